@@ -0,0 +1,50 @@
+"""create job and exhausted_key tables
+
+Revision ID: c7d2e4f19a06
+Revises: b3a52b39c8cc
+Create Date: 2026-10-19 00:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7d2e4f19a06'
+down_revision: Union[str, Sequence[str], None] = 'b3a52b39c8cc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'job',
+        sa.Column('pipeline', sa.String(), nullable=False),
+        sa.Column('md5', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('lease_owner', sa.String(), nullable=True),
+        sa.Column('lease_expires_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('next_run_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('pipeline', 'md5')
+    )
+    op.create_index('ix_job_claim', 'job', ['pipeline', 'status', 'next_run_at'], unique=False)
+    op.create_table(
+        'exhausted_key',
+        sa.Column('key_hash', sa.String(), nullable=False),
+        sa.Column('period', sa.String(), nullable=False),
+        sa.Column('exhausted_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key_hash', 'period')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('exhausted_key')
+    op.drop_index('ix_job_claim', table_name='job')
+    op.drop_table('job')
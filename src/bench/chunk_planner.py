@@ -0,0 +1,48 @@
+"""
+Micro-benchmark of the chunk planning of the pdf extraction.
+
+Writes the chunks of an interrupted extraction of a large document with `bench.corpus`, a share
+of them is missing, and replays the planning of the extraction worker: `ChunkPlanner` loads the
+chunks, every gap it gives is marked as extracted and the coverage of the pages is verified at
+the end. Reports the time of every step per size of the document.
+"""
+import random
+import tempfile
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from bench.corpus import make_pages, write_chunks
+
+
+def run(sizes=(1000, 5000, 20000), missing=0.1):
+    from content.pdf_extractor import ChunkPlanner
+
+    template = make_pages(seed=1552)
+    table = Table(title=f"Chunk planning, {missing:.0%} of chunks are missing")
+    for column in ["pages", "chunks", "load, ms", "plan, ms", "verify, ms"]:
+        table.add_column(column)
+    for pages in sizes:
+        with tempfile.TemporaryDirectory(prefix="monocorpus-bench-chunks-") as chunks_dir:
+            doc_pages = [template[i % len(template)] for i in range(pages)]
+            chunks = write_chunks(chunks_dir, doc_pages, missing=missing, rnd=random.Random(pages))
+
+            started = time.perf_counter()
+            planner = ChunkPlanner(chunks_dir, pages_count=pages)
+            loaded = time.perf_counter()
+            while chunk := planner.next():
+                planner.mark_success(chunk)
+            planned = time.perf_counter()
+            complete, missing_pages = planner.verify_complete()
+            verified = time.perf_counter()
+            assert complete, f"Pages {missing_pages[:10]} are not covered"
+
+        table.add_row(
+            str(pages),
+            str(chunks),
+            f"{(loaded - started) * 1000:.1f}",
+            f"{(planned - loaded) * 1000:.1f}",
+            f"{(verified - planned) * 1000:.1f}",
+        )
+    Console().print(table)
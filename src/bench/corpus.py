@@ -0,0 +1,518 @@
+"""
+Synthetic corpus for the benchmarks.
+
+Generates the data the pipelines work on, at any scale:
+- documents on the disk: pdf documents with a text layer of Tatar-like text, headings, footnotes
+  and figures, epub and docx documents, in a tree of directories like the entry point of
+  Yandex.Disk
+- `Document` rows of them: languages, some of them not Tatar, ISBNs, some of them shared by a full
+  document and its limited variants, content urls of the extracted documents
+- zipped markdown content of the extracted documents and upstream metadata in the buckets
+- chunks extracted by Gemini of the documents whose extraction was interrupted, with gaps between
+  them, like the ones read by `ChunkPlanner`
+
+Everything is generated from a seed, so runs with the same parameters process the same corpus.
+Large pdf documents are assembled from a few rendered pages, so a document of thousands of pages
+takes seconds to generate. Every document has its own title in the pdf metadata, so md5s differ.
+
+Functions:
+    run(root, docs, ...): Generates the corpus with rows in SQLite and shows a summary of it
+    generate(root, docs, ...): Generates the corpus into the directory, returns a summary of it
+    render_pdf(pages): Renders the distinct pages into the template of pdf documents
+    write_pdf(path, pages, title, template): Pdf document assembled from the template
+    write_epub(path, pages, title): Epub document, a chapter per ten pages
+    write_docx(path, pages, title): Docx document with footnotes
+    write_content(path, md5, pages): Zipped markdown content, as uploaded by the content extraction
+    write_chunks(chunks_dir, pages, missing, rnd): Chunks extracted by Gemini with gaps between them
+"""
+import functools
+import hashlib
+import io
+import json
+import os
+import random
+import time
+import zipfile
+from collections import Counter
+from html import escape
+from types import SimpleNamespace
+
+import pymupdf
+from rich.console import Console
+from rich.table import Table
+
+WORDS = [
+    "китап", "бала", "мәктәп", "укучы", "язучы", "халык", "тел", "сүз", "җөмлә", "әдәбият",
+    "Казан", "Тукай", "шигырь", "хикәя", "авыл", "җыр", "өй", "күңел", "дөнья", "ил",
+    "яхшы", "зур", "яңа", "бөек", "туган", "һәм", "белән", "өчен", "турында", "иде",
+]
+
+FORMATS = {"pdf": 0.7, "epub": 0.15, "docx": 0.15}
+
+MIME_TYPES = {
+    "pdf": "application/pdf",
+    "epub": "application/epub+zip",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+}
+
+TATAR_LANGUAGES = {"tt-Cyrl": 0.9, "tt-Latn-x-zamanalif": 0.05, "tt-Arab": 0.05}
+NON_TATAR_LANGUAGES = {"ru": 0.7, "ba-Cyrl": 0.2, "en": 0.1}
+
+GENRES = ["fiction", "poetry", "textbook", "science", "children", None]
+
+BUCKETS = {
+    "document": "ttdoc",
+    "metadata": "ttmeta",
+    "content": "ttcontent",
+    "upstream_metadata": "upstream-metadata",
+    "content_chunks": "ttcontent-chunks",
+    "image": "ttimg",
+}
+
+ENTRY_POINT = "/bench/monocorpus"
+STORAGE_HOST = "https://storage.bench"
+
+# distinct pages the documents are assembled from
+TEMPLATE_PAGES = 10
+# pages per chunk extracted by Gemini, the first size of `ChunkPlanner`
+CHUNK_SIZE = 5
+# files per directory on the disk
+DIR_SIZE = 1000
+
+# layout of an A4 page
+BODY = pymupdf.Rect(56, 56, 539, 560)
+FIGURE = pymupdf.Rect(150, 580, 445, 700)
+CAPTION = pymupdf.Rect(56, 704, 539, 724)
+FOOTNOTES = pymupdf.Rect(56, 732, 539, 800)
+
+
+def sentence(rnd):
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(4, 14))]
+    return " ".join(words).capitalize() + rnd.choice([".", ".", ".", "!", "?"])
+
+
+def paragraph(rnd):
+    return " ".join(sentence(rnd) for _ in range(rnd.randint(2, 6)))
+
+
+def make_pages(seed, figures=0.1, footnotes=0.3):
+    """
+    Distinct pages the documents are made of: a heading on every tenth page, paragraphs with
+    references to the footnotes of the page and sometimes a figure with a caption
+    """
+    rnd = random.Random(seed)
+    pages = []
+    for page_no in range(TEMPLATE_PAGES):
+        notes = []
+        paragraphs = []
+        for _ in range(rnd.randint(2, 3)):
+            note = None
+            if rnd.random() < footnotes:
+                notes.append(sentence(rnd))
+                note = len(notes)
+            paragraphs.append((paragraph(rnd), note))
+        pages.append(SimpleNamespace(
+            heading=sentence(rnd) if page_no % 10 == 0 else None,
+            paragraphs=paragraphs,
+            figure=f"Рәсем {page_no + 1}. {sentence(rnd)}" if rnd.random() < figures else None,
+            footnotes=notes,
+        ))
+    return pages
+
+
+def run(root, docs, **params):
+    """
+    Generate the corpus into the directory, `Document` rows are written into `bench.db` in it.
+    Point `database_url` of the config to `sqlite:///{root}/bench.db` to run the pipelines on it.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from models import Base
+
+    os.makedirs(root, exist_ok=True)
+    engine = create_engine(f"sqlite:///{os.path.join(root, 'bench.db')}")
+    Base.metadata.create_all(engine)
+    started = time.perf_counter()
+    with Session(engine) as session:
+        summary = generate(root, docs, session=session, **params)
+        session.commit()
+    seconds = time.perf_counter() - started
+
+    table = Table(title=f"Synthetic corpus in {root}, generated in {seconds:.1f}s")
+    for column in ["", "count"]:
+        table.add_column(column)
+    for key in ["documents", *MIME_TYPES, "pages", "rows", "unsynced", "non_tatar", "duplicates", "extracted", "interrupted", "chunks"]:
+        table.add_row(key, str(summary[key]))
+    for name in ["disk", "s3", "chunks"]:
+        table.add_row(f"{name}, MB", f"{_size(os.path.join(root, name)) / 1024 ** 2:.1f}")
+    Console().print(table)
+
+
+def _size(path):
+    return sum(os.path.getsize(os.path.join(dir_name, file)) for dir_name, _, files in os.walk(path) for file in files)
+
+
+def generate(
+    root,
+    docs,
+    pages=20,
+    max_pages=None,
+    seed=1552,
+    formats=FORMATS,
+    languages=TATAR_LANGUAGES,
+    non_tatar=0.05,
+    duplicates=0.05,
+    isbns=0.6,
+    extracted=0.5,
+    interrupted=0.0,
+    unsynced=0.0,
+    upstream_metadata=0.5,
+    figures=0.1,
+    files=True,
+    session=None,
+    chunks_dir=None,
+):
+    """
+    Generate the corpus into the directory:
+    - `disk/` is the root of the disk of `FakeYaDisk`, documents are under `ENTRY_POINT`
+    - `s3/` is the root of the buckets of `FakeS3`
+    - `chunks/{md5}/` has the chunks of the interrupted extractions, unless `chunks_dir` is given
+    `Document` rows are added into the session, they are not committed.
+
+    :param docs: count of documents
+    :param pages: mean count of pages of pdf documents, the counts are exponentially distributed
+    :param max_pages: limit of pages of a pdf document, ten times `pages` by default
+    :param formats: shares of the formats of the documents
+    :param languages: shares of the languages of the documents in Tatar
+    :param non_tatar: share of documents not in Tatar, the sync wipes them
+    :param duplicates: share of limited variants of other documents having the same ISBN
+    :param isbns: share of documents having an ISBN
+    :param extracted: share of pdf documents with uploaded content
+    :param interrupted: share of the other pdf documents with chunks extracted already
+    :param unsynced: share of documents without rows, the sync adds them
+    :param upstream_metadata: share of documents with upstream metadata in the bucket
+    :param figures: share of pages with a figure
+    :param files: if False, no documents are written to the disk and md5s are random
+    :return: summary of the corpus
+    """
+    from bench.fakes import FakeYaDisk, PUBLIC_URL_PREFIX
+    from models import Document
+
+    rnd = random.Random(seed)
+    max_pages = max_pages or pages * 10
+    template = make_pages(seed, figures=figures)
+    pdf_template = render_pdf(template) if files else None
+    chunks_dir = chunks_dir or os.path.join(root, "chunks")
+    disk = FakeYaDisk(os.path.join(root, "disk"))
+    content_dir = os.path.join(root, "s3", BUCKETS["content"])
+    upstream_dir = os.path.join(root, "s3", BUCKETS["upstream_metadata"])
+    for path in [content_dir, upstream_dir]:
+        os.makedirs(path, exist_ok=True)
+
+    summary = Counter()
+    originals = []
+    for idx in range(docs):
+        fmt = _choice(rnd, formats)
+        page_count = min(max_pages, max(1, round(rnd.expovariate(1 / pages)))) if fmt == "pdf" else None
+        doc_pages = _cycle(template, page_count or rnd.randint(10, 40))
+        title = f"{sentence(rnd)[:-1]} #{idx}"
+        ya_path = f"{ENTRY_POINT}/{fmt}/{idx // DIR_SIZE:03d}/doc-{idx:06d}.{fmt}"
+
+        if files:
+            local_path = os.path.join(disk.root, ya_path.lstrip("/"))
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            if fmt == "pdf":
+                write_pdf(local_path, doc_pages, title, template=pdf_template)
+            else:
+                _WRITERS[fmt](local_path, doc_pages, title)
+            file = disk.get_meta(ya_path)
+            md5, public_url, resource_id = file.md5, file.public_url, file.resource_id
+        else:
+            md5 = f"{rnd.getrandbits(128):032x}"
+            public_url, resource_id = f"{PUBLIC_URL_PREFIX}{md5}", hashlib.md5(ya_path.encode()).hexdigest()
+        summary[fmt] += 1
+        summary["pages"] += len(doc_pages)
+
+        if rnd.random() < upstream_metadata:
+            with open(os.path.join(upstream_dir, f"{md5}.zip"), "wb") as f:
+                f.write(_upstream_metadata(md5, title))
+
+        if rnd.random() < unsynced:
+            summary["unsynced"] += 1
+            continue
+
+        doc = Document(
+            md5=md5,
+            mime_type=MIME_TYPES[fmt],
+            ya_path=ya_path,
+            ya_public_url=public_url,
+            ya_public_key=md5,
+            ya_resource_id=resource_id,
+            title=title,
+            author=" ".join(rnd.choice(WORDS).capitalize() for _ in range(2)),
+            language=_choice(rnd, NON_TATAR_LANGUAGES if rnd.random() < non_tatar else languages),
+            publish_date=str(rnd.randint(1920, 2024)),
+            genre=rnd.choice(GENRES),
+            page_count=page_count,
+            full=True,
+            sharing_restricted=False,
+        )
+        if originals and rnd.random() < duplicates:
+            # a limited variant of a document, the sync keeps the full one
+            original = rnd.choice(originals)
+            doc.isbn, doc.full = original.isbn, False
+            summary["duplicates"] += 1
+        elif rnd.random() < isbns:
+            doc.isbn = _isbn(rnd)
+            originals.append(doc)
+        summary["non_tatar"] += doc.language in NON_TATAR_LANGUAGES
+
+        if fmt != "pdf" or rnd.random() < extracted:
+            write_content(os.path.join(content_dir, f"{md5}.zip"), md5, doc_pages)
+            doc.content_url = f"{STORAGE_HOST}/{BUCKETS['content']}/{md5}.zip"
+            doc.content_extraction_method = "bench"
+            summary["extracted"] += 1
+        elif rnd.random() < interrupted:
+            summary["chunks"] += write_chunks(os.path.join(chunks_dir, md5), doc_pages, missing=0.1, rnd=rnd)
+            summary["interrupted"] += 1
+        if session is not None:
+            session.add(doc)
+        summary["rows"] += 1
+
+    summary["documents"] = docs
+    return summary
+
+
+def write_pdf(path, pages, title, template=None):
+    """
+    Pdf document of the pages, which repeat the first `TEMPLATE_PAGES` of them. The pages are
+    rendered once into the template and copied from it, pass the template of `render_pdf` to
+    reuse it between documents.
+    """
+    template = template or render_pdf(pages[:TEMPLATE_PAGES])
+    with pymupdf.open() as doc:
+        for start in range(0, len(pages), len(template)):
+            doc.insert_pdf(template, to_page=min(len(pages) - start, len(template)) - 1)
+        doc.set_metadata({"title": title})
+        doc.save(path, garbage=1, deflate=True)
+
+
+def render_pdf(pages):
+    """Render the pages into the template of `write_pdf`"""
+    doc = pymupdf.open()
+    for page in pages:
+        pdf_page = doc.new_page()
+        html = f"<h2>{escape(page.heading)}</h2>" if page.heading else ""
+        html += "".join(f"<p>{escape(text)}{f'<sup>{note}</sup>' if note else ''}</p>" for text, note in page.paragraphs)
+        # the builtin fonts have no glyphs for Tatar letters, the html box falls back to the fonts having them
+        pdf_page.insert_htmlbox(BODY, html)
+        if page.figure:
+            pdf_page.draw_rect(FIGURE, color=(0.3, 0.3, 0.3), fill=(0.8, 0.85, 0.9))
+            pdf_page.draw_circle(FIGURE.tl + (60, 60), 30, color=(0.3, 0.3, 0.3), fill=(0.9, 0.6, 0.3))
+            pdf_page.insert_htmlbox(CAPTION, f"<p style='font-size:9px;text-align:center'>{escape(page.figure)}</p>")
+        if page.footnotes:
+            notes = "".join(f"<p style='font-size:8px'><sup>{idx}</sup> {escape(text)}</p>" for idx, text in enumerate(page.footnotes, start=1))
+            pdf_page.insert_htmlbox(FOOTNOTES, notes)
+    # every html box embeds its fonts, the subsets of them are copied with every page
+    doc.subset_fonts()
+    return pymupdf.open("pdf", doc.tobytes(garbage=3, deflate=True))
+
+
+def write_epub(path, pages, title):
+    """Epub document, a chapter per ten pages, footnotes are asides linked from the text"""
+    chapters = [pages[i:i + 10] for i in range(0, len(pages), 10)]
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        # the mimetype goes first and is not compressed
+        zf.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+            '</container>'
+        ))
+        manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+                    '<item id="figure" href="figure.png" media-type="image/png"/>']
+        spine = []
+        nav = []
+        for idx, chapter in enumerate(chapters, start=1):
+            zf.writestr(f"OEBPS/chapter-{idx}.xhtml", _xhtml(title, _epub_chapter(chapter)))
+            manifest.append(f'<item id="chapter-{idx}" href="chapter-{idx}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="chapter-{idx}"/>')
+            nav.append(f'<li><a href="chapter-{idx}.xhtml">{idx}</a></li>')
+        zf.writestr("OEBPS/nav.xhtml", _xhtml(title, f'<nav epub:type="toc"><ol>{"".join(nav)}</ol></nav>'))
+        zf.writestr("OEBPS/figure.png", _figure_png())
+        zf.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="id">{hashlib.md5(title.encode()).hexdigest()}</dc:identifier>'
+            f'<dc:title>{escape(title)}</dc:title><dc:language>tt</dc:language>'
+            '</metadata>'
+            f'<manifest>{"".join(manifest)}</manifest><spine>{"".join(spine)}</spine>'
+            '</package>'
+        ))
+
+
+def _epub_chapter(pages):
+    body = []
+    for page in pages:
+        if page.heading:
+            body.append(f"<h2>{escape(page.heading)}</h2>")
+        for text, note in page.paragraphs:
+            ref = f'<a epub:type="noteref" href="#n{id(page)}-{note}">{note}</a>' if note else ""
+            body.append(f"<p>{escape(text)}{ref}</p>")
+        if page.figure:
+            body.append(f'<figure><img src="figure.png" alt=""/><figcaption>{escape(page.figure)}</figcaption></figure>')
+        for idx, text in enumerate(page.footnotes, start=1):
+            body.append(f'<aside epub:type="footnote" id="n{id(page)}-{idx}"><p>{escape(text)}</p></aside>')
+    return "".join(body)
+
+
+def _xhtml(title, body):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="tt">'
+        f'<head><title>{escape(title)}</title></head><body>{body}</body></html>'
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _figure_png():
+    pix = pymupdf.Pixmap(pymupdf.csRGB, pymupdf.IRect(0, 0, 64, 48), False)
+    pix.set_rect(pix.irect, (200, 215, 230))
+    return pix.tobytes("png")
+
+
+def write_docx(path, pages, title):
+    """Docx document with headings and footnotes, figures are left out"""
+    body = []
+    notes = []
+    for page in pages:
+        if page.heading:
+            body.append(f'<w:p><w:pPr><w:pStyle w:val="Heading2"/></w:pPr>{_run(page.heading)}</w:p>')
+        for text, note in page.paragraphs:
+            ref = ""
+            if note:
+                # ids 0 and 1 are reserved for the separators
+                notes.append((len(notes) + 2, page.footnotes[note - 1]))
+                ref = f'<w:r><w:rPr><w:vertAlign w:val="superscript"/></w:rPr><w:footnoteReference w:id="{notes[-1][0]}"/></w:r>'
+            body.append(f"<w:p>{_run(text)}{ref}</w:p>")
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '<Override PartName="/word/footnotes.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.footnotes+xml"/>'
+            '<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>'
+            '</Types>'
+        ))
+        zf.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+            '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" Target="docProps/core.xml"/>'
+            '</Relationships>'
+        ))
+        zf.writestr("docProps/core.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:title>{escape(title)}</dc:title><dc:language>tt</dc:language>'
+            '</cp:coreProperties>'
+        ))
+        zf.writestr("word/_rels/document.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/footnotes" Target="footnotes.xml"/>'
+            '</Relationships>'
+        ))
+        zf.writestr("word/document.xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document {_W}><w:body>{"".join(body)}</w:body></w:document>'
+        ))
+        footnotes = [
+            '<w:footnote w:type="separator" w:id="0"><w:p><w:r><w:separator/></w:r></w:p></w:footnote>',
+            '<w:footnote w:type="continuationSeparator" w:id="1"><w:p><w:r><w:continuationSeparator/></w:r></w:p></w:footnote>',
+            *(f'<w:footnote w:id="{note_id}"><w:p>{_run(text)}</w:p></w:footnote>' for note_id, text in notes),
+        ]
+        zf.writestr("word/footnotes.xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:footnotes {_W}>{"".join(footnotes)}</w:footnotes>'
+        ))
+
+
+_W = 'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+
+def _run(text):
+    return f'<w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r>'
+
+
+def page_markdown(page, page_no, first_footnote=1):
+    """Markdown of the page like the one extracted by Gemini, `page_no` counts the pages of the document from 1"""
+    parts = [f"## {page.heading}"] if page.heading else []
+    parts.extend(text + (f"[^{first_footnote + note - 1}]" if note else "") for text, note in page.paragraphs)
+    if page.figure:
+        bbox = [round(FIGURE.y0 / 842 * 1000), round(FIGURE.x0 / 595 * 1000), round(FIGURE.y1 / 842 * 1000), round(FIGURE.x1 / 595 * 1000)]
+        parts.append(f'<figure data-bbox="{bbox}" data-page="{page_no}"><figcaption>{page.figure}</figcaption></figure>')
+    parts.extend(f"[^{first_footnote + idx}]: {text}" for idx, text in enumerate(page.footnotes))
+    return "\n\n".join(parts)
+
+
+def _markdown(pages, first_page=1):
+    parts = []
+    footnote = 1
+    for page_no, page in enumerate(pages, start=first_page):
+        parts.append(page_markdown(page, page_no, footnote))
+        footnote += len(page.footnotes)
+    return "\n\n".join(parts)
+
+
+def write_content(path, md5, pages):
+    """Zipped markdown content of the document, as uploaded by the content extraction"""
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f"{md5}.md", _markdown(pages))
+
+
+def write_chunks(chunks_dir, pages, missing, rnd):
+    """
+    Chunks of `CHUNK_SIZE` pages extracted by Gemini, a `missing` share of them is left out,
+    like after an interrupted extraction. Ranges are the ones of `ChunkPlanner`, from 0 to the
+    count of pages inclusive. Returns the count of the written chunks.
+    """
+    os.makedirs(chunks_dir, exist_ok=True)
+    written = 0
+    for start in range(0, len(pages) + 1, CHUNK_SIZE):
+        if rnd.random() < missing:
+            continue
+        end = min(start + CHUNK_SIZE - 1, len(pages))
+        content = _markdown(pages[start:end + 1], first_page=start + 1)
+        with open(os.path.join(chunks_dir, f"chunk-{start}-{end}.json"), "w") as f:
+            json.dump({"content": content}, f, ensure_ascii=False)
+        written += 1
+    return written
+
+
+def _upstream_metadata(md5, title):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr(f"{md5}.json", json.dumps({"title": title}, ensure_ascii=False))
+    return buffer.getvalue()
+
+
+def _isbn(rnd):
+    """ISBN-13 of the Tatar book publishing house with a valid check digit"""
+    digits = f"9785298{rnd.randint(0, 99999):05d}"
+    check = (10 - sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10) % 10
+    return f"{digits[:3]}-{digits[3]}-{digits[4:7]}-{digits[7:]}-{check}"
+
+
+def _choice(rnd, weights):
+    return rnd.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def _cycle(template, count):
+    return [template[i % len(template)] for i in range(count)]
+
+
+_WRITERS = {"epub": write_epub, "docx": write_docx}
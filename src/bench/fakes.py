@@ -0,0 +1,300 @@
+"""
+Local stand-ins of the services used by the pipelines, for the offline benchmarks.
+
+- `FakeGemini` replaces `genai.Client`: files are "uploaded" instantly, and the response is
+  streamed after a configurable latency at a configurable rate of tokens. Responses are built
+  from the text layer of the uploaded pdf slices, so they pass the validation of the pipelines.
+- `FakeS3` replaces the boto3 client of the object storage, buckets are directories.
+- `FakeYaDisk` replaces `yadisk_client.YaDisk`, the disk is a directory tree, every file is
+  published by a link derived from its md5. `FakePublicLinks` downloads by these links in place
+  of `downloads.download_public`.
+
+Only the methods called by the pipelines are implemented.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import time
+import uuid
+from types import SimpleNamespace
+
+import pymupdf
+
+from utils import calculate_md5
+
+PUBLIC_URL_PREFIX = "https://disk.bench/d/"
+
+# Gemini accounts a page of a pdf document as this count of tokens
+TOKENS_PER_PAGE = 258
+
+
+class FakeGemini:
+
+    def __init__(self, api_key, latency=2.0, tokens_per_second=500.0):
+        self.api_key = api_key
+        self.files = _Files()
+        self.models = _Models(latency, tokens_per_second)
+
+
+class _File(SimpleNamespace):
+    pass
+
+
+class _Files:
+
+    def __init__(self):
+        self.uploaded = {}
+
+    def upload(self, file, config=None):
+        name = f"files/{uuid.uuid4().hex}"
+        self.uploaded[name] = _File(name=name, path=file, state="ACTIVE", mime_type=(config or {}).get("mime_type"))
+        return self.uploaded[name]
+
+    def get(self, name):
+        return self.uploaded[name]
+
+    def delete(self, name):
+        self.uploaded.pop(name, None)
+
+
+class _Models:
+
+    def __init__(self, latency, tokens_per_second):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+
+    def generate_content_stream(self, model, contents, config):
+        # like the real client, the request is sent on the first read of the stream
+        return self._stream(contents, config.response_schema)
+
+    def _stream(self, contents, schema):
+        files = [c for c in contents if isinstance(c, _File)]
+        pages, text = _read_pdfs(files)
+        response = _respond(schema.__name__ if schema else None, text, pages)
+        prompt_tokens = sum(len(c.get("text", "")) for c in contents if isinstance(c, dict)) // 4 + pages * TOKENS_PER_PAGE
+        output_tokens = len(response) // 4
+
+        time.sleep(self.latency)
+        step = 400
+        for idx in range(0, len(response), step):
+            part = response[idx:idx + step]
+            time.sleep(len(part) / 4 / self.tokens_per_second)
+            last = idx + step >= len(response)
+            usage = SimpleNamespace(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=output_tokens,
+                total_token_count=prompt_tokens + output_tokens,
+            ) if last else None
+            yield SimpleNamespace(text=part, usage_metadata=usage)
+
+
+def _read_pdfs(files):
+    pages = 0
+    texts = []
+    for f in files:
+        with pymupdf.open(f.path) as doc:
+            pages += doc.page_count
+            texts.extend(page.get_text().strip() for page in doc)
+    return pages, "\n\n".join(texts)
+
+
+def _respond(schema_name, text, pages):
+    if schema_name == "ExtractionResult":
+        return json.dumps({"content": text}, ensure_ascii=False)
+    if schema_name == "Book":
+        title = text.strip().split("\n")[0][:100] if text.strip() else None
+        return json.dumps({
+            "@context": "https://schema.org",
+            "@type": "Book",
+            "name": title,
+            "inLanguage": "tt-Cyrl",
+            "genre": ["fiction"],
+            "datePublished": "1990",
+            "numberOfPages": pages,
+        }, ensure_ascii=False)
+    return "{}"
+
+
+class FakeS3:
+
+    def __init__(self, root):
+        self.root = root
+        self._endpoint = SimpleNamespace(host="https://storage.bench")
+
+    def upload_file(self, path, bucket, key):
+        dest = self._path(bucket, key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(path, dest)
+
+    def download_file(self, bucket, key, path):
+        shutil.copyfile(self._path(bucket, key), path)
+
+    def list_objects_v2(self, Bucket, Prefix="", MaxKeys=1000, **kwargs):
+        contents = []
+        for key in self._keys(Bucket, Prefix):
+            contents.append({"Key": key, "Size": os.path.getsize(self._path(Bucket, key))})
+            if len(contents) >= MaxKeys:
+                break
+        return {"Contents": contents} if contents else {}
+
+    def get_paginator(self, operation):
+        return SimpleNamespace(paginate=self._paginate)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            try:
+                os.remove(self._path(Bucket, obj["Key"]))
+            except FileNotFoundError:
+                pass
+
+    def _paginate(self, Bucket, Prefix=""):
+        page = []
+        for key in self._keys(Bucket, Prefix):
+            page.append({"Key": key, "Size": os.path.getsize(self._path(Bucket, key))})
+            if len(page) == 1000:
+                yield {"Contents": page}
+                page = []
+        if page:
+            yield {"Contents": page}
+
+    def _keys(self, bucket, prefix):
+        bucket_dir = os.path.join(self.root, bucket)
+        keys = []
+        for dir_name, _, files in os.walk(bucket_dir):
+            for file in files:
+                key = os.path.relpath(os.path.join(dir_name, file), bucket_dir).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+
+class FakeYaDisk:
+
+    def __init__(self, root, token=None, proxy=None):
+        self.root = root
+        self._md5s = {}
+        self._public = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def get_meta(self, path, fields=None, **kwargs):
+        return self._resource(self._local(path))
+
+    def listdir(self, path, max_items=None, fields=None, **kwargs):
+        local = self._local(path)
+        for name in sorted(os.listdir(local))[:max_items]:
+            yield self._resource(os.path.join(local, name))
+
+    def get_public_meta(self, public_url, fields=None, **kwargs):
+        return self._resource(self._by_public_url(public_url))
+
+    def download_public(self, public_url, file_obj, **kwargs):
+        with open(self._by_public_url(public_url), "rb") as f:
+            shutil.copyfileobj(f, file_obj)
+
+    def upload(self, local_path, path, overwrite=False, **kwargs):
+        dest = self._local(path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(local_path, dest)
+        return self._resource(dest)
+
+    def create_folders(self, path, **kwargs):
+        os.makedirs(self._local(path), exist_ok=True)
+
+    def move(self, src_path, dst_path, overwrite=False, **kwargs):
+        dest = self._local(dst_path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(self._local(src_path), dest)
+
+    def remove(self, path, **kwargs):
+        local = self._local(path)
+        if os.path.isdir(local):
+            shutil.rmtree(local)
+        elif os.path.exists(local):
+            os.remove(local)
+
+    def publish(self, path, **kwargs):
+        # every file is published already
+        return self._resource(self._local(path))
+
+    def unpublish(self, path, **kwargs):
+        pass
+
+    def _local(self, path):
+        return os.path.join(self.root, path.removeprefix("disk:").lstrip("/"))
+
+    def _disk_path(self, local):
+        return "disk:/" + os.path.relpath(local, self.root).replace(os.sep, "/")
+
+    def _md5(self, local):
+        stat = os.stat(local)
+        key = (local, stat.st_size, stat.st_mtime_ns)
+        if key not in self._md5s:
+            self._md5s[key] = calculate_md5(local)
+        return self._md5s[key]
+
+    def _resource(self, local):
+        path = self._disk_path(local)
+        if os.path.isdir(local):
+            return _Resource(type="dir", path=path, name=os.path.basename(local))
+        md5 = self._md5(local)
+        return _Resource(
+            type="file",
+            path=path,
+            name=os.path.basename(local),
+            md5=md5,
+            mime_type=mimetypes.guess_type(local)[0] or "application/octet-stream",
+            public_key=md5,
+            public_url=f"{PUBLIC_URL_PREFIX}{md5}",
+            resource_id=hashlib.md5(path.encode()).hexdigest(),
+            size=os.path.getsize(local),
+        )
+
+    def _by_public_url(self, public_url):
+        md5 = public_url.removeprefix(PUBLIC_URL_PREFIX)
+        if not os.path.exists(self._public.get(md5, "")):
+            # files were added or moved since the last lookup
+            self._public = {
+                self._md5(os.path.join(dir_name, file)): os.path.join(dir_name, file)
+                for dir_name, _, files in os.walk(self.root)
+                for file in files
+            }
+        if md5 not in self._public:
+            raise FileNotFoundError(public_url)
+        return self._public[md5]
+
+
+class _Resource(SimpleNamespace):
+    """Attributes of the resource are also readable by keys, like `resp['public_key']`"""
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        # fields which are not set are None, like in the responses of the real API
+        return None
+
+
+class FakePublicLinks:
+    """Downloads by the public links of `FakeYaDisk`, replaces `downloads.download_public`"""
+
+    def __init__(self, disk_root):
+        self.disk = FakeYaDisk(disk_root)
+
+    def __call__(self, public_url, local_path, expected_md5, config):
+        part_path = f"{local_path}.part"
+        with open(part_path, "wb") as f:
+            self.disk.download_public(public_url, f)
+        os.replace(part_path, local_path)
+        return expected_md5
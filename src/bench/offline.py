@@ -0,0 +1,356 @@
+"""
+Offline benchmark of the pipelines.
+
+Runs `extract` of pdf documents, `meta`, `sync` and `hf` end to end against the local stand-ins
+of Gemini, S3 and Yandex.Disk from `bench.fakes`, with SQLite in place of Postgres. Every
+scenario runs in two child processes, the first one generates the corpus with `bench.corpus` and
+the second one runs the pipeline, with a temporary directory as the home and the working
+directory, so the work directories and the state files of the real runs are not touched. The wall time, the throughput
+and the peak memory of the pipeline process and of its child processes are reported and
+appended to `offline.csv` in `Dirs.LOGS`, the output of every scenario is saved next to it.
+
+The stand-ins replace `create_client`, `create_session`, `YaDisk`, `download_public` and
+`read_config` in the loaded modules of the project, also in the postprocessing processes.
+Pacing of requests for the free tier of Gemini and the delays between the starts of the workers
+are disabled, the latency of the fake Gemini stands for the time of a request.
+"""
+import base64
+import csv
+import functools
+import importlib
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from rich import print
+from rich.console import Console
+from rich.table import Table
+
+from bench.corpus import BUCKETS, ENTRY_POINT
+from dirs import Dirs
+from utils import get_in_workdir
+
+SCENARIOS = ["extract", "meta", "sync", "hf"]
+
+# modules of the pipelines, the stand-ins are put in place after they are imported
+MODULES = {
+    "extract": ["content.dispatch", "content.pdf_extractor", "content.postprocess_queue"],
+    "meta": ["metadata.dispatch"],
+    "sync": ["sync"],
+    "hf": ["hf"],
+}
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(SRC_DIR)
+
+# `time` for the dispatchers: workers are started without delays
+_NO_DELAYS = SimpleNamespace(sleep=lambda seconds: None, monotonic=time.monotonic, time=time.time)
+
+
+def run(scenarios=SCENARIOS, docs=8, pages=20, keys=4, latency=2.0, tokens_per_second=500.0, postprocess_workers=2, timeout=30 * 60):
+    settings = {
+        "docs": docs,
+        "pages": pages,
+        "keys": keys,
+        "latency": latency,
+        "tokens_per_second": tokens_per_second,
+        "postprocess_workers": postprocess_workers,
+    }
+    table = Table(title=f"Offline pipelines: {docs} documents of {pages} pages on average, {keys} keys, Gemini latency {latency}s")
+    for column in ["scenario", "status", "documents", "time, s", "docs/min", "pages/min", "peak RSS, MB", "children peak RSS, MB"]:
+        table.add_column(column)
+
+    history_file = get_in_workdir(Dirs.LOGS, file="offline.csv")
+    new_file = not os.path.exists(history_file)
+    with open(history_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["timestamp", "scenario", *settings, "documents", "seconds", "peak_rss_mb", "children_peak_rss_mb"])
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        for scenario in scenarios:
+            print(f"Running scenario '{scenario}'")
+            result = _run_scenario(scenario, settings, timeout)
+            if result["status"] != "ok":
+                table.add_row(scenario, f"[red]{result['status']}[/red]", *["-"] * 6)
+                continue
+            seconds = result["seconds"]
+            table.add_row(
+                scenario,
+                "[green]ok[/green]",
+                str(result["documents"]),
+                f"{seconds:.1f}",
+                f"{result['documents'] / seconds * 60:.1f}",
+                f"{result['pages'] / seconds * 60:.0f}" if result["pages"] else "-",
+                f"{result['peak_rss_mb']:.0f}",
+                f"{result['children_peak_rss_mb']:.0f}",
+            )
+            writer.writerow([
+                timestamp, scenario, *settings.values(), result["documents"], f"{seconds:.2f}",
+                f"{result['peak_rss_mb']:.1f}", f"{result['children_peak_rss_mb']:.1f}",
+            ])
+
+    Console().print(table)
+    print(f"History is appended to {history_file}")
+
+
+def _run_scenario(scenario, settings, timeout):
+    log_path = get_in_workdir(Dirs.LOGS, file=f"offline-{scenario}.log")
+    with tempfile.TemporaryDirectory(prefix=f"monocorpus-bench-{scenario}-") as home, open(log_path, "w") as log:
+        env = {**os.environ, "HOME": home, "PYTHONPATH": os.pathsep.join(filter(None, [SRC_DIR, os.environ.get("PYTHONPATH")]))}
+        # metrics of the child processes are collected in their own home
+        env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        spec = json.dumps({"scenario": scenario, **settings})
+        for phase in ["prepare", "run"]:
+            # a new session, so the postprocessing processes are killed on timeout as well
+            proc = subprocess.Popen(
+                [sys.executable, "-c", f"from bench.offline import child; child({phase!r})", spec],
+                cwd=home,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+            try:
+                return_code = proc.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+                return {"status": f"timeout in {phase}, see {log_path}"}
+            if return_code != 0:
+                return {"status": f"failed in {phase}, see {log_path}"}
+        with open(os.path.join(home, "result.json")) as f:
+            return {"status": "ok", **json.load(f)}
+
+
+def child(phase):
+    """Entry point of the child processes, the home is the working directory"""
+    spec = json.loads(sys.argv[1])
+    home = os.getcwd()
+    scenario = spec["scenario"]
+    if phase == "prepare":
+        _PREPARE[scenario](spec, home)
+        return
+
+    install(home, spec)
+    started = time.perf_counter()
+    _RUN[scenario](spec)
+    seconds = time.perf_counter() - started
+    documents, pages = _COUNT[scenario](spec, home)
+    with open(os.path.join(home, "result.json"), "w") as f:
+        json.dump({
+            "documents": documents,
+            "pages": pages,
+            "seconds": seconds,
+            "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+            "children_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        }, f)
+
+
+def install(home, spec):
+    """Put the stand-ins of the services in place in the modules of the scenario"""
+    from bench.fakes import FakeGemini, FakeS3, FakeYaDisk, FakePublicLinks
+
+    for module in ["utils", "s3", "downloads", *MODULES[spec["scenario"]]]:
+        importlib.import_module(module)
+    config = _config(home, spec)
+    disk_root = os.path.join(home, "disk")
+    _substitute("utils", "read_config", lambda *args, **kwargs: config)
+    _substitute("s3", "create_session", lambda config=None: FakeS3(os.path.join(home, "s3")))
+    _substitute("gemini", "create_client", lambda api_key: FakeGemini(api_key, spec["latency"], spec["tokens_per_second"]))
+    _substitute("yadisk_client", "YaDisk", functools.partial(FakeYaDisk, disk_root))
+    _substitute("downloads", "download_public", FakePublicLinks(disk_root))
+
+    if module := sys.modules.get("content.pdf_extractor"):
+        module.PdfExtractor._sleep_if_needed = lambda self: None
+    if module := sys.modules.get("metadata.dispatch"):
+        module.MetadataExtractionWorker._sleep_if_needed = lambda self, prev_req_time: None
+    for name in ["content.dispatch", "metadata.dispatch"]:
+        if module := sys.modules.get(name):
+            module.time = _NO_DELAYS
+    if module := sys.modules.get("content.postprocess_queue"):
+        # the postprocessing processes are spawned, they put the stand-ins in place on start
+        module.setup_child_logging = _ChildSetup(home, spec)
+
+
+class _ChildSetup:
+    """Initializer of the postprocessing processes"""
+
+    def __init__(self, home, spec):
+        self.home = home
+        self.spec = spec
+
+    def __call__(self, queue):
+        from logs import setup_child_logging
+
+        setup_child_logging(queue)
+        install(self.home, self.spec)
+
+
+def _substitute(module_name, name, replacement):
+    """Replace the object in every module of the project which has imported it"""
+    if module_name not in sys.modules:
+        return
+    original = getattr(sys.modules[module_name], name)
+    for module in list(sys.modules.values()):
+        if not (getattr(module, "__file__", None) or "").startswith(SRC_DIR):
+            continue
+        for attr, value in list(vars(module).items()):
+            if value is original:
+                setattr(module, attr, replacement)
+
+
+def _config(home, spec):
+    return {
+        # the pipelines write from several threads and processes at once
+        "database_url": f"sqlite:///{os.path.join(home, 'bench.db')}?timeout=60",
+        "gemini_api_keys": [f"bench-key-{idx:04d}" for idx in range(spec["keys"])],
+        "proxy": None,
+        "encryption_key": base64.urlsafe_b64encode(bytes(32)).decode(),
+        "yandex": {
+            "disk": {
+                "oauth_token": "bench",
+                "entry_point": ENTRY_POINT,
+                "entry_points": {"tt": ENTRY_POINT},
+                "filtered_out": "/bench/filtered_out",
+                "hidden": f"{ENTRY_POINT}/hidden",
+            },
+            "cloud": {
+                "aws_access_key_id": "bench",
+                "aws_secret_access_key": "bench",
+                "bucket": BUCKETS,
+            },
+        },
+        "sentence_segmenter": "rules",
+        "downloads": {"prefetch": 2},
+    }
+
+
+def _session(home, spec):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from models import Base
+
+    engine = create_engine(_config(home, spec)["database_url"])
+    Base.metadata.create_all(engine)
+    return Session(engine)
+
+
+def _prepare_extract(spec, home):
+    from bench.corpus import generate
+    from prepare_shots import load_inline_shots
+
+    # the examples of the prompt are read from the working directory, they are cooked before the run like in production
+    shutil.copytree(os.path.join(REPO_DIR, "shots", "snippets"), os.path.join(home, "shots", "snippets"))
+    os.makedirs(os.path.join(home, "shots", "cooked"))
+    load_inline_shots()
+    with _session(home, spec) as session:
+        # the fake Gemini responds with the text layer, there are no figures to detect
+        generate(
+            home, spec["docs"], pages=spec["pages"], formats={"pdf": 1}, languages={"tt-Cyrl": 1}, non_tatar=0,
+            duplicates=0, extracted=0, figures=0, session=session,
+        )
+        session.commit()
+
+
+def _prepare_meta(spec, home):
+    from bench.corpus import generate
+
+    with _session(home, spec) as session:
+        generate(home, spec["docs"], pages=spec["pages"], formats={"pdf": 1}, extracted=0, session=session)
+        session.commit()
+
+
+def _prepare_sync(spec, home):
+    """
+    Half of the documents on the disk are synced already, some of them are not in Tatar or are
+    limited variants of other documents, the sync wipes them
+    """
+    from bench.corpus import generate
+
+    with _session(home, spec) as session:
+        generate(home, spec["docs"], pages=spec["pages"], unsynced=0.5, non_tatar=0.1, duplicates=0.1, session=session)
+        session.commit()
+
+
+def _prepare_hf(spec, home):
+    from bench.corpus import generate
+
+    with _session(home, spec) as session:
+        # documents are not read by the assembling of the dataset
+        generate(home, spec["docs"], pages=spec["pages"], non_tatar=0, extracted=1, files=False, session=session)
+        session.commit()
+
+
+def _run_extract(spec):
+    from cli import ExtractParams
+    from content.dispatch import _process_pdf
+
+    params = ExtractParams(md5=None, path=None, batch_size=spec["docs"], workers=spec["keys"], postprocess_workers=spec["postprocess_workers"])
+    _process_pdf(params, "tt")
+
+
+def _run_meta(spec):
+    from metadata.dispatch import _process_by_predicate
+
+    _process_by_predicate("tt", docs_batch_size=spec["docs"], keys_batch_size=spec["keys"])
+
+
+def _run_sync(spec):
+    from sync import sync
+
+    sync()
+
+
+def _run_hf(spec):
+    from hf import assemble_dataset
+
+    assemble_dataset()
+
+
+def _count_extract(spec, home):
+    from sqlalchemy import func, select
+    from models import Document
+
+    with _session(home, spec) as session:
+        documents, pages = session.execute(
+            select(func.count(), func.sum(Document.page_count)).where(Document.content_url.is_not(None))
+        ).one()
+    return documents, pages or 0
+
+
+def _count_meta(spec, home):
+    from sqlalchemy import func, select
+    from models import Document
+
+    with _session(home, spec) as session:
+        return session.scalar(select(func.count()).where(Document.meta.is_not(None))), None
+
+
+def _count_sync(spec, home):
+    # every file on the disk is visited
+    return spec["docs"], None
+
+
+def _count_hf(spec, home):
+    import pyarrow.parquet as pq
+
+    parquet_dir = get_in_workdir(Dirs.PARQUET)
+    return sum(pq.ParquetFile(os.path.join(parquet_dir, name)).metadata.num_rows for name in os.listdir(parquet_dir)), None
+
+
+def _peak_rss_mb(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+_PREPARE = {"extract": _prepare_extract, "meta": _prepare_meta, "sync": _prepare_sync, "hf": _prepare_hf}
+_RUN = {"extract": _run_extract, "meta": _run_meta, "sync": _run_sync, "hf": _run_hf}
+_COUNT = {"extract": _count_extract, "meta": _count_meta, "sync": _count_sync, "hf": _count_hf}
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark of the chunk continuity check.
+
+Glues synthetic chunk boundaries with `continue_smoothly` using the rule-based segmenter and,
+if spaCy is installed, the spaCy sentencizer. Reports the time of both and how often they agree,
+the disagreeing boundaries are printed to be turned into new rules.
+"""
+import random
+import time
+
+from rich import print
+from rich.table import Table
+from rich.console import Console
+
+from content.continuity_checker import continue_smoothly
+
+WORDS = ["китап", "бала", "мәктәп", "укучы", "язучы", "халык", "тел", "сүз", "җөмлә", "әдәбият", "Казан", "Тукай", "1905", "т.б", "ТАССР"]
+ENDINGS = [".", "!", "?", "...", "…", "?!", ".»", "!)", ",", ":", ";", " —", "-", ""]
+OPENINGS = ["", "«", "(", "— ", "\n", " ", "\n\n"]
+
+
+def synthetic_boundaries(count, seed=1552):
+    rnd = random.Random(seed)
+
+    def sentence():
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(3, 15))]
+        if rnd.random() < 0.5:
+            words[0] = words[0].capitalize()
+        return " ".join(words) + rnd.choice(ENDINGS)
+
+    boundaries = []
+    for _ in range(count):
+        tail = " ".join(sentence() for _ in range(rnd.randint(1, 5)))[-300:]
+        if rnd.random() < 0.3:
+            tail += "\n"
+        head = rnd.choice(OPENINGS) + " ".join(sentence() for _ in range(rnd.randint(1, 5)))
+        boundaries.append((tail, head))
+    return boundaries
+
+
+def run(count=2000):
+    boundaries = synthetic_boundaries(count)
+    segmenters = ["rules"]
+    try:
+        import spacy  # noqa: F401
+        segmenters.append("spacy")
+    except ImportError:
+        print("[yellow]spaCy is not installed, agreement is not checked[/yellow]")
+
+    results = {}
+    table = Table(title=f"Continuity check of {count} chunk boundaries")
+    for column in ["segmenter", "total, s", "per boundary, µs"]:
+        table.add_column(column)
+    for segmenter in segmenters:
+        # the first call loads the spaCy pipeline, it is not a part of the measurement
+        continue_smoothly(*boundaries[0], segmenter=segmenter)
+        start = time.perf_counter()
+        results[segmenter] = [continue_smoothly(tail, head, segmenter=segmenter) for tail, head in boundaries]
+        elapsed = time.perf_counter() - start
+        table.add_row(segmenter, f"{elapsed:.3f}", f"{elapsed / count * 1e6:.1f}")
+    Console().print(table)
+
+    if "spacy" in results:
+        disagreements = [
+            (tail, head)
+            for (tail, head), rules, spacy_result in zip(boundaries, results["rules"], results["spacy"])
+            if rules != spacy_result
+        ]
+        print(f"Agreement with spaCy: {100 * (1 - len(disagreements) / count):.2f}%")
+        for tail, head in disagreements[:10]:
+            print(f"  {tail[-40:]!r} | {head[:40]!r}")
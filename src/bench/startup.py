@@ -0,0 +1,98 @@
+"""
+Startup benchmark of the CLI modules.
+
+Imports every module in a fresh interpreter with `python -X importtime` and reports the total
+import time together with the heaviest top-level imports. Every run is appended to
+`startup.csv` in `Dirs.LOGS`, so regressions can be tracked over time.
+"""
+import csv
+import os
+import subprocess
+import sys
+import time
+
+from rich.table import Table
+from rich.console import Console
+
+from dirs import Dirs
+from utils import get_in_workdir
+
+MODULES = [
+    "cli",
+    "content",
+    "content.non_pdf_pipeline",
+    "content.pdf_extractor",
+    "content.pdf_postprocess",
+    "metadata",
+]
+
+
+def measure(module, repeat=3):
+    """Import time of the module in microseconds and of its direct imports, best of `repeat` runs"""
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=src_dir,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        total, imports = _parse(result.stderr, module)
+        if best is None or total < best[0]:
+            best = (total, imports)
+    return best
+
+
+def _parse(output, module):
+    # lines look like `import time:       512 |      12345 |   package.module`, nesting is shown by indentation,
+    # a module is reported after everything it imports
+    chain = {".".join(module.split(".")[:idx]) for idx in range(1, module.count(".") + 2)}
+    total = 0
+    imports = {}
+    nested = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if level == 1:
+            nested[name] = int(cumulative)
+        elif level == 0:
+            # interpreter startup imports site, encodings etc. before the module, they are not counted
+            if name in chain:
+                total += int(cumulative)
+                imports.update(nested)
+            nested = {}
+    return total, imports
+
+
+def run(repeat=3):
+    table = Table(title=f"Import time of CLI modules, best of {repeat}")
+    for column in ["module", "total, ms", "heaviest imports"]:
+        table.add_column(column)
+
+    history_file = get_in_workdir(Dirs.LOGS, file="startup.csv")
+    new_file = not os.path.exists(history_file)
+    with open(history_file, "a", newline="") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(["timestamp", "module", "total_ms"])
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        for module in MODULES:
+            try:
+                total, imports = measure(module, repeat)
+            except RuntimeError as e:
+                table.add_row(module, "-", f"[red]{e}[/red]")
+                continue
+            heaviest = sorted(imports.items(), key=lambda kv: kv[1], reverse=True)[:5]
+            table.add_row(module, f"{total / 1000:.0f}", ", ".join(f"{name} {us / 1000:.0f}" for name, us in heaviest))
+            writer.writerow([timestamp, module, f"{total / 1000:.1f}"])
+
+    Console().print(table)
+    print(f"History is appended to {history_file}")
@@ -0,0 +1,89 @@
+"""
+Micro-benchmark of the fused text normalization.
+
+Runs every rule set of `content.text_normalization` over a synthetic document the old way,
+one `re.sub` per rule, and with the compiled single-pass normalizer, checks that both give the
+same result and reports the time and throughput of each.
+"""
+import random
+import re
+import time
+
+from rich.table import Table
+from rich.console import Console
+
+from content.text_normalization import EPUB_NORMALIZER, DOC_LIKE_NORMALIZER
+
+
+def sequential_epub(content):
+    content = re.sub(r"^xml version='1\.0' encoding='utf-8'\?\s*", '', content, flags=re.MULTILINE)
+    content = re.sub(r"^!\[\]\(.*?\)\s*", '', content, flags=re.MULTILINE)
+    content = re.sub(r'^- ?', '— ', content, flags=re.MULTILINE)
+    return re.sub(r'!\[.*?\]\(.*?\)', '', content, flags=re.MULTILINE)
+
+
+def sequential_doc_like(content):
+    content = re.sub(r"^!\[\]\(.*?\)\s*", '', content, flags=re.MULTILINE)
+    content = re.sub(r'^- ?', '— ', content, flags=re.MULTILINE)
+    content = re.sub(r'!\[.*?\]\(.*?\)', '', content, flags=re.MULTILINE)
+    content = re.sub(r'<img\s+[^>]*src="[^"]+"[^>]*>', '', content)
+    return re.sub(r'dN=`?.*?</a>`?\{=html\}', '', content, flags=re.DOTALL)
+
+
+RULE_SETS = {
+    "epub": (sequential_epub, EPUB_NORMALIZER),
+    "doc-like": (sequential_doc_like, DOC_LIKE_NORMALIZER),
+}
+
+
+def synthetic_document(size_mb, seed=1552):
+    rnd = random.Random(seed)
+    words = ["китап", "бала", "мәктәп", "укучы", "язучы", "халык", "тел", "сүз", "җөмлә", "әдәбият", "ки-\nтап"]
+    blocks = [
+        lambda: " ".join(rnd.choice(words) for _ in range(rnd.randint(10, 60))) + ".",
+        lambda: "- " + " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 12))),
+        lambda: "![](images/cover.jpg)\n",
+        lambda: f"Рәсем ![схема](img/{rnd.randint(0, 999)}.png) өстендә.",
+        lambda: '<img class="x" src="media/image1.png" alt="">',
+        lambda: "xml version='1.0' encoding='utf-8'?\n",
+        lambda: '<table class="toc"><tr><td>Кереш</td><td>3</td></tr></table>',
+        lambda: '[]{#a dN=`<a href="#x">`{=html}1`</a>`{=html}',
+    ]
+    weights = [70, 10, 3, 3, 3, 1, 1, 2]
+    parts = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        block = rnd.choices(blocks, weights)[0]()
+        parts.append(block)
+        size += len(block.encode("utf-8")) + 2
+    return "\n\n".join(parts)
+
+
+def run(size_mb=10, repeat=5):
+    content = synthetic_document(size_mb)
+    table = Table(title=f"Text normalization of {size_mb} MB document, best of {repeat}")
+    for column in ["rule set", "sequential, s", "fused, s", "fused, MB/s", "speedup", "same result"]:
+        table.add_column(column)
+
+    for name, (sequential, fused) in RULE_SETS.items():
+        sequential_time, expected = _best_of(sequential, content, repeat)
+        fused_time, actual = _best_of(fused, content, repeat)
+        table.add_row(
+            name,
+            f"{sequential_time:.3f}",
+            f"{fused_time:.3f}",
+            f"{size_mb / fused_time:.1f}",
+            f"{sequential_time / fused_time:.2f}x",
+            "[green]yes[/green]" if expected == actual else "[red]no[/red]",
+        )
+    Console().print(table)
+
+
+def _best_of(fn, content, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of the work directory path resolution.
+
+Replays the calls of `get_in_workdir` made by an extraction worker for every chunk: log lines,
+the chunked results directory, the prompt dump and the slice. Runs them with the old resolution,
+which resolved the script path and created the directory on every call, and with the memoized
+one, which remembers the fixed directories and creates only the directories of documents, and
+reports the time and the count of stat and mkdir syscalls of both. The syscalls are counted by
+wrapping the `os` functions issuing them.
+"""
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from rich.table import Table
+from rich.console import Console
+
+from dirs import Dirs
+from utils import get_in_workdir, forget_workdirs, workdir
+
+# functions of `os` which are a syscall each
+COUNTED = ["stat", "lstat", "mkdir"]
+
+MD5 = "0" * 32
+
+
+def _uncached_get_in_workdir(*dir_names, file=None, prefix=workdir):
+    dir_names = [i.value if isinstance(i, Dirs) else i for i in dir_names]
+    script_parent_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+    path = [script_parent_dir, '..', os.path.expanduser(prefix), *dir_names]
+    path = os.path.normpath(os.path.join(*path))
+    os.makedirs(path, exist_ok=True)
+    if file:
+        return os.path.join(path, file)
+    else:
+        return path
+
+
+def _chunk_loop(resolve, chunks):
+    for chunk in range(chunks):
+        resolve(Dirs.LOGS, file="content_extraction_bench.log")
+        resolve(Dirs.DOC_SLICES, MD5, file=f"slice-{chunk}-{chunk + 4}.pdf")
+        resolve(Dirs.LOGS, file="content_extraction_bench.log")
+        resolve(Dirs.PROMPTS, MD5)
+        resolve(Dirs.CHUNKED_RESULTS, MD5)
+        resolve(Dirs.LOGS, file="content_extraction_bench.log")
+
+
+@contextmanager
+def _counting(counter):
+    originals = {name: getattr(os, name) for name in COUNTED}
+
+    def _wrap(name, fn):
+        def _counted(*args, **kwargs):
+            counter[name] += 1
+            return fn(*args, **kwargs)
+        return _counted
+
+    for name, fn in originals.items():
+        setattr(os, name, _wrap(name, fn))
+    try:
+        yield
+    finally:
+        for name, fn in originals.items():
+            setattr(os, name, fn)
+
+
+def run(chunks=10000):
+    table = Table(title=f"Path resolution of {chunks} chunks, {6 * chunks} calls")
+    for column in ["resolution", "time, ms", *[f"os.{name}" for name in COUNTED]]:
+        table.add_column(column)
+    for name, resolve in [("uncached", _uncached_get_in_workdir), ("memoized", get_in_workdir)]:
+        # the wrappers slow the calls down, so the time and the syscalls are measured by separate runs
+        forget_workdirs()
+        start = time.perf_counter()
+        _chunk_loop(resolve, chunks)
+        elapsed = time.perf_counter() - start
+
+        forget_workdirs()
+        counter = Counter()
+        with _counting(counter):
+            _chunk_loop(resolve, chunks)
+        table.add_row(name, f"{elapsed * 1000:.1f}", *[str(counter[name]) for name in COUNTED])
+    Console().print(table)
@@ -0,0 +1,233 @@
+"""
+Cache Module
+
+Work directories in `~/.monocorpus` keep the artifacts of every processed document: downloaded
+documents, slices, page images, clips, chunks extracted by Gemini, prompts. Nothing removes them,
+so the disk of an extraction box fills up in a few days. This module accounts the usage of these
+directories per document and evicts the artifacts which are not needed anymore:
+- artifacts are attributed to documents by the md5 their names start with
+- artifacts of documents being processed are pinned: by a worker holding `pinned(md5)`, in any
+  process, or by a task waiting in the postprocessing spool
+- chunks extracted by Gemini are evicted only after the content of the document is uploaded,
+  everything else can be downloaded or recreated again
+- the least recently used documents are evicted first, until the usage fits into the budget
+
+Functions:
+    pin(md5) / unpin(md5): Protects artifacts of the document from eviction
+    pinned(md5): Context manager pinning the document while it is processed
+    usage(): Artifacts in the managed directories with their sizes and documents
+    trim(max_size=None, older_than=None, dry_run=False): Evicts artifacts of finished documents
+    trim_to_budget(config): Trims the cache to `cache.max_size_gb` of the config, if it is set
+"""
+import os
+import re
+import shutil
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from rich import print
+
+from dirs import Dirs
+from utils import get_in_workdir, forget_workdirs, pid_alive
+
+MANAGED_DIRS = [
+    Dirs.ENTRY_POINT,
+    Dirs.DOC_SLICES,
+    Dirs.PAGE_IMAGES,
+    Dirs.CLIPS,
+    Dirs.CHUNKED_RESULTS,
+    Dirs.UPSTREAM_METADATA,
+    Dirs.PROMPTS,
+]
+
+# results of paid Gemini requests, they are kept until the content of the document is uploaded
+KEPT_UNTIL_UPLOADED = {Dirs.CHUNKED_RESULTS}
+
+# artifacts used recently may belong to a document between two pinned steps
+MIN_AGE = 60 * 60
+
+_MD5_PATTERN = re.compile(r"^([0-9a-f]{32})(?![0-9a-f])")
+
+_pins_lock = threading.Lock()
+_pins = defaultdict(int)
+
+
+@dataclass
+class Entry:
+    directory: Dirs
+    md5: str
+    path: str
+    size: int
+    last_used: float
+
+
+def pin(md5):
+    """Protect artifacts of the document from eviction, pins are counted and visible to other processes"""
+    with _pins_lock:
+        _pins[md5] += 1
+        if _pins[md5] == 1:
+            with open(_pin_file(md5), "w") as f:
+                f.write(str(os.getpid()))
+
+
+def unpin(md5):
+    with _pins_lock:
+        _pins[md5] -= 1
+        if _pins[md5] <= 0:
+            del _pins[md5]
+            try:
+                os.remove(_pin_file(md5))
+            except FileNotFoundError:
+                pass
+
+
+@contextmanager
+def pinned(md5):
+    pin(md5)
+    try:
+        yield
+    finally:
+        unpin(md5)
+
+
+def pinned_md5s():
+    """Md5s of documents pinned by the alive processes or waiting in the postprocessing spool"""
+    md5s = set()
+    pins_dir = get_in_workdir(Dirs.CACHE_PINS)
+    for name in os.listdir(pins_dir):
+        md5, _, pid = name.partition(".")
+        if pid_alive(pid):
+            md5s.add(md5)
+        else:
+            # the process crashed without unpinning
+            os.remove(os.path.join(pins_dir, name))
+    for name in os.listdir(get_in_workdir(Dirs.POSTPROCESS_QUEUE)):
+        if name.endswith(".json"):
+            md5s.add(name.removesuffix(".json"))
+    return md5s
+
+
+def usage():
+    """Top level entries of the managed directories with their sizes and the time of the last use"""
+    entries = []
+    for directory in MANAGED_DIRS:
+        with os.scandir(get_in_workdir(directory)) as it:
+            for item in it:
+                m = _MD5_PATTERN.match(item.name)
+                size, last_used = _measure(item)
+                entries.append(Entry(directory, m.group(1) if m else None, item.path, size, last_used))
+    return entries
+
+
+def trim(max_size=None, older_than=None, dry_run=False):
+    """
+    Evict artifacts of documents which are not pinned, the least recently used first.
+
+    :param max_size: evict until the managed directories take no more than this count of bytes
+    :param older_than: evict everything not used for this count of seconds
+    :param dry_run: only report what would be evicted
+    :return: evicted entries
+    """
+    entries = usage()
+    total = sum(e.size for e in entries)
+    pinned_docs = pinned_md5s()
+    now = time.time()
+    candidates = [
+        e for e in entries
+        if e.md5 and e.md5 not in pinned_docs and now - e.last_used > MIN_AGE
+    ]
+    uploaded = _uploaded_md5s({e.md5 for e in candidates if e.directory in KEPT_UNTIL_UPLOADED})
+    candidates = [e for e in candidates if e.directory not in KEPT_UNTIL_UPLOADED or e.md5 in uploaded]
+
+    # all artifacts of a document are evicted together, documents used long ago go first
+    by_md5 = defaultdict(list)
+    for e in candidates:
+        by_md5[e.md5].append(e)
+    order = sorted(by_md5.values(), key=lambda group: max(e.last_used for e in group))
+
+    evicted = []
+    for group in order:
+        last_used = max(e.last_used for e in group)
+        too_old = older_than is not None and now - last_used > older_than
+        too_big = max_size is not None and total > max_size
+        if not (too_old or too_big):
+            # the rest of documents are used even later
+            break
+        for e in group:
+            if not dry_run:
+                _remove(e.path)
+            total -= e.size
+            evicted.append(e)
+    if evicted and not dry_run:
+        # directories of evicted documents are created again on the next use
+        forget_workdirs()
+    return evicted
+
+
+def trim_to_budget(config):
+    """Trim the cache to the budget set by `cache.max_size_gb`, nothing is done if it is not set"""
+    max_size_gb = (config.get('cache') or {}).get('max_size_gb')
+    if not max_size_gb:
+        return
+    evicted = trim(max_size=int(max_size_gb * 1024 ** 3))
+    if evicted:
+        freed = sum(e.size for e in evicted)
+        print(f"Evicted {len({e.md5 for e in evicted})} documents from the cache, {freed / 1024 ** 3:.1f} GB freed")
+
+
+def _measure(item):
+    """Size of the file or the directory and the latest time its content was used"""
+    stat = item.stat(follow_symlinks=False)
+    if not item.is_dir(follow_symlinks=False):
+        return stat.st_size, max(stat.st_mtime, stat.st_atime)
+    size = 0
+    last_used = stat.st_mtime
+    for dir_name, _, files in os.walk(item.path):
+        for file in files:
+            try:
+                stat = os.stat(os.path.join(dir_name, file), follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            size += stat.st_size
+            last_used = max(last_used, stat.st_mtime, stat.st_atime)
+    return size, last_used
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _uploaded_md5s(md5s):
+    """Md5s of the documents with uploaded content, none of them if the database is not available"""
+    if not md5s:
+        return set()
+    from sqlalchemy import select
+    from models import Document, DocumentCrh
+    from utils import get_session
+
+    uploaded = set()
+    md5s = sorted(md5s)
+    try:
+        with get_session() as session:
+            for entity_cls in [Document, DocumentCrh]:
+                for idx in range(0, len(md5s), 1000):
+                    batch = md5s[idx:idx + 1000]
+                    predicate = entity_cls.md5.in_(batch) & entity_cls.content_url.is_not(None)
+                    uploaded.update(session.scalars(select(entity_cls.md5).where(predicate)))
+    except Exception as e:
+        print(f"[yellow]Could not check which documents are uploaded, their chunks are kept: {e}[/yellow]")
+        return set()
+    return uploaded
+
+
+def _pin_file(md5):
+    return get_in_workdir(Dirs.CACHE_PINS, file=f"{md5}.{os.getpid()}")
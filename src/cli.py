@@ -1,6 +1,6 @@
 import typer
 from typing_extensions import Annotated
-from typing import Optional
+from typing import List, Optional
 from dataclasses import dataclass
 import string
 
@@ -13,6 +13,8 @@ class ExtractParams:
     path: str
     batch_size: int
     workers: int
+    postprocess_workers: int
+    profile: bool = False
 
 @dataclass
 class CliParams:
@@ -88,9 +90,23 @@ def extract(
         int,
         typer.Option(
             "--workers", "-w",
-            help="Count of parallel workers to process documents. Each worker use separate Gemini API key. Cannot be more than count of available API keys.",
+            help="Count of parallel workers to process documents. For pdf each worker use separate Gemini API key and cannot be more than count of available API keys, for other documents it is the count of converting processes.",
         )
-    ] = 8):
+    ] = 8,
+    postprocess_workers: Annotated[
+        int,
+        typer.Option(
+            "--postprocess-workers",
+            help="Count of parallel processes to postprocess extracted pdf documents: figures detection, formatting and uploading.",
+        )
+    ] = 2,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            "--profile",
+            help="Run extraction and postprocessing of every pdf document under the profiler set by `profiling.profiler` in the config, reports are saved per md5 in misc/profiles",
+        )
+    ] = False):
     """
     Extract content from documents stored in Yandex Disk.
     """
@@ -99,6 +115,8 @@ def extract(
         md5=md5.strip() if md5 else None, 
         path=path.strip() if path else None,
         workers=workers,
+        postprocess_workers=postprocess_workers,
+        profile=profile,
         batch_size=batch_size if batch_size and batch_size > 0 else workers*3,
     )
     content.extract_content(cli_params)
@@ -201,3 +219,236 @@ def upload_to_s3():
             if doc.document_url != document_url:
                 doc.document_url = document_url
                 session.commit()
+
+
+bench_app = typer.Typer(help="Micro-benchmarks of the processing steps")
+app.add_typer(bench_app, name="bench")
+
+
+@bench_app.command("normalize")
+def bench_normalize(
+    size: Annotated[int, typer.Option(help="Size of the synthetic document in MB")] = 10,
+    repeat: Annotated[int, typer.Option(help="Count of runs, the best one is reported")] = 5,
+):
+    """
+    Compare the single-pass text normalization with one `re.sub` per rule
+    """
+    from bench.text_normalization import run
+    run(size_mb=size, repeat=repeat)
+
+
+@bench_app.command("boundaries")
+def bench_boundaries(
+    count: Annotated[int, typer.Option(help="Count of synthetic chunk boundaries")] = 2000,
+):
+    """
+    Compare the rule-based continuity check of extracted chunks with the spaCy sentencizer
+    """
+    from bench.sentence_boundary import run
+    run(count=count)
+
+
+@bench_app.command("startup")
+def bench_startup(
+    repeat: Annotated[int, typer.Option(help="Count of runs per module, the best one is reported")] = 3,
+):
+    """
+    Measure import time of the CLI modules with `python -X importtime`
+    """
+    from bench.startup import run
+    run(repeat=repeat)
+
+
+@bench_app.command("workdir")
+def bench_workdir(
+    chunks: Annotated[int, typer.Option(help="Count of chunks of the replayed extraction loop")] = 10000,
+):
+    """
+    Compare syscalls of the memoized work directory resolution with the uncached one
+    """
+    from bench.workdir import run
+    run(chunks=chunks)
+
+
+@bench_app.command("corpus")
+def bench_corpus(
+    output: Annotated[str, typer.Argument(help="Directory to generate the corpus into")],
+    docs: Annotated[int, typer.Option(help="Count of documents")] = 1000,
+    pages: Annotated[int, typer.Option(help="Mean count of pages of pdf documents")] = 20,
+    max_pages: Annotated[Optional[int], typer.Option(help="Limit of pages of a pdf document, ten times --pages by default")] = None,
+    seed: Annotated[int, typer.Option(help="Seed of the generator, the same seed gives the same corpus")] = 1552,
+    non_tatar: Annotated[float, typer.Option(help="Share of documents not in Tatar")] = 0.05,
+    duplicates: Annotated[float, typer.Option(help="Share of limited variants of other documents with the same ISBN")] = 0.05,
+    extracted: Annotated[float, typer.Option(help="Share of pdf documents with uploaded content")] = 0.5,
+    interrupted: Annotated[float, typer.Option(help="Share of not extracted pdf documents with extracted chunks")] = 0.1,
+    unsynced: Annotated[float, typer.Option(help="Share of documents on the disk without rows")] = 0.0,
+    files: Annotated[bool, typer.Option(help="Write the documents to the disk, rows and content only otherwise")] = True,
+):
+    """
+    Generate a synthetic corpus for scale testing: pdf, epub and docx documents on a local disk,
+    `Document` rows in SQLite, content, upstream metadata and chunks extracted by Gemini
+    """
+    from bench.corpus import run
+    run(
+        output, docs, pages=pages, max_pages=max_pages, seed=seed, non_tatar=non_tatar, duplicates=duplicates,
+        extracted=extracted, interrupted=interrupted, unsynced=unsynced, files=files,
+    )
+
+
+@bench_app.command("planner")
+def bench_planner(
+    pages: Annotated[Optional[List[int]], typer.Argument(help="Counts of pages of the documents")] = None,
+    missing: Annotated[float, typer.Option(help="Share of chunks which are not extracted yet")] = 0.1,
+):
+    """
+    Measure the chunk planning of the pdf extraction for documents of thousands of pages
+    """
+    from bench.chunk_planner import run
+    run(sizes=pages or (1000, 5000, 20000), missing=missing)
+
+
+@bench_app.command("offline")
+def bench_offline(
+    scenarios: Annotated[
+        Optional[List[str]],
+        typer.Argument(help="Pipelines to run: extract, meta, sync, hf. All of them if not provided"),
+    ] = None,
+    docs: Annotated[int, typer.Option(help="Count of synthetic documents")] = 8,
+    pages: Annotated[int, typer.Option(help="Mean count of pages of pdf documents")] = 20,
+    keys: Annotated[int, typer.Option(help="Count of fake Gemini keys, one extraction worker per key")] = 4,
+    latency: Annotated[float, typer.Option(help="Seconds before the fake Gemini starts streaming a response")] = 2.0,
+    tokens_per_second: Annotated[float, typer.Option(help="Rate of streaming of the fake Gemini")] = 500.0,
+    postprocess_workers: Annotated[int, typer.Option(help="Count of postprocessing processes of the extraction")] = 2,
+    timeout: Annotated[int, typer.Option(help="Seconds after which a scenario is killed")] = 30 * 60,
+):
+    """
+    Run the pipelines end to end against local stand-ins of Gemini, S3, Yandex.Disk and the database
+    """
+    from bench.offline import run, SCENARIOS
+    if unknown := set(scenarios or []) - set(SCENARIOS):
+        raise typer.BadParameter(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    run(scenarios or SCENARIOS, docs=docs, pages=pages, keys=keys, latency=latency, tokens_per_second=tokens_per_second, postprocess_workers=postprocess_workers, timeout=timeout)
+
+
+cache_app = typer.Typer(help="Usage and eviction of the artifacts in the work directories")
+app.add_typer(cache_app, name="cache")
+
+
+@cache_app.command("stats")
+def cache_stats(
+    top: Annotated[int, typer.Option(help="Count of the largest documents to show")] = 10,
+):
+    """
+    Show disk usage of the work directories per directory and the largest documents
+    """
+    from collections import defaultdict
+    from rich.console import Console
+    from rich.table import Table
+    import cache
+
+    entries = cache.usage()
+    pinned_md5s = cache.pinned_md5s()
+    by_dir = defaultdict(lambda: [0, set()])
+    by_md5 = defaultdict(int)
+    for e in entries:
+        by_dir[e.directory][0] += e.size
+        by_dir[e.directory][1].add(e.md5)
+        by_md5[e.md5] += e.size
+
+    table = Table(title="Work directories")
+    for column in ["directory", "size, MB", "documents"]:
+        table.add_column(column)
+    for directory in cache.MANAGED_DIRS:
+        size, md5s = by_dir[directory]
+        table.add_row(directory.value, f"{size / 1024 ** 2:.1f}", str(len(md5s - {None})))
+    table.add_row("total", f"{sum(by_md5.values()) / 1024 ** 2:.1f}", str(len(set(by_md5) - {None})))
+    Console().print(table)
+
+    table = Table(title=f"Largest {top} documents")
+    for column in ["md5", "size, MB", "pinned"]:
+        table.add_column(column)
+    for md5, size in sorted(by_md5.items(), key=lambda kv: kv[1], reverse=True)[:top]:
+        table.add_row(md5 or "(not attributed)", f"{size / 1024 ** 2:.1f}", "yes" if md5 in pinned_md5s else "")
+    Console().print(table)
+
+
+@cache_app.command("trim")
+def cache_trim(
+    max_size: Annotated[
+        Optional[float],
+        typer.Option("--max-size", help="Budget of the work directories in GB, `cache.max_size_gb` of the config by default"),
+    ] = None,
+    older_than: Annotated[
+        Optional[float],
+        typer.Option("--older-than", help="Evict documents not used for this count of days"),
+    ] = None,
+    dry_run: Annotated[bool, typer.Option("--dry-run", help="Only show what would be evicted")] = False,
+):
+    """
+    Evict artifacts of documents which are not processed right now, the least recently used first.
+    Chunks extracted by Gemini are evicted only for documents with uploaded content.
+    """
+    from utils import read_config
+    import cache
+
+    if max_size is None and older_than is None:
+        max_size = (read_config().get('cache') or {}).get('max_size_gb')
+        if not max_size:
+            raise typer.BadParameter("Neither --max-size nor --older-than is given and `cache.max_size_gb` is not set")
+    evicted = cache.trim(
+        max_size=int(max_size * 1024 ** 3) if max_size is not None else None,
+        older_than=older_than * 24 * 60 * 60 if older_than is not None else None,
+        dry_run=dry_run,
+    )
+    freed = sum(e.size for e in evicted)
+    action = "Would evict" if dry_run else "Evicted"
+    print(f"{action} {len({e.md5 for e in evicted})} documents, {freed / 1024 ** 3:.2f} GB")
+
+
+jobs_app = typer.Typer(help="Jobs of the pipelines in the database")
+app.add_typer(jobs_app, name="jobs")
+
+
+@jobs_app.command("stats")
+def jobs_stats():
+    """
+    Show counts of the jobs per pipeline and status
+    """
+    from rich.console import Console
+    from rich.table import Table
+    from sqlalchemy import func, select
+    from models import Job
+    from utils import get_session
+
+    with get_session() as session:
+        rows = session.execute(
+            select(Job.pipeline, Job.status, func.count(), func.max(Job.attempts))
+            .group_by(Job.pipeline, Job.status)
+            .order_by(Job.pipeline, Job.status)
+        ).all()
+    table = Table(title="Jobs")
+    for column in ["pipeline", "status", "jobs", "max attempts"]:
+        table.add_column(column)
+    for pipeline, status, count, attempts in rows:
+        table.add_row(pipeline, status, str(count), str(attempts))
+    Console().print(table)
+
+
+@jobs_app.command("retry")
+def jobs_retry(
+    pipeline: Annotated[str, typer.Option(help="Pipeline of the jobs: content_tt, content_crh or metadata")] = "content_tt",
+    status: Annotated[
+        Optional[List[str]],
+        typer.Option("--status", help="Statuses of the jobs to retry, can be repeated. `failed` by default"),
+    ] = None,
+):
+    """
+    Make jobs pending again with no failed attempts, e.g. after a fix of the extraction
+    """
+    from utils import read_config
+    import jobs
+
+    queue = jobs.JobQueue(pipeline, read_config())
+    md5s = queue.md5s(*(status or [jobs.FAILED]))
+    queue.enqueue(md5s, reset=True)
+    print(f"{len(md5s)} jobs of {pipeline} are pending again")
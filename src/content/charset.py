@@ -0,0 +1,90 @@
+"""
+Charset Module
+
+Normalizes the encoding of text documents to UTF-8 before pandoc reads them. The encoding is
+detected incrementally on a bounded prefix of the file, and the file is re-encoded chunk by
+chunk, so the memory does not depend on the size of the document. A prefix detected as ASCII
+or UTF-8 says nothing about the rest of the file, so the whole file is checked to be valid UTF-8,
+and the detector is fed again from the first invalid chunk if it is not.
+
+The downloaded document is left untouched, the re-encoded copy is stored next to it in
+`Dirs.ENTRY_POINT` and reused by the following runs. This keeps the md5 check of the downloaded
+document in `download_file_locally` valid.
+
+Functions:
+    to_utf8(path, md5): Returns the path to the UTF-8 version of the document
+"""
+import codecs
+import os
+
+from chardet import UniversalDetector
+from rich import print
+
+from dirs import Dirs
+from utils import get_in_workdir
+
+# the detector usually settles within the first kilobytes, it is never fed more than this
+SAMPLE_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# encodings which need no conversion
+UTF8_COMPATIBLE = {'utf-8', 'ascii'}
+
+
+def to_utf8(path, md5):
+    _, ext = os.path.splitext(path)
+    # the extension stays the last one, pandoc deduces the input format from it
+    utf8_path = get_in_workdir(Dirs.ENTRY_POINT, file=f"{md5}.utf-8{ext}")
+    if os.path.exists(utf8_path):
+        return utf8_path
+
+    encoding = _detect_encoding(path)
+    if not encoding or encoding.lower() in UTF8_COMPATIBLE:
+        invalid_at = _find_invalid_utf8(path)
+        if invalid_at is None:
+            return path
+        # e.g. cp1251 text after a long ASCII prefix, ASCII is a subset of all the candidates
+        encoding = _detect_encoding(path, invalid_at)
+        if not encoding or encoding.lower() in UTF8_COMPATIBLE:
+            encoding = 'utf-8'
+
+    print(f"Converting {path} from {encoding} to UTF-8...")
+    # the encoding is guessed from the prefix only, a rare byte it can not decode must not fail the document
+    with open(path, 'r', encoding=encoding, errors='replace', newline='') as src, \
+            open(f"{utf8_path}.part", 'w', encoding='utf-8', newline='') as dst:
+        while chunk := src.read(CHUNK_SIZE):
+            dst.write(chunk)
+    os.replace(f"{utf8_path}.part", utf8_path)
+    return utf8_path
+
+
+def _detect_encoding(path, offset=0):
+    detector = UniversalDetector()
+    fed = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while fed < SAMPLE_SIZE and (chunk := f.read(CHUNK_SIZE)):
+            detector.feed(chunk)
+            fed += len(chunk)
+            if detector.done:
+                break
+    detector.close()
+    return detector.result['encoding']
+
+
+def _find_invalid_utf8(path):
+    """Offset of the first chunk of the file which is not valid UTF-8, None if the whole file is"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    offset = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            try:
+                decoder.decode(chunk)
+            except UnicodeDecodeError:
+                return offset
+            offset += len(chunk)
+    try:
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return max(offset - CHUNK_SIZE, 0)
+    return None
@@ -1,9 +1,24 @@
-import re
+"""
+Continuity Checker Module
+
+Decides how a chunk of content extracted by Gemini is glued to the previous one: whether the
+sentence broken by the chunk boundary continues, or the new chunk starts a new paragraph.
 
-from spacy.lang.tt import Tatar
+The sentences are found by a rule-based segmenter reproducing the spaCy sentencizer: a token
+from `SENTENCE_END` followed by a token that is not punctuation starts a new sentence. The
+tokenization follows the spaCy Tatar tokenizer: its prefixes, suffixes and infixes, e.g. `?` and
+`!` between letters, and its special cases with periods, like `млн.`. URLs are not matched, they
+rarely end a sentence. So the segmenter needs neither spaCy nor its startup time, the agreement
+with spaCy is checked by `tests/test_continuity_checker.py`. The spaCy pipeline is still
+available as a segmenter, it is loaded lazily on the first use.
 
-nlp = Tatar()
-nlp.add_pipe('sentencizer')
+Functions:
+    continue_smoothly(prev_chunk_tail, content, segmenter="rules"): Glues the chunk to the previous one
+    sentences(text, segmenter="rules"): Character spans of the sentences of the text
+"""
+import re
+import unicodedata
+from functools import lru_cache
 
 HEADER_PATTERNS = [
     r'^\s*<\s*/?\s*\w+',                    # HTML tag
@@ -12,10 +27,83 @@ HEADER_PATTERNS = [
     r'^[IVXLCDM]+\.\s+[A-ZА-ЯӘӨҮҢҖҺЁ]',     # Roman numeral sections like "IV. Results"
 ]
 
-def continue_smoothly(prev_chunk_tail, content):
+# default punctuation of the spaCy sentencizer which occurs in Cyrillic and Latin texts
+SENTENCE_END = {'.', '!', '?', '‼', '‽', '⁇', '⁈', '⁉', '﹒', '﹖', '﹗', '！', '．', '？'}
+
+# chunks of text between whitespaces, and whitespaces
+_CHUNK_PATTERN = re.compile(r"\S+|\s+")
+_ALPHA = r"[^\W\d_]"
+# letters of the Latin, Cyrillic and Tatar alphabets
+_LOWER = "a-zß-öø-ÿа-яёәөүҗңһğşı"
+_UPPER = "A-ZÀ-ÖØ-ÞА-ЯЁӘӨҮҖҢҺĞŞİ"
+_QUOTES = "\\'\"”“`‘´’‚,„»«「」『』（）〔〕【】《》〈〉〈〉⟦⟧"
+_PUNCT = ",:;!?¿؟¡()\\[\\]{}<>_#*&。？！，、；：～·।،۔؛٪"
+_CURRENCY = "$£€¥฿₽﷼₠-₿"
+_UNITS = (
+    "km|km²|km³|m|m²|m³|dm|dm²|dm³|cm|cm²|cm³|mm|mm²|mm³|ha|µm|nm|yd|in|ft|kg|g|mg|µg|t|lb|oz|m/s|km/h|kmh|mph|hPa|Pa|mbar|mb|MB|kb|KB|gb|GB|tb|TB|T|G|M|K|%"
+    "|км|км²|км³|м|м²|м³|дм|дм²|дм³|см|см²|см³|мм|мм²|мм³|нм|кг|г|мг|м/с|км/ч|кПа|Па|мбар|Кб|КБ|кб|Мб|МБ|мб|Гб|ГБ|гб|Тб|ТБ|тб"
+)
+
+# prefixes, suffixes and infixes of the spaCy Tatar tokenizer in the same order, icons are
+# recognized by their unicode category instead of the list of spaCy
+_PREFIX_PATTERN = re.compile("|".join([
+    r"^[§%=—–]",
+    r"^\+(?![0-9])",
+    rf"^(?:…|……|[{_PUNCT}])",
+    r"^\.\.+",
+    r"^…",
+    rf"^[{_QUOTES}]",
+    rf"^(?:[{_CURRENCY}]|US\$|C\$|A\$)",
+]))
+_SUFFIX_PATTERN = re.compile("|".join([
+    rf"(?:…|……|[{_PUNCT}])$",
+    r"\.\.+$",
+    r"…$",
+    rf"[{_QUOTES}]$",
+    r"(?:'s|'S|’s|’S|—|–)$",
+    r"(?<=[0-9])\+$",
+    r"(?<=°[FfCcKk])\.$",
+    rf"(?<=[0-9])(?:[{_CURRENCY}]|US\$|C\$|A\$)$",
+    rf"(?<=[0-9])(?:{_UNITS})$",
+    rf"(?<=[0-9{_LOWER}%²\-\+…|{_PUNCT}{_QUOTES}])\.$",
+    rf"(?<=[{_UPPER}][{_UPPER}])\.$",
+]))
+_INFIX_PATTERN = re.compile("|".join([
+    r"\.\.+",
+    r"…",
+    rf"(?<=[{_LOWER}])\.(?=[{_UPPER}])",
+    rf"(?<={_ALPHA})[,!?/()]+(?={_ALPHA})",
+    rf"(?<={_ALPHA}|[{_QUOTES}])[:<>=](?={_ALPHA})",
+    rf"(?<={_ALPHA})--(?={_ALPHA})",
+    rf"(?<={_ALPHA}),(?={_ALPHA})",
+    rf"(?<={_ALPHA})([{_QUOTES}\)\]\(\[])(?=[\-]|{_ALPHA})",
+    rf"(?<={_ALPHA})(?:–|—|——|~)(?={_ALPHA})",
+    r"(?<=[0-9])-(?=[0-9])",
+]))
+
+# tokenizer exceptions of spaCy which contain a period: abbreviations are not sentence ends
+_ABBREVIATIONS = [
+    "дш", "сш", "чш", "пш", "җм", "шб", "яш", "гый", "фев", "мар", "апр",
+    "июн", "июл", "авг", "сен", "окт", "ноя", "дек", "млрд", "млн",
+]
+_SPECIAL_CASES = (
+    {f"{form}." for abbr in _ABBREVIATIONS for form in (abbr, abbr.capitalize(), abbr.upper())}
+    | {"һ.б.ш.", "һ.б.", "б.э.к.", "б.э."}
+    | {f"{char}." for char in "abcdefghijklmnopqrstuvwxyzäöü"}
+    | {f"°{unit}." for unit in "CFKcfk"}
+)
+# "һ.б.ш." is split into 6 tokens
+_MAX_SPECIAL_TOKENS = 6
+
+def continue_smoothly(prev_chunk_tail, content, segmenter="rules"):
     """
-    Check if two paragraphs are the same
-    return: True if paragraphs are the same, False otherwise
+    Glue the chunk to the previous one.
+
+    :param prev_chunk_tail: the end of the previous chunk
+    :param content: the chunk
+    :param segmenter: 'rules' or 'spacy'
+    :return: the chunk prefixed with a space if it continues the last sentence of the previous chunk,
+             with a paragraph break otherwise
     """
     content_head = content[:300]
     if not content_head:
@@ -24,12 +112,11 @@ def continue_smoothly(prev_chunk_tail, content):
         if re.match(pattern, content_head):
             return '\n\n' + content
 
-    nlp_prev = nlp(prev_chunk_tail)
-    nlp_new = nlp(content_head)
-    last_sent = list(nlp_prev.sents)[-1].text
-    first_sent = list(nlp_new.sents)[0].text
-    nlp_merged = nlp(last_sent + first_sent)
-    same_paragraph = len(list(nlp_merged.sents)) == 1
+    start, end = sentences(prev_chunk_tail, segmenter)[-1]
+    last_sent = prev_chunk_tail[start:end]
+    start, end = sentences(content_head, segmenter)[0]
+    first_sent = content_head[start:end]
+    same_paragraph = len(sentences(last_sent + first_sent, segmenter)) == 1
     if same_paragraph:
         if prev_chunk_tail.endswith('-'):
             return content
@@ -37,4 +124,137 @@ def continue_smoothly(prev_chunk_tail, content):
             return ' ' + content
     else:
         return '\n\n' + content
-        
\ No newline at end of file
+
+
+def sentences(text, segmenter="rules"):
+    if segmenter == "spacy":
+        return [(s.start_char, s.end_char) for s in _spacy_nlp()(text).sents]
+
+    tokens = _tokenize(text)
+    if not tokens:
+        return []
+    # the same loop as in `spacy.pipeline.Sentencizer.predict`
+    starts = [0]
+    seen_period = False
+    for idx, (token_start, token_end) in enumerate(tokens):
+        token = text[token_start:token_end]
+        is_sentence_end = token in SENTENCE_END
+        if seen_period and not is_sentence_end and not _is_punct(token):
+            starts.append(idx)
+            seen_period = False
+        elif is_sentence_end:
+            seen_period = True
+
+    spans = []
+    for num, first in enumerate(starts):
+        last = (starts[num + 1] if num + 1 < len(starts) else len(tokens)) - 1
+        spans.append((tokens[first][0], tokens[last][1]))
+    return spans
+
+
+def _tokenize(text):
+    """Character spans of the tokens, the same as spaCy would produce as far as punctuation is concerned"""
+    tokens = []
+    for m in _CHUNK_PATTERN.finditer(text):
+        start, end = m.span()
+        if not text[start].isspace():
+            tokens.extend(_split_chunk(text, start, end))
+            continue
+        # a single space after a token belongs to the token, the rest of the whitespace is a token of its own
+        if start > 0 and text[start] == ' ':
+            start += 1
+        if start < end:
+            tokens.append((start, end))
+    return tokens
+
+
+def _split_chunk(text, start, end):
+    """The same as `spacy.Tokenizer._split_affixes` followed by `_attach_tokens`, without the URL matching"""
+    if text[start:end].isalnum() or text[start:end] in _SPECIAL_CASES:
+        return [(start, end)]
+    prefixes = []
+    suffixes = []
+    last_size = 0
+    while start < end and end - start != last_size:
+        if text[start:end] in _SPECIAL_CASES:
+            break
+        last_size = end - start
+        pre_len = _affix_length(_PREFIX_PATTERN, text[start:end])
+        if pre_len and text[start + pre_len:end] in _SPECIAL_CASES:
+            prefixes.append((start, start + pre_len))
+            start += pre_len
+            break
+        suf_len = _affix_length(_SUFFIX_PATTERN, text[start + pre_len:end])
+        if suf_len and text[start:end - suf_len] in _SPECIAL_CASES:
+            suffixes.append((end - suf_len, end))
+            end -= suf_len
+            break
+        if pre_len and suf_len and pre_len + suf_len <= end - start:
+            prefixes.append((start, start + pre_len))
+            suffixes.append((end - suf_len, end))
+            start += pre_len
+            end -= suf_len
+        elif pre_len:
+            prefixes.append((start, start + pre_len))
+            start += pre_len
+        elif suf_len:
+            suffixes.append((end - suf_len, end))
+            end -= suf_len
+
+    if start < end and text[start:end] in _SPECIAL_CASES:
+        middle = [(start, end)]
+    else:
+        middle = _infixes(text, start, end)
+    return _merge_special_cases(text, prefixes + middle + suffixes[::-1])
+
+
+def _merge_special_cases(text, tokens):
+    """The same as `spacy.Tokenizer._retokenize_special_spans`: split special cases are merged back, the longest first"""
+    merged = []
+    idx = 0
+    while idx < len(tokens):
+        last = idx
+        for candidate in range(min(len(tokens), idx + _MAX_SPECIAL_TOKENS) - 1, idx, -1):
+            if text[tokens[idx][0]:tokens[candidate][1]] in _SPECIAL_CASES:
+                last = candidate
+                break
+        merged.append((tokens[idx][0], tokens[last][1]))
+        idx = last + 1
+    return merged
+
+
+def _affix_length(pattern, chunk):
+    if not chunk:
+        return 0
+    if m := pattern.search(chunk):
+        return m.end() - m.start()
+    # icons
+    char = chunk[0] if pattern is _PREFIX_PATTERN else chunk[-1]
+    return 1 if unicodedata.category(char) == 'So' else 0
+
+
+def _infixes(text, start, end):
+    """The same as `spacy.Tokenizer._attach_tokens`: an infix at the start of the chunk is not split off"""
+    spans = []
+    cursor = start
+    for m in _INFIX_PATTERN.finditer(text, start, end):
+        if m.start() == start:
+            continue
+        spans.append((cursor, m.start()))
+        spans.append(m.span())
+        cursor = m.end()
+    spans.append((cursor, end))
+    return [t for t in spans if t[0] < t[1]]
+
+
+def _is_punct(token):
+    return all(unicodedata.category(char).startswith('P') for char in token)
+
+
+@lru_cache(maxsize=None)
+def _spacy_nlp():
+    from spacy.lang.tt import Tatar
+
+    nlp = Tatar()
+    nlp.add_pipe('sentencizer')
+    return nlp
@@ -18,26 +18,28 @@ Key Components:
    - Google Cloud authentication for additional processing
 
 3. Parallel Processing
+   - Pipeline of download, convert, format and upload stages for EPUB and Office documents
    - Multi-threaded extraction for PDFs
+   - Separate process pool for postprocessing of extracted PDFs
    - API key rotation and rate limit handling
-   - Queue-based task distribution
+   - Leased jobs claimed from the database, so several processes and hosts can share the work
 
 4. State Management
-   - Tracking of unprocessable documents
-   - Management of rate-limited API keys
-   - Persistent state for interrupted operations
+   - Job of every PDF in the `job` table: pending, running, done, failed or repairable
+   - Retries of failed attempts with a delay, up to a maximum count of attempts
+   - Rate-limited API keys per quota period in the database
+   - Jobs of crashed workers are claimed again once their leases expire
 
 Classes:
-    Channel: Manages shared state and persistence for document processing
+    Channel: Records outcomes of the documents and rate-limited API keys
+        - Completes, retries, returns or fails jobs of the documents
         - Tracks API key usage and rate limits
-        - Maintains lists of unprocessable/repairable documents
         - Handles thread-safe state updates
 
 Functions:
     extract_content(cli_params): Main entry point for content extraction
     _process_non_pdf(cli_params): Handles extraction from EPUB and Office documents
     _process_pdf(cli_params): Orchestrates parallel PDF content extraction
-    _upload_artifacts_to_s3(...): Handles upload of processed content to S3
     _get_credentials(): Manages Google Cloud authentication
 
 Configuration:
@@ -50,8 +52,8 @@ Configuration:
 Error Handling:
     - Graceful shutdown on interruption
     - API rate limit management
-    - Document processing failure tracking
-    - State persistence for recovery
+    - Document processing failure tracking with the error of the last attempt
+    - Durable job state for recovery
 
 Usage:
     The module is typically invoked through CLI commands that specify:
@@ -60,24 +62,21 @@ Usage:
     - Processing limits and filters
 """
 from yadisk_client import YaDisk
-import mdformat
-from dirs import Dirs
 from rich import print
-from s3 import upload_file, create_session
+from s3 import create_session
 import os
-import zipfile
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from queue import Queue
-from utils import read_config, obtain_documents, download_file_locally, get_in_workdir, encrypt, load_expired_keys, dump_expired_keys, get_session
-from .epub_extractor import EpubExtractor
-from .doc_like_extractor import DocLikeExtractor, to_docx_mime_types, check_encoding_mime_types
+from queue import Queue, Empty
+from sqlalchemy import select
+from utils import read_config, obtain_documents, get_session
+from jobs import JobQueue, exhausted_keys, add_exhausted_keys, FAILED, REPAIRABLE
+from .doc_like_extractor import to_docx_mime_types, check_encoding_mime_types
 import threading
 import time
-from .pdf_extractor import PdfExtractor
+from .non_pdf_pipeline import NonPdfPipeline
 import random
 from models import Document, DocumentCrh
-from rich.progress import track
+from cache import trim_to_budget
+from metrics import serve as serve_metrics, watch_queue
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
@@ -106,6 +105,8 @@ def _process_non_pdf(cli_params, lang_tag):
         entity_cls.mime_type.in_(non_pdf_format_types)
     )
     config = read_config()
+    serve_metrics(config)
+    trim_to_budget(config)
     s3client = create_session(config)
     with YaDisk(config['yandex']['disk']['oauth_token'], proxy=config['proxy']) as ya_client:
         with get_session() as session:
@@ -116,54 +117,16 @@ def _process_non_pdf(cli_params, lang_tag):
         
         print(f"Got {len(docs)} docs for content extraction")
         
+        # skip csv for now
+        docs = [d for d in docs if not (d.mime_type == 'text/csv' or d.ya_path.endswith('.csv'))]
         gcloud_creds = _get_credentials()
-        for doc in track(docs, description="Processing documents..."):
-            # skip csv for now
-            if doc.mime_type == 'text/csv' or doc.ya_path.endswith('.csv'):
-                continue
-            print(f"Extracting content from file {doc.md5}({doc.ya_public_url})")
-            local_doc_path = download_file_locally(ya_client, doc, config)
-            try:
-                if doc.mime_type == 'application/epub+zip':
-                    content = EpubExtractor(doc, local_doc_path, config, s3client).extract()
-                else:
-                    content = DocLikeExtractor(doc, local_doc_path, config, s3client, gcloud_creds).extract()
-                
-                formatted_content = mdformat.text(
-                    content,
-                    codeformatters=(),
-                    extensions=["toc", "footnote"],
-                    options={"wrap": "keep", "number": "keep", "validate": True, "end_of_line": "lf"},
-                )
-                formatted_response_md = get_in_workdir(Dirs.CONTENT, file=f"{doc.md5}-formatted.md")
-                with open(formatted_response_md, 'w') as f:
-                    f.write(formatted_content)
-                    
-                _upload_artifacts_to_s3(doc, formatted_response_md, local_doc_path, config, s3client)
-
-                with get_session() as session:
-                    session.merge(doc)
-                    session.commit()
-            except Exception as e:
-                print(f"[red]Failed to extract content from file {doc.md5}({doc.ya_public_url}): {e}[/red]")
-                continue
-            
-            
-def _upload_artifacts_to_s3(doc, formatted_response_md, local_doc_path, config, s3lient):        
-    content_key = f"{doc.md5}.zip"
-    content_bucket = config["yandex"]["cloud"]['bucket']['content']
-    local_content_path = get_in_workdir(Dirs.CONTENT, file=f"{doc.md5}.zip")
-    with zipfile.ZipFile(local_content_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-        zf.write(arcname=f"{doc.md5}.md", filename=formatted_response_md)
-    doc.content_url = upload_file(local_content_path, content_bucket, content_key, s3lient)
-    
-    doc_bucket = config["yandex"]["cloud"]['bucket']['document']
-    doc_key = os.path.basename(local_doc_path)
-    remote_doc_url = upload_file(local_doc_path, doc_bucket, doc_key, s3lient, skip_if_exists=True)
-    doc.document_url = encrypt(remote_doc_url, config) if doc.sharing_restricted else remote_doc_url
+        NonPdfPipeline(config, ya_client, s3client, gcloud_creds, workers=cli_params.workers).run(docs)
 
 
 def _get_credentials():
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     token_file = "personal_token.json"
     
     if os.path.exists(token_file):
@@ -176,79 +139,94 @@ def _get_credentials():
     return Credentials.from_authorized_user_file(token_file, SCOPES)
 
 class Channel:
+    """
+    Outcomes of the documents and exhausted API keys, shared by the workers of every process and
+    host through the database
+    """
     
-    def __init__(self):
+    def __init__(self, jobs, keys):
+        self.jobs = jobs
+        self.keys = keys
         self.lock = threading.Lock()
-        self.exceeded_keys_set = load_expired_keys()
-        self.unprocessable_docs, self.repairable_docs = self._load_unprocessable_docs()
-        
-    def get_all_unprocessable_docs(self):
-        return self.unprocessable_docs | self.repairable_docs
-    
-    def dump(self):
-        dump_expired_keys(self.exceeded_keys_set)
-        self._dump_to_file("unprocessables", "unprocessables.txt", self.unprocessable_docs)
-        self._dump_to_file("unprocessables", "repairables.txt", self.repairable_docs)
-            
-
-    def _load_unprocessable_docs(self, dir = "unprocessables"):
-        return self._load_file(dir, "unprocessables.txt"), self._load_file(dir, "repairables.txt")
-    
-    
-    def _load_file(self, dir, file_name):
-        file = os.path.join(dir, file_name)
-        if os.path.exists(file):
-            with open(file, "r") as f:
-                return set([l.strip() for l in f.readlines()])
-        else: 
-            return set()
+        self.reload()
         
-        
-    def _dump_to_file(self, dir, file_name, items):
-        os.makedirs(dir, exist_ok=True)
-        file = os.path.join(dir, file_name)
-        with open(file, "w") as f:
-            f.write("\n".join([l.strip() for l in items]))
-            
+    def reload(self):
+        with self.lock:
+            self.exceeded_keys_set = exhausted_keys(self.keys)
     
     def add_exceeded_key(self, key):
         with self.lock:
             self.exceeded_keys_set.add(key)
-            dump_expired_keys(self.exceeded_keys_set)
-    
-            
-    def add_unprocessable_doc(self, md5):
-        with self.lock:
-            self.unprocessable_docs.add(md5)
-            self._dump_to_file("unprocessables", "unprocessables.txt", self.unprocessable_docs)
+        add_exhausted_keys([key])
             
+    def add_unprocessable_doc(self, md5, error=None):
+        self.jobs.fail(md5, error)
     
-    def add_repairable_doc(self, md5):
-        with self.lock:
-            self.repairable_docs.add(md5)
-            self._dump_to_file("unprocessables", "repairables.txt", self.repairable_docs)
+    def add_repairable_doc(self, md5, error=None):
+        self.jobs.fail(md5, error, repairable=True)
+        
+    def retry_doc(self, md5, error=None):
+        """The attempt failed, the document is retried later by any worker"""
+        self.jobs.release(md5, error=error, attempt=True)
+        
+    def return_doc(self, md5):
+        """The document was not processed through no fault of its own, e.g. the key is exhausted"""
+        self.jobs.release(md5)
+        
+    def complete_doc(self, md5):
+        self.jobs.complete(md5)
+
+
+def _import_legacy_state(jobs, dir="unprocessables"):
+    """Unprocessable and repairable documents recorded in files by the runs before the jobs table"""
+    for file_name, status in [("unprocessables.txt", FAILED), ("repairables.txt", REPAIRABLE)]:
+        jobs.import_file(os.path.join(dir, file_name), status)
 
     
 def _process_pdf(cli_params, lang_tag):
+    # Gemini, pymupdf and the figure detection are imported only when pdf documents are processed
+    from .pdf_extractor import PdfExtractor, fetch_doc
+    from .postprocess_queue import PostprocessQueue
+    from prefetch import Prefetcher
+
     config = read_config()
+    if cli_params.profile:
+        # the config is passed to the extraction threads and postprocessing processes
+        config.setdefault('profiling', {})['enabled'] = True
+    serve_metrics(config)
     stop_event = threading.Event()
     print("Extracting content of pdf documents")
     entity_cls = Document if lang_tag == 'tt' else DocumentCrh
+    # a run of one language must not claim the jobs of documents of the other one
+    jobs = JobQueue(f"content_{lang_tag}", config)
+    _import_legacy_state(jobs)
+    channel = Channel(jobs, config["gemini_api_keys"])
+    postprocess_queue = PostprocessQueue(config, lang_tag, channel, workers=cli_params.postprocess_workers)
+    postprocess_queue.resume()
+    # the spooled tasks of the previous run of this host are finished by this run
+    jobs.adopt(postprocess_queue.pending())
+    watch_queue("postprocess", lambda: len(postprocess_queue.pending()))
+    
+    predicate = (
+        entity_cls.content_url.is_(None) &
+        (entity_cls.mime_type ==  "application/pdf") &
+        (entity_cls.language == ("tt-Cyrl" if lang_tag == 'tt' else 'crh-Cyrl')) &
+        (entity_cls.full == True)
+    )
+    selected = None
+    if cli_params.md5 or cli_params.path:
+        with YaDisk(config['yandex']['disk']['oauth_token'], proxy=config['proxy']) as ya_client, get_session() as session:
+            selected = [doc.md5 for doc in obtain_documents(cli_params, ya_client, entity_cls=entity_cls, predicate=predicate, session=session)]
+        # explicitly requested documents are extracted even if they failed before
+        jobs.enqueue(selected, reset=True)
     
     while not stop_event.is_set():
         tasks_queue = None
         threads = None
+        prefetcher = None
         
-        channel = Channel()
-        predicate = (
-            entity_cls.content_url.is_(None) &
-            (entity_cls.mime_type ==  "application/pdf") &
-            (entity_cls.language == ("tt-Cyrl" if lang_tag == 'tt' else 'crh-Cyrl')) &
-            (entity_cls.full == True) & 
-            (
-                (entity_cls.md5 == cli_params.md5) if cli_params.md5 else entity_cls.md5.not_in(channel.get_all_unprocessable_docs())
-            )
-        )
+        channel.reload()
+        trim_to_budget(config)
         
         try:
             available_keys =  list(set(config["gemini_api_keys"]) - channel.exceeded_keys_set)
@@ -256,35 +234,51 @@ def _process_pdf(cli_params, lang_tag):
             keys_slice = available_keys[:cli_params.workers]
             if not keys_slice:
                 print("No keys available, exiting...")
-                return
+                break
             else:
                 print(f"Available keys: {available_keys}, Total keys: {config['gemini_api_keys']}, Exceeded keys: {channel.exceeded_keys_set}, Extracting with keys: {keys_slice}")
             
-            with YaDisk(config['yandex']['disk']['oauth_token'], proxy=config['proxy']) as ya_client:
-                with get_session() as session:
-                    docs = list(obtain_documents(cli_params, ya_client, entity_cls=entity_cls, predicate=predicate, limit=cli_params.batch_size, session=session))
-                    
-                if not docs:
+            if selected is None:
+                # documents synced since the previous batch get their jobs
+                jobs.enqueue(select(entity_cls.md5).where(predicate))
+            claimed = jobs.claim(cli_params.batch_size, md5s=selected)
+            if not claimed:
+                if (due := jobs.next_due(selected)) is None:
                     print("No docs for processing, exiting...")
-                    return
-
-                print(f"Got {len(docs)} docs for content extraction")
-                tasks_queue = Queue(maxsize=len(docs))
-                for doc in docs:
-                    tasks_queue.put(doc)
-                    
-                if tasks_queue.empty():
-                    print("No documents for processing...")
-                    return
+                    break
+                print(f"Waiting {due:.0f}s for documents to retry...")
+                time.sleep(min(due, 60))
+                continue
+            
+            with get_session() as session:
+                docs = list(session.scalars(select(entity_cls).where(entity_cls.md5.in_(claimed) & predicate)))
+                existing = set(session.scalars(select(entity_cls.md5).where(entity_cls.md5.in_(claimed))))
+            for md5 in set(claimed) - {doc.md5 for doc in docs}:
+                if md5 in existing:
+                    # the document was extracted meanwhile or does not need extraction anymore
+                    channel.complete_doc(md5)
                 else:
-                    print(f"Got {tasks_queue.qsize()} docs in tasks queue")
-                
+                    channel.add_unprocessable_doc(md5, error=f"Document is not found in {entity_cls.__tablename__}")
+            if not docs:
+                continue
+
+            print(f"Claimed {len(docs)} docs for content extraction")
+            # the claimed documents are handed out to the workers of this process
+            tasks_queue = Queue(maxsize=len(docs))
+            for doc in docs:
+                tasks_queue.put(doc)
+            watch_queue("content_tasks", tasks_queue.qsize)
+            
+            with YaDisk(config['yandex']['disk']['oauth_token'], proxy=config['proxy']) as ya_client:
                 s3lient = create_session(config)
+                # the next documents are downloaded and sliced while the workers are busy with the current ones
+                prefetch_depth = (config.get('downloads') or {}).get('prefetch', 2)
+                prefetcher = Prefetcher(tasks_queue, lambda doc: fetch_doc(ya_client, doc, config), depth=prefetch_depth)
                     
                 threads = []
                 for num in range(min(len(keys_slice), len(docs))):
                     key = keys_slice[num]
-                    t = threading.Thread(target=PdfExtractor(key, tasks_queue, config, s3lient, ya_client, channel, stop_event, lang_tag=lang_tag))
+                    t = threading.Thread(target=PdfExtractor(key, tasks_queue, postprocess_queue, config, s3lient, ya_client, channel, stop_event, lang_tag=lang_tag, prefetcher=prefetcher))
                     t.start()
                     threads.append(t)
                     time.sleep(5)  # slight delay to avoid overwhelming the API with requests
@@ -292,15 +286,34 @@ def _process_pdf(cli_params, lang_tag):
             # waiting for workers shutdown gracefully
             for t in threads:
                 t.join()
-                
-            channel.dump()
+            prefetcher.close()
+            # workers stop before the queue is empty when their keys are exhausted
+            _return_unprocessed(tasks_queue, channel)
         except KeyboardInterrupt:
             print("Interrupted, shutting down workers...")
             stop_event.set()
             if tasks_queue:
                 tasks_queue.queue.clear()  # Clear the queue to stop workers
+            if prefetcher:
+                prefetcher.close()
             if threads:
                 for t in threads:
                     t.join(timeout=60*10)
-            channel.dump()
-            return
\ No newline at end of file
+            # unfinished postprocessing tasks stay spooled and are resumed by the next run of this host,
+            # other claimed documents are returned to the queue for any worker
+            spooled = postprocess_queue.pending()
+            postprocess_queue.abort()
+            jobs.close(keep=spooled)
+            return
+    
+    print("Waiting for postprocessing of extracted documents...")
+    postprocess_queue.join()
+    jobs.close()
+
+
+def _return_unprocessed(tasks_queue, channel):
+    while True:
+        try:
+            channel.return_doc(tasks_queue.get(block=False).md5)
+        except Empty:
+            return
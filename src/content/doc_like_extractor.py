@@ -1,16 +1,7 @@
-from utils import get_in_workdir
-from dirs import Dirs
-from rich import print
-import re
-import os
-from rich import print
-import subprocess
-import chardet
-import subprocess
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
-from googleapiclient.discovery import build
-import io
-import shutil
+from .text_normalization import DOC_LIKE_NORMALIZER
+from .pandoc import to_markdown
+from .docx_converter import convert_to_docx
+from .charset import to_utf8
 
 
 # these formats requires preformatting into docx format before extraction
@@ -43,88 +34,35 @@ check_encoding_mime_types = set([
 ])
 
 
-gdrive_operative_folder_name = '1WFYCcbrtKGv3KTwyKdcKHKxXwmr9iFHE'
-
-
 class DocLikeExtractor:
-    def __init__(self, doc, local_doc_path, config, s3lient, gcloud_creds):
+    def __init__(self, doc, local_doc_path, config, s3lient, gcloud_creds, pandoc_url=None):
         self.doc = doc
         self.local_doc_path = local_doc_path
         self.config = config
         self.s3lient = s3lient
         self.gcloud_creds = gcloud_creds
+        self.pandoc_url = pandoc_url
         
     def extract(self):
-        response_path = get_in_workdir(Dirs.CONTENT, file=f"{self.doc.md5}-formatted.md")
-        
         if self.doc.mime_type == 'text/markdown':
-            shutil.copyfile(self.local_doc_path, response_path)
+            with open(self.local_doc_path, 'r') as f:
+                content = f.read()
         else:
             self._preprocess_if_required()
+            content = to_markdown(self.local_doc_path, server_url=self.pandoc_url)
         
-            cmd = [
-                "pandoc",
-                self.local_doc_path,
-                "-o", response_path,
-                "-t", "markdown_mmd",
-                # "--extract-media", clips_dir,
-                "--wrap=preserve"
-            ]
-        
-            subprocess.run(cmd, check=True)
-        
-            return self._postprocess(response_path)
+        return self._postprocess(content)
 
             
     def _preprocess_if_required(self):
         if self.doc.mime_type in check_encoding_mime_types:
-            # Step 1: Detect encoding
-            with open(self.local_doc_path, 'rb') as f:
-                raw_data = f.read()
-                detected = chardet.detect(raw_data)
-                encoding = detected['encoding']
-
-            # Step 2: Convert to UTF-8 if needed
-            if encoding and encoding.lower() != 'utf-8':
-                print(f"Converting {self.local_doc_path} from {encoding} to UTF-8...")
-                text = raw_data.decode(encoding)
-                with open(self.local_doc_path, 'w', encoding='utf-8') as f:
-                    f.write(text)
+            self.local_doc_path = to_utf8(self.local_doc_path, self.doc.md5)
         
         if self.doc.mime_type in to_docx_mime_types:
-            service = build('drive', 'v3', credentials=self.gcloud_creds)
-            file_metadata = {
-                'name': os.path.basename(self.local_doc_path), 
-                'mimeType': 'application/vnd.google-apps.document',
-                'parents': [gdrive_operative_folder_name]  # Use a specific folder for conversion,
-            }
-            media = MediaFileUpload(self.local_doc_path, resumable=True)
-            uploaded = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-            file_id = uploaded.get('id')
-
-            output_path = get_in_workdir(Dirs.ENTRY_POINT, file=f"{self.doc.md5}.docx")
-            request = service.files().export_media(fileId=file_id,
-                mimeType='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
-            fh = io.FileIO(output_path, 'wb')
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                _, done = downloader.next_chunk()
-            
-            service.files().delete(fileId=file_id).execute()
-            self.local_doc_path = output_path
+            self.local_doc_path = convert_to_docx(self.local_doc_path, self.doc.md5, self.config, self.gcloud_creds)
     
-    def _postprocess(self, response_path):
-        with open(response_path, 'r') as f:
-            content = f.read()
-            
-        content = re.sub(r"^!\[\]\(.*?\)\s*", '', content, flags=re.MULTILINE)
-        content = re.sub(r'^- ?', '— ', content, flags=re.MULTILINE)
-        content = re.sub(r'!\[.*?\]\(.*?\)', '', content, flags=re.MULTILINE)
-        content = re.sub(r'<img\s+[^>]*src="[^"]+"[^>]*>', '', content)
-        content = re.sub(r'dN=`?.*?</a>`?\{=html\}', '', content, flags=re.DOTALL)
-        
-        return content
+    def _postprocess(self, content):
+        return DOC_LIKE_NORMALIZER(content)
             
         # def __replacer(match):
         #     src_path = match.group(1)
@@ -0,0 +1,120 @@
+"""
+DOCX Converter Module
+
+Pandoc can not read RTF, DOC and ODT documents well enough, so they are converted to DOCX
+before extraction. Two backends are available:
+- libreoffice: headless LibreOffice running locally, works offline and in parallel. Every
+  process uses its own LibreOffice profile, since two instances can not share one, it is
+  removed when the process exits
+- gdrive: the document is uploaded to Google Drive as Google Doc and exported back as DOCX,
+  four network round-trips per document behind a single OAuth credential
+
+The backend is chosen by `non_pdf.docx_converter` in the config, the other one is used as the
+fallback when the chosen one fails.
+
+Functions:
+    convert_to_docx(path, md5, config, gcloud_creds): Converts the document and returns the path to DOCX
+"""
+import atexit
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+
+from rich import print
+
+from dirs import Dirs
+from utils import get_in_workdir
+
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+gdrive_operative_folder_name = '1WFYCcbrtKGv3KTwyKdcKHKxXwmr9iFHE'
+
+# LibreOffice hangs on some broken documents instead of failing
+LIBREOFFICE_TIMEOUT = 300
+
+
+def convert_to_docx(path, md5, config, gcloud_creds):
+    backend = (config.get('non_pdf') or {}).get('docx_converter', 'libreoffice')
+    fallback = 'gdrive' if backend == 'libreoffice' else 'libreoffice'
+    output_path = get_in_workdir(Dirs.ENTRY_POINT, file=f"{md5}.docx")
+    try:
+        _CONVERTERS[backend](path, output_path, gcloud_creds)
+    except Exception as e:
+        print(f"[yellow]Could not convert {path} to docx with {backend}, trying {fallback}: {e}[/yellow]")
+        _CONVERTERS[fallback](path, output_path, gcloud_creds)
+    return output_path
+
+
+def _convert_with_libreoffice(path, output_path, gcloud_creds):
+    soffice = shutil.which("soffice") or shutil.which("libreoffice")
+    if not soffice:
+        raise FileNotFoundError("LibreOffice is not installed")
+
+    with tempfile.TemporaryDirectory(prefix="soffice-") as tmp_dir:
+        cmd = [
+            soffice,
+            f"-env:UserInstallation=file://{_profile_dir()}",
+            "--headless",
+            "--norestore",
+            "--convert-to", "docx",
+            "--outdir", tmp_dir,
+            path,
+        ]
+        subprocess.run(cmd, check=True, capture_output=True, timeout=LIBREOFFICE_TIMEOUT)
+        # soffice exits with 0 even if it could not convert the document
+        converted = os.path.join(tmp_dir, f"{os.path.splitext(os.path.basename(path))[0]}.docx")
+        if not os.path.exists(converted):
+            raise ValueError(f"LibreOffice produced no output for {path}")
+        shutil.move(converted, output_path)
+
+
+def _profile_dir():
+    """LibreOffice profile of the process, created on the first conversion and removed on exit"""
+    global _profile
+    pid = os.getpid()
+    if _profile is None or _profile[0] != pid:
+        profile_dir = tempfile.mkdtemp(prefix="monocorpus-soffice-")
+        atexit.register(_remove_profile_dir, profile_dir, pid)
+        _profile = (pid, profile_dir)
+    return _profile[1]
+
+
+def _remove_profile_dir(profile_dir, pid):
+    # a forked child inherits the handlers of its parent, it must not remove the profile in use by the parent
+    if os.getpid() == pid:
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+
+_profile = None
+
+
+def _convert_with_gdrive(path, output_path, gcloud_creds):
+    from googleapiclient.discovery import build
+    from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+
+    service = build('drive', 'v3', credentials=gcloud_creds)
+    file_metadata = {
+        'name': os.path.basename(path),
+        'mimeType': 'application/vnd.google-apps.document',
+        'parents': [gdrive_operative_folder_name]  # Use a specific folder for conversion,
+    }
+    media = MediaFileUpload(path, resumable=True)
+    uploaded = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    file_id = uploaded.get('id')
+
+    request = service.files().export_media(fileId=file_id, mimeType=DOCX_MIME_TYPE)
+    with io.FileIO(output_path, 'wb') as fh:
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while done is False:
+            _, done = downloader.next_chunk()
+
+    service.files().delete(fileId=file_id).execute()
+
+
+_CONVERTERS = {
+    'libreoffice': _convert_with_libreoffice,
+    'gdrive': _convert_with_gdrive,
+}
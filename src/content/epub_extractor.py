@@ -1,115 +1,224 @@
-from utils import get_in_workdir
-from ebooklib import epub, ITEM_NAVIGATION, ITEM_DOCUMENT, ITEM_IMAGE, ITEM_STYLE, ITEM_FONT, ITEM_COVER, ITEM_UNKNOWN
+import multiprocessing
+import os
+import posixpath
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from urllib.parse import urlparse, unquote
+
 from bs4 import BeautifulSoup, NavigableString
-from markdownify import markdownify as md
-from dirs import Dirs
+from lxml import etree
+from markdownify import MarkdownConverter
 from rich import print
-import re
-from urllib.parse import urlparse
+
+from dirs import Dirs
+from s3 import upload_file, create_session
+from utils import get_in_workdir
+from .text_normalization import EPUB_NORMALIZER
+
+TOC_MARKER = "<!-- mdformat-toc start --no-anchors -->"
+
+DOCUMENT_MEDIA_TYPES = {'application/xhtml+xml', 'text/html'}
+NCX_MEDIA_TYPE = 'application/x-dtbncx+xml'
+
+IMAGE_EXTENSIONS = {'image/jpeg': 'jpeg', 'image/png': 'png', 'image/gif': 'gif', 'image/svg+xml': 'svg'}
+
+NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+}
 
 
 class EpubExtractor:
-    
+
     def __init__(self, doc, local_doc_path, config, s3lient):
         self.doc = doc
         self.local_doc_path = local_doc_path
         self.config = config
         self.s3lient = s3lient
-    
-    
+        settings = config.get('non_pdf') or {}
+        # processes converting the items, documents are already converted in parallel by the non-PDF pipeline
+        self.workers = settings.get('epub_workers', 1)
+        self.upload_images = settings.get('epub_images', False)
+
+
     def extract(self):
-        md_content, icr = self._extract(self.doc, self.config, self.local_doc_path, self.s3lient) 
-        return self._postprocess(md_content)
+        return "\n\n".join(self.iter_markdown())
+
+
+    def extract_to(self, path):
+        """Write markdown to the file item by item, the whole book is never held in memory"""
+        with open(path, 'w') as f:
+            for idx, md_content in enumerate(self.iter_markdown()):
+                if idx:
+                    f.write("\n\n")
+                f.write(md_content)
+
+
+    def iter_markdown(self):
+        """Yield postprocessed markdown of the book items in reading order"""
+        for md_content in self._extract(self.local_doc_path):
+            yield self._postprocess(md_content)
 
 
     def _postprocess(self, content):
-        content = re.sub(r"^xml version='1\.0' encoding='utf-8'\?\s*", '', content, flags=re.MULTILINE)
-        content = re.sub(r"^!\[\]\(.*?\)\s*", '', content, flags=re.MULTILINE)
-        content = re.sub(r'^- ?', '— ', content, flags=re.MULTILINE)
-        content = re.sub(r'!\[.*?\]\(.*?\)', '', content, flags=re.MULTILINE)
-        return content
-        
-        
-    def _extract(self, doc, config, local_doc_path, s3session):
-        outputs = []
-        book = epub.read_epub(local_doc_path)
-        clips_counter = 0
-        clips_dir = get_in_workdir(Dirs.CLIPS)
-        clips_bucket = config["yandex"]["cloud"]['bucket']['image']
-        image_items = 0
-        document_items = 0
-        
-        for item in book.get_items():
-            item_type = item.get_type()
-            
-            # Skip unsupported types early
-            if item_type in [ITEM_STYLE, ITEM_FONT]:
+        # all rules are bound to a single line, so items can be postprocessed one by one
+        return EPUB_NORMALIZER(content)
+
+
+    def _extract(self, local_doc_path):
+        # items are read straight from the archive one at a time in the order of the spine
+        with zipfile.ZipFile(local_doc_path) as zf, ExitStack() as stack:
+            manifest, spine, toc_id = _read_package(zf)
+
+            navigation = [href for item_id, (href, media_type, properties) in manifest.items()
+                          if item_id == toc_id or media_type == NCX_MEDIA_TYPE or 'nav' in properties]
+            if any(_read(zf, href).strip() for href in navigation):
+                yield TOC_MARKER
+
+            window = 2 * self.workers
+            if self.workers > 1:
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")))
+                converted = _ordered_map(executor, _convert_item, self._documents(zf, manifest, spine, navigation), window)
+            else:
+                converted = (_convert_item(href, content) for href, content in self._documents(zf, manifest, spine, navigation))
+
+            if not self.upload_images:
+                for text_md, _ in converted:
+                    if text_md:
+                        yield text_md
+                return
+
+            # images are uploaded while the next items are converted, an item waits only for its own images
+            uploader = stack.enter_context(ThreadPoolExecutor(max_workers=8, thread_name_prefix="epub-uploader"))
+            uploads = {}
+            pending = deque()
+            for text_md, images in converted:
+                for image_href in images:
+                    if image_href not in uploads and (upload := self._upload_image(zf, manifest, image_href, len(uploads), uploader)):
+                        uploads[image_href] = upload
+                pending.append((text_md, [uploads[i] for i in images if i in uploads]))
+                while pending and (len(pending) > window or all(f.done() for f in pending[0][1])):
+                    if md_content := _with_figures(*pending.popleft()):
+                        yield md_content
+            while pending:
+                if md_content := _with_figures(*pending.popleft()):
+                    yield md_content
+
+
+    def _documents(self, zf, manifest, spine, navigation):
+        for item_id in spine:
+            if item_id not in manifest:
+                print(f"Spine item {item_id} is missing in the manifest")
                 continue
-            
-            if item_type == ITEM_NAVIGATION:
-                if item.get_content().strip():
-                    outputs.append("<!-- mdformat-toc start --no-anchors -->")
-                    continue
-            
+            href, media_type, properties = manifest[item_id]
+            if href in navigation:
+                continue
+            if media_type not in DOCUMENT_MEDIA_TYPES:
+                print(f"Unexpected type of spine item {href}: {media_type}")
+                continue
+
             # Get and validate content
-            content = item.get_content().strip()
+            content = _read(zf, href).strip()
             if not content:
-                print(f"Empty content in {item.get_name()}")
-                continue
-            
-            # Handle images
-            if item_type in [ITEM_IMAGE, ITEM_COVER]:
+                print(f"Empty content in {href}")
                 continue
-                # image_items += 1
-                # match item.media_type:
-                #     case 'image/jpeg':
-                #         ext = "jpeg"
-                #     case 'image/png':
-                #         ext = "png"
-                #     case 'image/svg+xml':
-                #         ext = "svg"
-                #     case _: raise ValueError(f"Unsupported media type: {item.media_type}")
-                # path = os.path.join(clips_dir, f"{doc.md5}-{clips_counter}.{ext}")
-                # clips_counter += 1
-                # with open(path, "wb") as f:
-                #     f.write(content)
-                # url = upload_file(path, clips_bucket, os.path.basename(path), s3session, skip_if_exists=True)
-                # literal = f'<figure style="text-align: center; margin: 1em 0;" id="{os.path.basename(item.get_name())}"><img alt="" src="{url}" style="max-width: 800px; width: 50%; height: auto;"></figure>'
-                # outputs.append(literal)
-            
-            elif item_type == ITEM_DOCUMENT:
-                document_items += 1
-                soup = BeautifulSoup(content, 'html.parser').html
-                for p in soup.find_all('p'):
-                    for i, content in enumerate(p.contents):
-                        if isinstance(content, NavigableString):
-                            # Replace the content with \n removed
-                            p.contents[i].replace_with(content.replace('\n', ' '))
-                
-                # Remove <a> tag with relative href but keep the text
-                for a in soup.find_all('a', href=True):
-                    if self._is_relative(a['href']):
-                        a.unwrap() 
-                        
-                text_html = str(soup)
-                if not text_html.strip():
-                    print(f"No HTML after parsing in {item.get_name()}")
-                    continue
-                
-                text_md = md(text_html, bullets='*+-', strong_em_symbol='*', escape_misc=False, heading_styles='atx', table_infer_header=True)
-                if text_md.strip():
-                    outputs.append(text_md)
-                else:
-                    print(f"Markdown is empty for {item.get_name()}")
-            elif item_type == ITEM_UNKNOWN:
-                print("Unknown type found")
-            else:
-                raise ValueError(f"Unexpected type received: {item_type}")
-                
-        return "\n\n".join(outputs), (image_items, document_items)
-    
-    
-    def _is_relative(self, url):
-        parsed = urlparse(url)
-        return not parsed.scheme and not parsed.netloc
+            yield href, content
+
+
+    def _upload_image(self, zf, manifest, image_href, counter, uploader):
+        media_type = next((t for href, t, _ in manifest.values() if href == image_href), None)
+        if not (ext := IMAGE_EXTENSIONS.get(media_type)) or not (content := _read(zf, image_href)):
+            return None
+        path = os.path.join(get_in_workdir(Dirs.CLIPS), f"{self.doc.md5}-{counter}.{ext}")
+        with open(path, "wb") as f:
+            f.write(content)
+        if self.s3lient is None:
+            self.s3lient = create_session(self.config)
+        clips_bucket = self.config["yandex"]["cloud"]['bucket']['image']
+        return uploader.submit(upload_file, path, clips_bucket, os.path.basename(path), self.s3lient, skip_if_exists=True)
+
+
+_CONVERTER = MarkdownConverter(bullets='*+-', strong_em_symbol='*', escape_misc=False, heading_styles='atx', table_infer_header=True)
+
+
+def _convert_item(href, content):
+    """Convert XHTML item of the book to markdown, returns it with the paths of the images it refers to"""
+    soup = BeautifulSoup(content, 'lxml').html
+    if soup is None:
+        print(f"No HTML after parsing in {href}")
+        return None, []
+
+    for p in soup.find_all('p'):
+        for i, content in enumerate(p.contents):
+            if isinstance(content, NavigableString):
+                # Replace the content with \n removed
+                p.contents[i].replace_with(content.replace('\n', ' '))
+
+    # Remove <a> tag with relative href but keep the text
+    for a in soup.find_all('a', href=True):
+        if _is_relative(a['href']):
+            a.unwrap()
+
+    item_dir = posixpath.dirname(href)
+    images = list(dict.fromkeys(
+        posixpath.normpath(posixpath.join(item_dir, unquote(img['src'])))
+        for img in soup.find_all('img', src=True)
+        if _is_relative(img['src'])
+    ))
+
+    text_md = _CONVERTER.convert_soup(soup)
+    if text_md.strip():
+        return text_md, images
+    print(f"Markdown is empty for {href}")
+    return None, images
+
+
+def _is_relative(url):
+    parsed = urlparse(url)
+    return not parsed.scheme and not parsed.netloc
+
+
+def _with_figures(text_md, uploads):
+    figures = [
+        f'<figure style="text-align: center; margin: 1em 0;"><img alt="" src="{f.result()}" style="max-width: 800px; width: 50%; height: auto;"></figure>'
+        for f in uploads
+    ]
+    return "\n\n".join(([text_md] if text_md else []) + figures)
+
+
+def _ordered_map(executor, fn, items, window):
+    """Like `executor.map`, but keeps at most `window` items in flight"""
+    pending = deque()
+    for args in items:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _read_package(zf):
+    """Read the manifest, the spine and the id of NCX from the package document"""
+    container = etree.fromstring(zf.read('META-INF/container.xml'))
+    opf_path = container.find('.//container:rootfile', NAMESPACES).get('full-path')
+    opf_dir = posixpath.dirname(opf_path)
+    package = etree.fromstring(zf.read(opf_path))
+
+    manifest = {}
+    for item in package.iterfind('opf:manifest/opf:item', NAMESPACES):
+        href = posixpath.normpath(posixpath.join(opf_dir, unquote(item.get('href'))))
+        manifest[item.get('id')] = (href, item.get('media-type'), (item.get('properties') or '').split())
+
+    spine_element = package.find('opf:spine', NAMESPACES)
+    spine = [ref.get('idref') for ref in spine_element.iterfind('opf:itemref', NAMESPACES)]
+    return manifest, spine, spine_element.get('toc')
+
 
+def _read(zf, href):
+    try:
+        return zf.read(href)
+    except KeyError:
+        print(f"Item {href} is missing in the archive")
+        return b''
@@ -0,0 +1,183 @@
+"""
+Markdown Formatting Module
+
+Formats extracted markdown with mdformat. Small documents are formatted in one call, while
+multi-megabyte documents are split at safe block boundaries, the pieces are formatted in
+parallel processes and then reassembled, so that neither the time nor the memory grows with
+the size of the whole document.
+
+A boundary is safe when cutting there cannot change how the blocks around it are parsed:
+it lies outside of fenced code and raw HTML blocks, it does not split any footnote reference
+from its definition, and the next block is either a heading or a plain paragraph starting
+after a blank line. The extensions that need the whole document are resolved in a final pass:
+- footnote definitions, which mdformat moves to the end of the document, are collected from
+  every piece and appended after the last one
+- the TOC is rendered from a skeleton document that contains only the TOC marker and the
+  headings of all pieces
+
+Functions:
+    format_markdown(content, unescape=False, workers=None, chunk_size=CHUNK_SIZE): Formats markdown
+"""
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import mdformat
+
+# size of one piece in characters, documents smaller than two pieces are formatted at once
+CHUNK_SIZE = 256 * 1024
+
+OPTIONS = {"wrap": "keep", "number": "keep", "validate": True, "end_of_line": "lf"}
+
+TOC_MARKER = "<!-- mdformat-toc start --no-anchors -->"
+
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+HEADING_PATTERN = re.compile(r"^#{1,6}(?:[ \t]|$)")
+FOOTNOTE_LABEL_PATTERN = re.compile(r"\[\^([^\]\s]+)\]")
+FOOTNOTE_DEFINITION_PATTERN = re.compile(r"^\[\^[^\]\s]+\]: ", re.MULTILINE)
+# link reference definitions can be used anywhere in the document, such documents are not split
+LINK_DEFINITION_PATTERN = re.compile(r"^ {0,3}\[[^\]^][^\]]*\]:", re.MULTILINE)
+# beginnings of lines that may continue the previous block or start a block spanning blank lines
+NOT_PLAIN_PATTERN = re.compile(r"^(?:[\s>|<\[]|[-+*](?:\s|$)|\d{1,9}[.)](?:\s|$)|`{3}|~{3})")
+RAW_HTML_START_PATTERN = re.compile(r"^ {0,3}<(script|pre|style|textarea)(?:\s|>|$)", re.IGNORECASE)
+
+
+def format_markdown(content, unescape=False, workers=None, chunk_size=CHUNK_SIZE):
+    """
+    Format markdown document with 'toc' and 'footnote' extensions.
+
+    :param content: markdown document
+    :param unescape: revert escaping of backslashes, underscores and '<' done by mdformat
+    :param workers: count of processes formatting the pieces of a large document, defaults to count of CPUs,
+        callers running in a pool of processes already pass 1
+    :param chunk_size: approximate size of one piece in characters
+    :return: formatted document
+    """
+    chunks = _split(content, chunk_size) if len(content) >= 2 * chunk_size else [content]
+    if len(chunks) == 1:
+        formatted = mdformat.text(content, codeformatters=(), extensions=["toc", "footnote"], options=OPTIONS)
+        return _unescape(formatted) if unescape else formatted
+
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            pieces = list(executor.map(_format_chunk, chunks))
+    else:
+        pieces = [_format_chunk(c) for c in chunks]
+    del chunks
+
+    bodies = [body for body, _ in pieces]
+    tails = [tail for _, tail in pieces if tail]
+    _render_toc(bodies)
+    if unescape:
+        bodies = [_unescape(b) for b in bodies]
+        tails = [_unescape(t) for t in tails]
+    return "\n".join(bodies + tails)
+
+
+def _format_chunk(chunk):
+    """Format a piece of document and split the result into the body and the footnote definitions"""
+    formatted = mdformat.text(chunk, codeformatters=(), extensions=["footnote"], options=OPTIONS)
+    # mdformat moves definitions to the very end, after any fenced code of the body
+    last_fence = 0
+    for m in re.finditer(r"^(?:`{3,}|~{3,})", formatted, re.MULTILINE):
+        last_fence = m.end()
+    if m := FOOTNOTE_DEFINITION_PATTERN.search(formatted, last_fence):
+        return formatted[:m.start()].removesuffix("\n"), formatted[m.start():]
+    return formatted, ""
+
+
+def _render_toc(bodies):
+    """Replace TOC marker by the TOC rendered from the headings of all pieces"""
+    marked = [idx for idx, body in enumerate(bodies) if TOC_MARKER in body]
+    if not marked:
+        return
+    headings = []
+    for body in bodies:
+        in_fence = False
+        for line in body.split("\n"):
+            if FENCE_PATTERN.match(line):
+                in_fence = not in_fence
+            elif not in_fence and HEADING_PATTERN.match(line):
+                headings.append(line)
+    skeleton = "\n\n".join([TOC_MARKER, *headings]) + "\n"
+    rendered = mdformat.text(skeleton, codeformatters=(), extensions=["toc"], options=OPTIONS)
+    toc = rendered[:rendered.index("<!-- mdformat-toc end -->") + len("<!-- mdformat-toc end -->")]
+    toc = toc[toc.index("<!-- mdformat-toc start"):]
+    idx = marked[0]
+    bodies[idx] = bodies[idx].replace(TOC_MARKER, toc, 1)
+
+
+def _unescape(content):
+    # mdformat escapes all baspecial chars inside $...$, code below is not ideal because it replace all backslashes
+    return content.replace('\\\\', '\\').replace('\\_', '_').replace('\\<', '<')
+
+
+def _split(content, chunk_size):
+    """Split the document into pieces of approximately `chunk_size` characters at safe boundaries"""
+    if content.count(TOC_MARKER) > 1 or LINK_DEFINITION_PATTERN.search(content):
+        return [content]
+    lines = content.split("\n")
+    blocked = _footnote_spans(lines)
+
+    chunks = []
+    start = 0
+    size = 0
+    in_fence = None
+    in_raw_html = None
+    in_comment = False
+    prev_blank = True
+    for idx, line in enumerate(lines):
+        if (
+            size >= chunk_size
+            and not (in_fence or in_raw_html or in_comment)
+            and not blocked[idx]
+            and (HEADING_PATTERN.match(line) or (prev_blank and line and not NOT_PLAIN_PATTERN.match(line)))
+        ):
+            chunks.append("\n".join(lines[start:idx]) + "\n")
+            start = idx
+            size = 0
+        size += len(line) + 1
+
+        if in_fence:
+            if line.strip().startswith(in_fence) and not line.strip().strip(in_fence[0]):
+                in_fence = None
+        elif in_raw_html:
+            if f"</{in_raw_html}" in line.lower():
+                in_raw_html = None
+        elif in_comment:
+            if "-->" in line:
+                in_comment = False
+        elif m := FENCE_PATTERN.match(line):
+            in_fence = m.group(1)
+        elif m := RAW_HTML_START_PATTERN.match(line):
+            in_raw_html = m.group(1).lower() if f"</{m.group(1).lower()}" not in line.lower() else None
+        elif "<!--" in line:
+            in_comment = "-->" not in line[line.rindex("<!--"):]
+        prev_blank = not line.strip()
+
+    chunks.append("\n".join(lines[start:]))
+    return chunks
+
+
+def _footnote_spans(lines):
+    """Mark lines which lie between the first and the last mention of some footnote label"""
+    first_last = {}
+    for idx, line in enumerate(lines):
+        for label in FOOTNOTE_LABEL_PATTERN.findall(line):
+            first, _ = first_last.get(label, (idx, idx))
+            first_last[label] = (first, idx)
+
+    # difference array: +1 on the line after the first mention, -1 on the line after the last
+    delta = [0] * (len(lines) + 1)
+    for first, last in first_last.values():
+        if last > first:
+            delta[first + 1] += 1
+            delta[last + 1] -= 1
+    blocked = []
+    depth = 0
+    for d in delta[:-1]:
+        depth += d
+        blocked.append(depth > 0)
+    return blocked
@@ -0,0 +1,243 @@
+"""
+Non-PDF Extraction Pipeline Module
+
+EPUB, office and plain text documents are extracted without Gemini, so their throughput is
+limited only by local CPU and network. Instead of handling them one after another, the documents
+flow through four stages connected by bounded queues:
+- download: threads downloading the documents from Yandex.Disk
+- convert: `EpubExtractor`/`DocLikeExtractor`, run in a pool of processes, pandoc conversions are
+  served by one long-lived pandoc server
+- format: mdformat, run in the same pool of processes
+- upload: threads zipping and uploading the artifacts to S3 and updating the database
+
+The queues are bounded so that a fast stage cannot run far ahead of a slow one, and neither the
+downloaded documents nor the converted texts pile up. The CPU-bound stages hand only file paths
+between processes, the content itself never travels through the queues.
+
+Classes:
+    NonPdfPipeline: Runs documents through the stages
+
+Functions:
+    convert_task(doc, local_doc_path, config, gcloud_creds, pandoc_url): Converts a document to markdown in a worker process
+    format_task(md5, extracted_path): Formats converted markdown in a worker process
+"""
+import multiprocessing
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from queue import Queue
+
+from rich import print
+from rich.progress import Progress
+
+from dirs import Dirs
+from cache import pin, unpin
+from metrics import DOCUMENTS, ERRORS, watch_queue, error_class
+from s3 import upload_file
+from utils import download_file_locally, get_in_workdir, encrypt, get_session
+from .doc_like_extractor import DocLikeExtractor
+from .epub_extractor import EpubExtractor
+from .md_format import format_markdown
+from .pandoc import PandocServer
+
+# marks the end of the input of a stage
+_DONE = object()
+
+
+@dataclass
+class _Item:
+    doc: object
+    local_doc_path: str = None
+    extracted_path: str = None
+    formatted_path: str = None
+
+
+class NonPdfPipeline:
+
+    def __init__(self, config, ya_client, s3client, gcloud_creds, workers):
+        settings = config.get('non_pdf') or {}
+        self.config = config
+        self.ya_client = ya_client
+        self.s3client = s3client
+        self.gcloud_creds = gcloud_creds
+        self.workers = max(1, workers)
+        self.download_workers = settings.get('download_workers', 4)
+        self.upload_workers = settings.get('upload_workers', 4)
+        self.queue_size = settings.get('queue_size') or 2 * self.workers
+        self.stop_event = threading.Event()
+        self.executor = None
+        self.pandoc_url = None
+        self.progress = None
+        self.task_id = None
+
+
+    def run(self, docs):
+        """Process documents, returns when all of them are either uploaded or failed"""
+        queues = [Queue(maxsize=self.queue_size) for _ in range(4)]
+        stages = [
+            _Stage("download", self._download, self.download_workers, queues[0], queues[1], self),
+            _Stage("convert", self._convert, self.workers, queues[1], queues[2], self),
+            _Stage("format", self._format, self.workers, queues[2], queues[3], self),
+            _Stage("upload", self._upload, self.upload_workers, queues[3], None, self),
+        ]
+        # spawn instead of fork: the pipeline threads are already running
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            with PandocServer() as pandoc, Progress() as self.progress:
+                self.pandoc_url = pandoc.url
+                self.task_id = self.progress.add_task("Processing documents...", total=len(docs))
+                for stage in stages:
+                    watch_queue(f"non_pdf_{stage.name}", stage.inbox.qsize)
+                    stage.start()
+                for doc in docs:
+                    if self.stop_event.is_set():
+                        break
+                    queues[0].put(_Item(doc))
+                queues[0].put(_DONE)
+                for stage in stages:
+                    stage.join()
+        except KeyboardInterrupt:
+            print("Interrupted, shutting down the pipeline...")
+            self.stop_event.set()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            for queue in queues:
+                queue.queue.clear()
+            queues[0].put(_DONE)
+            for stage in stages:
+                stage.join(timeout=60)
+            raise
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+    def failed(self, item, stage, e):
+        print(f"[red]Failed to extract content from file {item.doc.md5}({item.doc.ya_public_url}) at {stage} stage: {e}[/red]")
+        if item.local_doc_path:
+            unpin(item.doc.md5)
+        DOCUMENTS.labels("non_pdf", "failed").inc()
+        ERRORS.labels(f"non_pdf_{stage}", error_class(e)).inc()
+        self.progress.advance(self.task_id)
+
+
+    def _download(self, item):
+        print(f"Extracting content from file {item.doc.md5}({item.doc.ya_public_url})")
+        # artifacts of the document are kept in the cache until it is uploaded or failed
+        pin(item.doc.md5)
+        try:
+            item.local_doc_path = download_file_locally(self.ya_client, item.doc, self.config)
+        except Exception:
+            unpin(item.doc.md5)
+            raise
+        return item
+
+
+    def _convert(self, item):
+        future = self.executor.submit(convert_task, item.doc, item.local_doc_path, self.config, self.gcloud_creds, self.pandoc_url)
+        item.extracted_path = future.result()
+        return item
+
+
+    def _format(self, item):
+        item.formatted_path = self.executor.submit(format_task, item.doc.md5, item.extracted_path).result()
+        return item
+
+
+    def _upload(self, item):
+        _upload_artifacts_to_s3(item.doc, item.formatted_path, item.local_doc_path, self.config, self.s3client)
+        with get_session() as session:
+            session.merge(item.doc)
+            session.commit()
+        unpin(item.doc.md5)
+        DOCUMENTS.labels("non_pdf", "extracted").inc()
+        self.progress.advance(self.task_id)
+
+
+class _Stage:
+    """Threads taking items from the inbox, processing them and putting the results into the outbox"""
+
+    def __init__(self, name, fn, threads, inbox, outbox, pipeline):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.pipeline = pipeline
+        self.lock = threading.Lock()
+        self.running = threads
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{num}", daemon=True) for num in range(threads)]
+
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+
+    def join(self, timeout=None):
+        for t in self.threads:
+            t.join(timeout=timeout)
+
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                # let the sibling threads see the end of the input as well
+                self.inbox.put(_DONE)
+                break
+            if self.pipeline.stop_event.is_set():
+                continue
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                self.pipeline.failed(item, self.name, e)
+                continue
+            if self.outbox is not None:
+                # blocks while the next stage is behind
+                self.outbox.put(result)
+
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last and self.outbox is not None:
+            self.outbox.put(_DONE)
+
+
+def convert_task(doc, local_doc_path, config, gcloud_creds, pandoc_url):
+    extracted_path = get_in_workdir(Dirs.CONTENT, file=f"{doc.md5}-extracted.md")
+    # extractors do not upload images at the moment, S3 client can not be passed to another process anyway
+    if doc.mime_type == 'application/epub+zip':
+        EpubExtractor(doc, local_doc_path, config, None).extract_to(extracted_path)
+        return extracted_path
+
+    content = DocLikeExtractor(doc, local_doc_path, config, None, gcloud_creds, pandoc_url).extract()
+    with open(extracted_path, 'w') as f:
+        f.write(content)
+    return extracted_path
+
+
+def format_task(md5, extracted_path):
+    with open(extracted_path, 'r') as f:
+        content = f.read()
+    # the pool is already busy with other documents, so the document is not split between processes
+    formatted_content = format_markdown(content, workers=1)
+
+    formatted_path = get_in_workdir(Dirs.CONTENT, file=f"{md5}-formatted.md")
+    with open(formatted_path, 'w') as f:
+        f.write(formatted_content)
+    os.remove(extracted_path)
+    return formatted_path
+
+
+def _upload_artifacts_to_s3(doc, formatted_response_md, local_doc_path, config, s3lient):
+    content_key = f"{doc.md5}.zip"
+    content_bucket = config["yandex"]["cloud"]['bucket']['content']
+    local_content_path = get_in_workdir(Dirs.CONTENT, file=f"{doc.md5}.zip")
+    with zipfile.ZipFile(local_content_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+        zf.write(arcname=f"{doc.md5}.md", filename=formatted_response_md)
+    doc.content_url = upload_file(local_content_path, content_bucket, content_key, s3lient)
+
+    doc_bucket = config["yandex"]["cloud"]['bucket']['document']
+    doc_key = os.path.basename(local_doc_path)
+    remote_doc_url = upload_file(local_doc_path, doc_bucket, doc_key, s3lient, skip_if_exists=True)
+    doc.document_url = encrypt(remote_doc_url, config) if doc.sharing_restricted else remote_doc_url
@@ -0,0 +1,144 @@
+"""
+Pandoc Module
+
+Conversion of documents to markdown with pandoc. Starting the pandoc executable costs more than
+converting a small text file, so a long-lived `pandoc server` is started once per run and the
+documents are posted to its HTTP API. The markdown is returned in memory instead of going
+through a file in `Dirs.CONTENT`.
+
+If the installed pandoc has no server mode, every document is converted by a separate pandoc
+process, still reading the markdown from its stdout.
+
+Classes:
+    PandocServer: Starts and stops the pandoc server
+
+Functions:
+    to_markdown(path, server_url=None): Converts a document to markdown
+"""
+import base64
+import os
+import socket
+import subprocess
+import time
+
+import requests
+from rich import print
+
+OUTPUT_FORMAT = "markdown_mmd"
+
+# input formats deduced from file extensions the same way the pandoc executable does
+INPUT_FORMATS = {
+    ".docx": "docx",
+    ".odt": "odt",
+    ".rtf": "rtf",
+    ".epub": "epub",
+    ".html": "html",
+    ".htm": "html",
+    ".xhtml": "html",
+    ".tex": "latex",
+    ".latex": "latex",
+    ".json": "json",
+    ".csv": "csv",
+    ".tsv": "tsv",
+    ".md": "markdown",
+    ".markdown": "markdown",
+    ".txt": "markdown",
+}
+# formats posted to the server base64 encoded
+BINARY_FORMATS = {"docx", "odt", "epub"}
+
+# conversion of a large document may take a while, pandoc server aborts requests after 2 seconds by default
+SERVER_TIMEOUT = 300
+
+
+class PandocServer:
+
+    def __init__(self, timeout=SERVER_TIMEOUT):
+        self.timeout = timeout
+        self.process = None
+        self.url = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+    def start(self):
+        """Start the server, `url` stays None if the installed pandoc can not run as a server"""
+        port = _free_port()
+        try:
+            self.process = subprocess.Popen(
+                ["pandoc", "server", "--port", str(port), "--timeout", str(self.timeout)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except FileNotFoundError:
+            print("[yellow]Pandoc is not installed[/yellow]")
+            return
+
+        url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and self.process.poll() is None:
+            try:
+                requests.get(f"{url}/version", timeout=1).raise_for_status()
+                self.url = url
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+
+        print("[yellow]Could not start pandoc server, documents will be converted by separate pandoc processes[/yellow]")
+        self.stop()
+
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        self.url = None
+
+
+def to_markdown(path, server_url=None):
+    """
+    Convert document to markdown keeping the line breaks of the source.
+
+    :param path: path to the document, the input format is deduced from its extension
+    :param server_url: url of a running pandoc server, a pandoc process is started per document if not provided
+    :return: markdown
+    """
+    if not server_url:
+        cmd = ["pandoc", path, "-t", OUTPUT_FORMAT, "--wrap=preserve"]
+        return subprocess.run(cmd, check=True, capture_output=True).stdout.decode("utf-8")
+
+    _, ext = os.path.splitext(path)
+    input_format = INPUT_FORMATS.get(ext.lower(), "markdown")
+    if input_format in BINARY_FORMATS:
+        with open(path, "rb") as f:
+            text = base64.b64encode(f.read()).decode("ascii")
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+
+    response = requests.post(
+        server_url,
+        json={"text": text, "from": input_format, "to": OUTPUT_FORMAT, "wrap": "preserve"},
+        headers={"Accept": "application/json"},
+        timeout=SERVER_TIMEOUT + 10,
+    )
+    if response.status_code != 200:
+        raise ValueError(f"Pandoc could not convert {path}: {response.text}")
+    return response.json()["output"]
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
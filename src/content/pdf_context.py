@@ -31,6 +31,28 @@ class Context():
         # self.progress.__exit__(type, value, traceback)
         pass
 
+    def to_dict(self):
+        """Serializable state of the context, the document itself is referenced by md5 only"""
+        return {
+            "doc_md5": self.doc.md5,
+            "md5": self.md5,
+            "local_doc_path": self.local_doc_path,
+            "chunk_paths": self.chunk_paths,
+            "ya_path": self.ya_path,
+            "ya_public_key": self.ya_public_key,
+            "ya_resource_id": self.ya_resource_id,
+            "unformatted_response_md": self.unformatted_response_md,
+            "extraction_method": self.extraction_method,
+            "doc_page_count": self.doc_page_count,
+        }
+
+    @classmethod
+    def from_dict(cls, doc, data):
+        context = cls(doc, data["local_doc_path"])
+        for attr in ["md5", "chunk_paths", "ya_path", "ya_public_key", "ya_resource_id", "unformatted_response_md", "extraction_method", "doc_page_count"]:
+            setattr(context, attr, data[attr])
+        return context
+
     def __str__(self):
         return '%s(%s)' % (
             type(self).__name__,
@@ -1,28 +1,28 @@
 from rich import print
-from utils import get_in_workdir, download_file_locally, encrypt, decrypt, get_session
+from utils import get_in_workdir, download_file_locally, decrypt
+from cache import pinned
+from logs import get_logger
+from spans import span, profiled
+from metrics import CHUNKS, TOKENS, DOCUMENTS, ERRORS, GEMINI_LATENCY, error_class
 from dirs import Dirs
-import zipfile
+import itertools
 import re
 import time
 from google.genai.errors import ClientError
 from queue import Empty
-import threading
 from content.pdf_context import Context
 import os
 from gemini import gemini_api, create_client
 import pymupdf
 import shutil
-from content.pdf_postprocess import postprocess, NoBboxError
 from prompt import cook_extraction_prompt
 import json
 from content.continuity_checker import continue_smoothly
 from pydantic import BaseModel, ValidationError
-from s3 import upload_file, create_session
 from json.decoder import JSONDecodeError
 import datetime
 import time
 from google.genai.errors import ServerError
-from models import Document, DocumentCrh
 
 
 model = 'gemini-2.5-pro'
@@ -160,9 +160,10 @@ class Chunk:
 class PdfExtractor:
     
     
-    def __init__(self, gemini_api_key, tasks_queue, config, s3lient, ya_client, channel, stop_event, lang_tag):
+    def __init__(self, gemini_api_key, tasks_queue, postprocess_queue, config, s3lient, ya_client, channel, stop_event, lang_tag, prefetcher):
         self.key = gemini_api_key
         self.tasks_queue = tasks_queue
+        self.postprocess_queue = postprocess_queue
         self.config = config
         self.s3lient = s3lient
         self.ya_client = ya_client
@@ -170,14 +171,18 @@ class PdfExtractor:
         self.stop_event = stop_event
         self.gemini_query_time = None
         self.lang_tag = lang_tag
+        self.prefetcher = prefetcher
+        self.logger = get_logger("content_extraction", key=gemini_api_key[-7:])
         
     def __call__(self):
         gemini_client = create_client(self.key)
         while not self.stop_event.is_set():
             try: 
                 doc = self.tasks_queue.get(block=False)
-                self.log(f"Processing doc {doc.md5}({doc.ya_public_url})")
-                result = self._extract_doc(doc, gemini_client)
+                self.log(f"Processing doc {doc.md5}({doc.ya_public_url})", md5=doc.md5)
+                # the extracted chunks and slices must not be evicted from the cache meanwhile
+                with pinned(doc.md5), profiled(doc.md5, "extraction", self.config), span("extraction", md5=doc.md5):
+                    result = self._extract_doc(doc, gemini_client)
                 
                 if self.stop_event.is_set() or result.get("stop_worker"):
                     return
@@ -185,56 +190,38 @@ class PdfExtractor:
                 if not (context := result.get("context")):
                     continue
                 
-                # additional processing
-                self.log(f"Postprocessing document {doc.md5}({doc.ya_public_url})")
-                postprocessed = postprocess(context, self.config)
-                
-                # write postprocessed content to a file
-                context.formatted_response_md = get_in_workdir(Dirs.CONTENT, file=f"{context.md5}-formatted.md")
-                with open(context.formatted_response_md, 'w') as f:
-                    f.write(postprocessed)
-                    
-                # create a zip file with the content
-                context.local_content_path = get_in_workdir(Dirs.CONTENT, file=f"{context.md5}.zip")
-                with zipfile.ZipFile(context.local_content_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-                    zf.write(arcname=f"{context.md5}.md", filename=context.formatted_response_md)
-                
+                # postprocessing is done by a separate pool of processes, so the key is not idle meanwhile
                 context.extraction_method = f"gemini-2.5/pdfinput"
-
-                # upload the content to S3
-                self._upload_artifacts(context)
-                
-                # update the document in the gsheet
-                with get_session() as _session:
-                    self._upsert_document(_session, context)
-                
-                self.log(f"[bold green]Content extraction complete {context.doc.md5}({context.doc.ya_public_url})[/bold green]")
+                self.postprocess_queue.put(context)
+                DOCUMENTS.labels("content", "extracted").inc()
+                self.log(f"Document {doc.md5}({doc.ya_public_url}) is extracted and queued for postprocessing", md5=doc.md5)
             except Empty:
                 self.log("No tasks for processing, shutting down thread...")
                 return
-            except NoBboxError as e:
-                print("No bbox")
-                self.channel.add_repairable_doc(e.md5)
             except (JSONDecodeError, RecursionError, IndexError) as e:
                 if doc:
                     import traceback
                     print(f"Error:", "\n", e, "\n", traceback.format_exc())
-                    self.channel.add_repairable_doc(doc.md5)
+                    self.channel.add_repairable_doc(doc.md5, error=repr(e))
             except Exception as e:
                 import traceback
-                self.log(f"Could not extract content from doc {doc.md5}({doc.ya_public_url}): {e} \n{traceback.format_exc()}")
+                self.log(f"Could not extract content from doc {doc.md5}({doc.ya_public_url}): {e} \n{traceback.format_exc()}", md5=doc.md5)
+                self.channel.retry_doc(doc.md5, error=repr(e))
             
             
     def _extract_doc(self, doc, gemini_client):
-        self.log(f"About to download doc {doc.md5}({doc.ya_public_url})")
-        local_doc_path = download_file_locally(self.ya_client, doc, self.config)
+        self.log(f"Waiting for doc {doc.md5}({doc.ya_public_url}) to be downloaded")
+        # usually the document is already downloaded and sliced by the prefetcher
+        with span("download", md5=doc.md5):
+            local_doc_path, page_count = self.prefetcher.take(doc)
         self.log(f"Downloaded doc {doc.md5}({doc.ya_public_url})")
         context = Context(doc, local_doc_path)
-        self._enrich_context(self.ya_client, context)
+        with span("public_meta", md5=doc.md5):
+            self._enrich_context(self.ya_client, context)
         
         unformatted_response_md = get_in_workdir(Dirs.CONTENT, file=f"{context.md5}-unformatted.md")
         with pymupdf.open(context.local_doc_path) as pdf_doc, open(unformatted_response_md, "w") as output:
-            context.doc_page_count=pdf_doc.page_count
+            context.doc_page_count = page_count
             chunked_results_dir = get_in_workdir(Dirs.CHUNKED_RESULTS, context.md5)
             prev_chunk_tail = None
             headers_hierarchy = []
@@ -249,6 +236,7 @@ class PdfExtractor:
                     complete, missing_pages = chunk_planner.verify_complete()
                     if not complete:
                         self.log(f"Chunk planner gave none chunks but there are missed pages '{missing_pages}' for doc '{context.md5}'")
+                        self.channel.retry_doc(context.md5, error=f"Missed pages {missing_pages}")
                         return {"stop_worker": False}
                     break
                 
@@ -263,10 +251,11 @@ class PdfExtractor:
                             content = deserialized
 
                 if not content:
-                    self.log(f"Extracting chunk({chunk.start}-{chunk.end})/{context.doc_page_count} of document {context.md5}({context.doc.ya_public_url})")
+                    self.log(f"Extracting chunk({chunk.start}-{chunk.end})/{context.doc_page_count} of document {context.md5}({context.doc.ya_public_url})", md5=context.md5, chunk=f"{chunk.start}-{chunk.end}")
                     
                     # create a pdf doc what will contain a slice of original pdf doc
-                    slice_file_path = self._create_doc_clice(chunk.start, chunk.end, pdf_doc, context.md5)
+                    with span("slice", md5=context.md5, chunk=f"{chunk.start}-{chunk.end}"):
+                        slice_file_path = self._create_doc_clice(chunk.start, chunk.end, pdf_doc, context.md5)
                 
                     if os.path.exists(chunk_result_complete_path): 
                         os.remove(chunk_result_complete_path)
@@ -285,7 +274,9 @@ class PdfExtractor:
                                         
                     self._sleep_if_needed()
                     uploaded_files = []
+                    started = time.monotonic()
                     try:
+                        fields = {"md5": context.md5, "chunk": f"{chunk.start}-{chunk.end}"}
                         resp, uploaded_files = gemini_api(
                             client=gemini_client,
                             model=model,
@@ -294,10 +285,14 @@ class PdfExtractor:
                             schema=ExtractionResult,
                             timeout_sec=6000
                         )
+                        # the request is sent on the first read of the stream, generation is the time to the first part
+                        resp = iter(resp)
+                        with span("gemini.generate", **fields):
+                            first = next(resp, None)
                         # write result into file
-                        with open(chunk_result_incomplete_path, "w") as f:
+                        with open(chunk_result_incomplete_path, "w") as f, span("gemini.stream", **fields):
                             raw_content = ""
-                            for p in resp:
+                            for p in itertools.chain([first] if first else [], resp):
                                 if p.usage_metadata:
                                     usage_meta = p.usage_metadata
                                 if text := p.text:
@@ -310,19 +305,28 @@ class PdfExtractor:
                             f.write(content)
                                     
                         # validating schema
-                        with open(chunk_result_incomplete_path, "r") as f:
+                        with open(chunk_result_incomplete_path, "r") as f, span("validate", **fields):
                             content = ExtractionResult.model_validate_json(f.read()).content
                             if _has_figure_tag_with_missing_attributes(content):
                                 raise ValidationError("Chunk has figure tag with missing attributes")
                             
                         # "mark" batch as extracted by renaming file
                         shutil.move(chunk_result_incomplete_path, chunk_result_complete_path)
-                        self.log(f"Chunk ({chunk.start}-{chunk.end})/{context.doc_page_count} of document {context.md5}({context.doc.ya_public_url}) [bold green]extracted successfully[/bold green]: {_tokens_info(usage_meta)}")
+                        self._account_chunk("extracted", started, usage_meta)
+                        self.log(
+                            f"Chunk ({chunk.start}-{chunk.end})/{context.doc_page_count} of document {context.md5}({context.doc.ya_public_url}) [bold green]extracted successfully[/bold green]: {_tokens_info(usage_meta)}",
+                            md5=context.md5, chunk=f"{chunk.start}-{chunk.end}", latency=round(time.monotonic() - started, 1), **_tokens_fields(usage_meta),
+                        )
                     except ServerError as e:
+                        ERRORS.labels("content", error_class(e)).inc()
+                        self._account_chunk("failed", started, usage_meta)
                         self.log(f"Server error: {e}")
-                        self.tasks_queue.put(doc)  # return task to the queue for later processing
+                        # return the document to the queue for later processing, the failure is on the side of Gemini
+                        self.channel.return_doc(doc.md5)
                         return {"stop_worker": False}  # continue to the next doc with timeout
                     except (ClientError, ValidationError) as e:
+                        ERRORS.labels("content", error_class(e)).inc()
+                        self._account_chunk("failed", started, usage_meta)
                         self.log(f"Client error: {e}")
                         if isinstance(e, ClientError):
                             self.log(f"Client error during extraction of content of doc {context.md5}({context.doc.ya_public_url}: {e}")
@@ -333,18 +337,18 @@ class PdfExtractor:
                             # elif e.code == 429 and "GenerateRequestsPerDayPerProjectPerModel-FreeTier" in message:
                             elif e.code == 429:
                                 self.log(f"Free tier limit reached for model {model}, stopping worker...")
-                                # return task to the queue for later processing
-                                self.tasks_queue.put(doc)
+                                # return the document to the queue for processing with another key
+                                self.channel.return_doc(doc.md5)
                                 # add key to the exceeded keys set
                                 self.channel.add_exceeded_key(self.key)
                                 return {"stop_worker": True}
 
                         if chunk_planner.decrease_chunk_size():
                             chunk_size = f"with size {chunk.end - chunk.start + 1}" if chunk else ""
-                            self.log(f"Could not extract chunk {chunk_size} of doc {context.md5}({context.doc.ya_public_url}){_tokens_info(usage_meta)}")
+                            self.log(f"Could not extract chunk {chunk_size} of doc {context.md5}({context.doc.ya_public_url}){_tokens_info(usage_meta)}", md5=context.md5, **_tokens_fields(usage_meta))
                             continue
                         else:
-                            self.channel.add_unprocessable_doc(context.md5)
+                            self.channel.add_unprocessable_doc(context.md5, error=repr(e))
                             self.log(f"Could not extract chunk with any size of doc {context.md5}({context.doc.ya_public_url}){_tokens_info(usage_meta)}")
                             return {"stop_worker": False}
                     finally:
@@ -361,7 +365,8 @@ class PdfExtractor:
                 headers_hierarchy.extend(self._extract_markdown_headers(content))
                 
                 if prev_chunk_tail:
-                    content = continue_smoothly(prev_chunk_tail=prev_chunk_tail, content=content)
+                    with span("continuity", md5=context.md5):
+                        content = continue_smoothly(prev_chunk_tail=prev_chunk_tail, content=content, segmenter=self.config.get('sentence_segmenter', 'rules'))
 
                 prev_chunk_tail = content[-300:]
                 # important to remove hyphen after taking the chunk tail
@@ -491,64 +496,54 @@ class PdfExtractor:
         context.ya_resource_id = ya_doc_meta.resource_id
         
         
-    def log(self, message):
-        message = f"{threading.current_thread().name} {time.strftime('%d-%m-%y %H:%M:%S')} {self.key[-7:]}: {message}"
-        log_file = get_in_workdir(Dirs.LOGS, file=f"content_extraction_{self.key}.log")
-        with open(log_file, "a") as log:
-            log.write(f"{message}\n")
-        print(message)
+    def log(self, message, **fields):
+        self.logger.info(message, fields=fields)
+
+
+    def _account_chunk(self, outcome, started, usage_meta):
+        key = self.key[-7:]
+        CHUNKS.labels(key, outcome).inc()
+        GEMINI_LATENCY.labels("content").observe(time.monotonic() - started)
+        for direction, count in _tokens_fields(usage_meta).items():
+            TOKENS.labels(key, direction.removesuffix("_tokens")).inc(count or 0)
         
 
     def _create_doc_clice(self, _from, _to, pdf_doc, md5):
-        slice_file_path = get_in_workdir(Dirs.DOC_SLICES, md5, file=f"slice-{_from}-{_to}.pdf")
-        if not os.path.exists(slice_file_path):
-            doc_slice = pymupdf.open()
+        return _create_doc_slice(_from, _to, pdf_doc, md5)
+
+
+def fetch_doc(ya_client, doc, config):
+    """
+    Download the document and cut the slices of the first chunks planned for it, the rest are cut
+    by the worker while Gemini extracts the previous ones. Runs in the prefetcher ahead of the
+    workers, so they do not wait for it, or in the worker itself when the document was not prefetched.
+
+    :return: path to the local document and the count of its pages
+    """
+    slices = (config.get('downloads') or {}).get('prefetch_slices', 2)
+    with pinned(doc.md5):
+        with span("prefetch.download", md5=doc.md5):
+            local_doc_path = download_file_locally(ya_client, doc, config)
+        chunked_results_dir = get_in_workdir(Dirs.CHUNKED_RESULTS, doc.md5)
+        with pymupdf.open(local_doc_path) as pdf_doc, span("prefetch.slice", md5=doc.md5):
+            page_count = pdf_doc.page_count
+            chunk_planner = ChunkPlanner(chunked_results_dir, pages_count=page_count)
+            while slices > 0 and (chunk := chunk_planner.next()):
+                if not os.path.exists(os.path.join(chunked_results_dir, f"chunk-{chunk.start}-{chunk.end}.json")):
+                    _create_doc_slice(chunk.start, chunk.end, pdf_doc, doc.md5)
+                    slices -= 1
+    return local_doc_path, page_count
+
+
+def _create_doc_slice(_from, _to, pdf_doc, md5):
+    slice_file_path = get_in_workdir(Dirs.DOC_SLICES, md5, file=f"slice-{_from}-{_to}.pdf")
+    if not os.path.exists(slice_file_path):
+        with pymupdf.open() as doc_slice:
             doc_slice.insert_pdf(pdf_doc, from_page=_from, to_page=_to)
-            doc_slice.save(slice_file_path)
-        return slice_file_path
-
-
-    def _upload_artifacts(self, context):
-        self.log(f"Uploading artifacts to object storage {context.doc.md5}({context.doc.ya_public_url})")
-                    
-        session = create_session(self.config)
-        
-        if context.local_content_path:
-            content_key = f"{context.md5}.zip"
-            content_bucket = self.config["yandex"]["cloud"]['bucket']['content']
-            context.remote_content_url = upload_file(context.local_content_path, content_bucket, content_key, session)
-            
-        if context.local_doc_path:
-            doc_bucket = self.config["yandex"]["cloud"]['bucket']['document']
-            doc_key = os.path.basename(context.local_doc_path)
-            context.remote_doc_url = upload_file(context.local_doc_path, doc_bucket, doc_key, session, skip_if_exists=True)
-        
-        for chunk_path in context.chunk_paths:
-            file_name, _ = os.path.splitext(os.path.basename(chunk_path))
-            file_name_ext = f"{file_name}.zip"
-            key = f"{context.md5}/{file_name_ext}"
-            chunk_path_arc = get_in_workdir(Dirs.CHUNKED_RESULTS, context.md5, file=file_name_ext)
-            with zipfile.ZipFile(chunk_path_arc, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-                zf.write(arcname=f"{file_name}.json", filename=chunk_path)
-                
-            doc_bucket = self.config["yandex"]["cloud"]['bucket']['content_chunks']
-            upload_file(chunk_path_arc, doc_bucket, key, session)
-    
-    
-    def _upsert_document(self, session, context):
-        entity_cls = Document if self.lang_tag == 'tt' else DocumentCrh
-        doc = session.get(entity_cls, context.doc.md5)
-        if context.ya_path and (ya_path := context.ya_path.removeprefix('disk:')) != '/':
-            doc.ya_path = ya_path
-        doc.ya_public_key=context.ya_public_key
-        doc.ya_resource_id=context.ya_resource_id
-
-        doc.content_extraction_method=context.extraction_method
-        doc.document_url = encrypt(context.remote_doc_url, self.config) if doc.sharing_restricted else context.remote_doc_url
-        doc.content_url = context.remote_content_url
-            
-        session.commit()
-        self.log(f"Updating doc details in gsheets {context.doc.md5}({context.doc.ya_public_url})")
+            # an interrupted prefetch must not leave a broken slice behind
+            doc_slice.save(slice_file_path + ".part")
+        os.replace(slice_file_path + ".part", slice_file_path)
+    return slice_file_path
 
 
 def _has_figure_tag_with_missing_attributes(content):
@@ -563,6 +558,12 @@ def _has_figure_tag_with_missing_attributes(content):
     return False
     
 
+def _tokens_fields(usage_meta):
+    if usage_meta:
+        return {"input_tokens": usage_meta.prompt_token_count, "output_tokens": usage_meta.candidates_token_count}
+    return {}
+
+
 def _tokens_info(usage_meta):
     if usage_meta:
         return f"input tokens:{usage_meta.prompt_token_count}, output tokens: {usage_meta.candidates_token_count}, total tokens: {usage_meta.total_token_count}"
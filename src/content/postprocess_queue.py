@@ -0,0 +1,230 @@
+"""
+PDF Postprocessing Queue Module
+
+Extraction workers hold Gemini API keys which are the scarce resource, so they must not wait
+for local CPU-bound work (YOLO figure detection, mdformat, zipping, uploading). This module
+decouples that work from them: an extraction worker only puts its finished `Context` into the
+queue and takes the next document, while a separately sized pool of processes consumes the
+queue.
+
+The queue is durable: every task is spooled into `Dirs.POSTPROCESS_QUEUE` before it is
+submitted and removed only after it was processed, so tasks interrupted by a crash or Ctrl+C
+are picked up again by `resume()` on the next run. A task which cannot be loaded, e.g. its spool
+file is corrupt or its document is gone, is dropped and its document is extracted again.
+
+Classes:
+    PostprocessQueue: Spools contexts and feeds them to the pool of postprocess workers
+
+Functions:
+    postprocess_task(task_path, config, lang_tag): Processes one spooled task in a worker process
+"""
+import json
+import multiprocessing
+import os
+import threading
+import traceback
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from json.decoder import JSONDecodeError
+
+from rich import print
+
+from content.pdf_context import Context
+from content.pdf_postprocess import postprocess, NoBboxError
+from dirs import Dirs
+from models import Document, DocumentCrh
+from s3 import upload_file, create_session
+from logs import get_logger, process_queue, setup_child_logging
+from spans import span, profiled
+from utils import get_in_workdir, get_session, encrypt
+
+
+class PostprocessQueue:
+
+    def __init__(self, config, lang_tag, channel, workers):
+        self.config = config
+        self.lang_tag = lang_tag
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.futures = {}
+        # spawn instead of fork: the parent process runs extraction threads at the same time
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            # records of the workers are written by the logging listener of this process
+            initializer=setup_child_logging,
+            initargs=(process_queue(),),
+        )
+
+
+    def put(self, context):
+        task_path = get_in_workdir(Dirs.POSTPROCESS_QUEUE, file=f"{context.md5}.json")
+        with open(f"{task_path}.part", "w") as f:
+            json.dump(context.to_dict(), f, ensure_ascii=False, indent=4)
+        os.replace(f"{task_path}.part", task_path)
+        self._submit(context.md5, task_path)
+
+
+    def resume(self):
+        """Submit tasks left in the spool by the previous runs"""
+        spool_dir = get_in_workdir(Dirs.POSTPROCESS_QUEUE)
+        for file_name in sorted(os.listdir(spool_dir)):
+            md5, ext = os.path.splitext(file_name)
+            if ext == ".json":
+                print(f"Resuming postprocessing of document {md5}")
+                self._submit(md5, os.path.join(spool_dir, file_name))
+
+
+    def pending(self):
+        """Md5s of documents which are queued for postprocessing or being postprocessed right now"""
+        with self.lock:
+            return set(self.futures.keys())
+
+
+    def join(self):
+        with self.lock:
+            futures = list(self.futures.values())
+        for f in futures:
+            f.exception()
+        self.executor.shutdown(wait=True)
+
+
+    def abort(self):
+        """Stop without waiting, unfinished tasks stay in the spool"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+    def _submit(self, md5, task_path):
+        with self.lock:
+            if md5 in self.futures:
+                return
+            future = self.executor.submit(postprocess_task, task_path, self.config, self.lang_tag)
+            self.futures[md5] = future
+        future.add_done_callback(lambda f: self._on_done(md5, f))
+
+
+    def _on_done(self, md5, future):
+        with self.lock:
+            self.futures.pop(md5, None)
+        if future.cancelled():
+            return
+        if e := future.exception():
+            print(f"[red]Postprocessing of document {md5} crashed: {e}[/red]")
+            self.channel.retry_doc(md5, error=repr(e))
+            return
+        result = future.result()
+        if result["status"] == "done":
+            self.channel.complete_doc(md5)
+        elif result["status"] == "repairable":
+            self.channel.add_repairable_doc(md5, error=result.get("error"))
+        else:
+            self.channel.retry_doc(md5, error=result.get("error"))
+
+
+def postprocess_task(task_path, config, lang_tag):
+    md5 = os.path.splitext(os.path.basename(task_path))[0]
+    try:
+        context = _load_task(task_path, lang_tag)
+    except Exception as e:
+        # the task is dropped, otherwise every run would resume it again, the document is extracted anew
+        log(f"Could not load postprocessing task of doc {md5}: {e} \n{traceback.format_exc()}")
+        os.remove(task_path)
+        return {"md5": md5, "status": "failed", "error": repr(e)}
+
+    doc = context.doc
+    try:
+        log(f"Postprocessing document {context.md5}({doc.ya_public_url})")
+        with profiled(context.md5, "postprocess", config), span("postprocess", md5=context.md5):
+            postprocessed = postprocess(context, config)
+
+            # write postprocessed content to a file
+            context.formatted_response_md = get_in_workdir(Dirs.CONTENT, file=f"{context.md5}-formatted.md")
+            with open(context.formatted_response_md, 'w') as f:
+                f.write(postprocessed)
+
+            # create a zip file with the content
+            context.local_content_path = get_in_workdir(Dirs.CONTENT, file=f"{context.md5}.zip")
+            with span("zip", md5=context.md5), zipfile.ZipFile(context.local_content_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+                zf.write(arcname=f"{context.md5}.md", filename=context.formatted_response_md)
+
+            # upload the content to S3
+            with span("upload", md5=context.md5):
+                _upload_artifacts(context, config)
+
+            # update the document in the database
+            with span("database", md5=context.md5), get_session() as session:
+                _upsert_document(session, context, config, lang_tag)
+
+        log(f"[bold green]Content extraction complete {context.doc.md5}({context.doc.ya_public_url})[/bold green]")
+        result = {"md5": context.md5, "status": "done"}
+    except NoBboxError as e:
+        log(f"No bbox in document {e.md5}")
+        result = {"md5": context.md5, "status": "repairable", "error": f"No bbox in document {e.md5}"}
+    except (JSONDecodeError, RecursionError, IndexError) as e:
+        # broken output of Gemini, e.g. malformed figure descriptions, is repaired manually
+        log(f"Could not postprocess doc {context.md5}({doc.ya_public_url}): {e} \n{traceback.format_exc()}")
+        result = {"md5": context.md5, "status": "repairable", "error": repr(e)}
+    except Exception as e:
+        log(f"Could not postprocess doc {context.md5}({doc.ya_public_url}): {e} \n{traceback.format_exc()}")
+        result = {"md5": context.md5, "status": "failed", "error": repr(e)}
+
+    os.remove(task_path)
+    return result
+
+
+def _load_task(task_path, lang_tag):
+    with open(task_path, "r") as f:
+        data = json.load(f)
+    entity_cls = Document if lang_tag == 'tt' else DocumentCrh
+    with get_session() as session:
+        doc = session.get(entity_cls, data["doc_md5"])
+    if doc is None:
+        raise LookupError(f"Document {data['doc_md5']} is not found in {entity_cls.__tablename__}")
+    return Context.from_dict(doc, data)
+
+
+def _upload_artifacts(context, config):
+    log(f"Uploading artifacts to object storage {context.doc.md5}({context.doc.ya_public_url})")
+
+    session = create_session(config)
+
+    if context.local_content_path:
+        content_key = f"{context.md5}.zip"
+        content_bucket = config["yandex"]["cloud"]['bucket']['content']
+        context.remote_content_url = upload_file(context.local_content_path, content_bucket, content_key, session)
+
+    if context.local_doc_path:
+        doc_bucket = config["yandex"]["cloud"]['bucket']['document']
+        doc_key = os.path.basename(context.local_doc_path)
+        context.remote_doc_url = upload_file(context.local_doc_path, doc_bucket, doc_key, session, skip_if_exists=True)
+
+    for chunk_path in context.chunk_paths:
+        file_name, _ = os.path.splitext(os.path.basename(chunk_path))
+        file_name_ext = f"{file_name}.zip"
+        key = f"{context.md5}/{file_name_ext}"
+        chunk_path_arc = get_in_workdir(Dirs.CHUNKED_RESULTS, context.md5, file=file_name_ext)
+        with zipfile.ZipFile(chunk_path_arc, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+            zf.write(arcname=f"{file_name}.json", filename=chunk_path)
+
+        doc_bucket = config["yandex"]["cloud"]['bucket']['content_chunks']
+        upload_file(chunk_path_arc, doc_bucket, key, session)
+
+
+def _upsert_document(session, context, config, lang_tag):
+    entity_cls = Document if lang_tag == 'tt' else DocumentCrh
+    doc = session.get(entity_cls, context.doc.md5)
+    if context.ya_path and (ya_path := context.ya_path.removeprefix('disk:')) != '/':
+        doc.ya_path = ya_path
+    doc.ya_public_key=context.ya_public_key
+    doc.ya_resource_id=context.ya_resource_id
+
+    doc.content_extraction_method=context.extraction_method
+    doc.document_url = encrypt(context.remote_doc_url, config) if doc.sharing_restricted else context.remote_doc_url
+    doc.content_url = context.remote_content_url
+
+    session.commit()
+    log(f"Updating doc details in gsheets {context.doc.md5}({context.doc.ya_public_url})")
+
+
+def log(message):
+    get_logger("content_postprocessing").info(message)
@@ -0,0 +1,90 @@
+"""
+Text Normalization Module
+
+Cleanup rules applied by the extractors to the markdown they produce. Instead of running one
+`re.sub` per rule, every rule set is compiled once into a single alternation of named groups,
+and a callback dispatches each match to the replacement of the rule that matched. The whole
+document is walked and copied only once, no matter how many rules are in the set.
+
+Rules are evaluated in a single left-to-right scan over the original text: at any position the
+first rule of the set that matches wins, and `^` anchors refer to the line starts of the
+original text. Applied one after another, a rule removing the start of a line exposes the rest
+of the line to the rules anchored at line starts. So such rules take over the rest of the chain
+themselves, e.g. a removed empty image followed by a hyphen gives an em dash. The equivalence
+with the rules applied one after another is checked by `tests/test_text_normalization.py`.
+
+Pdf documents are not normalized here: their rules are mostly a plain `str.replace`, which is
+faster than any regex scan, see `content.pdf_postprocess`.
+
+Every rule declares the characters its matches start with. They are combined into a lookahead
+in front of the alternation, so that the scan skips positions where no rule can match instead
+of trying every alternative there.
+
+Classes:
+    Rule: A pattern with its replacement
+    Normalizer: A compiled set of rules
+
+Rule sets:
+    EPUB_NORMALIZER: Cleanup of markdown converted from EPUB documents
+    DOC_LIKE_NORMALIZER: Cleanup of markdown converted by pandoc
+"""
+import re
+from dataclasses import dataclass
+from typing import Callable, Union
+
+
+@dataclass(frozen=True)
+class Rule:
+    pattern: str
+    replacement: Union[str, Callable[[re.Match], str]]
+    # characters a match can start with, they let the scan skip positions where no rule can match
+    starts: str
+    dotall: bool = False
+
+
+class Normalizer:
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.replacements = {}
+        alternatives = []
+        starts = set()
+        for idx, rule in enumerate(self.rules):
+            name = f"r{idx}"
+            self.replacements[name] = rule.replacement
+            # flags scoped to the single alternative, the rest of the rules are not affected
+            pattern = f"(?s:{rule.pattern})" if rule.dotall else rule.pattern
+            alternatives.append(f"(?P<{name}>{pattern})")
+            starts.update(rule.starts)
+        # without the lookahead every alternative would be tried at every position of the text
+        prefilter = "".join(re.escape(c) for c in sorted(starts))
+        self.pattern = re.compile(f"(?=[{prefilter}])(?:{'|'.join(alternatives)})", flags=re.MULTILINE)
+
+
+    def __call__(self, text):
+        return self.pattern.sub(self._dispatch, text)
+
+
+    def _dispatch(self, match):
+        replacement = self.replacements[match.lastgroup]
+        return replacement if isinstance(replacement, str) else replacement(match)
+
+
+def _exposed_dash(match):
+    """Em dash for the hyphen the removed start of the line is followed by, nothing otherwise"""
+    return '— ' if match.group().rstrip(' ').endswith('-') else ''
+
+
+# Replace hyphen + space at beginning of lines with em dash + space
+LEADING_DASH = Rule(r'^- ?', '— ', '-')
+# the empty image at the start of the line is removed, then the hyphen following it is at the start of the line
+LEADING_EMPTY_IMAGE = Rule(r"^!\[\]\(.*?\)\s*(?:- ?)?", _exposed_dash, '!')
+# the same for the prolog, it can be followed by an empty image too
+XML_PROLOG = Rule(r"^xml version='1\.0' encoding='utf-8'\?\s*(?:!\[\]\(.*?\)\s*)?(?:- ?)?", _exposed_dash, 'x')
+IMAGE = Rule(r'!\[.*?\]\(.*?\)', '', '!')
+HTML_IMAGE = Rule(r'<img\s+[^>]*src="[^"]+"[^>]*>', '', '<')
+PANDOC_RAW_HTML_LINK = Rule(r'dN=`?.*?</a>`?\{=html\}', '', 'd', dotall=True)
+
+
+EPUB_NORMALIZER = Normalizer([XML_PROLOG, LEADING_EMPTY_IMAGE, LEADING_DASH, IMAGE])
+DOC_LIKE_NORMALIZER = Normalizer([LEADING_EMPTY_IMAGE, LEADING_DASH, IMAGE, HTML_IMAGE, PANDOC_RAW_HTML_LINK])
@@ -13,6 +13,11 @@ class Dirs(Enum):
     WIPING_PLAN = "misc/wiping_plan"
     PROMPTS = "misc/prompts"
     LOGS = "misc/logs"
+    POSTPROCESS_QUEUE = "misc/postprocess_queue"
+    MD5_CACHE = "misc/md5_cache"
+    CACHE_PINS = "misc/cache_pins"
+    METRICS = "misc/metrics"
+    PROFILES = "misc/profiles"
     BOXES_PLOTS = "misc/plots"
     PREDICTIONS = "predictions"
     PARQUET = "parquet"
@@ -0,0 +1,211 @@
+"""
+Downloads Module
+
+Downloads documents by Yandex.Disk public links. The public link is resolved into a direct link
+to the file, which supports HTTP Range requests, so:
+- the file is written into a `.part` file and an interrupted download continues from where it
+  stopped, on the next attempt or on the next run
+- large files are fetched in segments over several parallel connections, the completed segments
+  are recorded next to the `.part` file and are not fetched again after an interruption
+- the MD5 hash is calculated while the file is downloaded, the `.part` file is renamed to the final
+  name only after the hash matches the expected one
+
+The count of simultaneous connections is limited for the whole process, no matter how many
+documents are downloaded in parallel.
+
+Functions:
+    download_public(public_url, local_path, expected_md5, config): Downloads and verifies the file
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from rich import print
+
+PUBLIC_DOWNLOAD_API = "https://cloud-api.yandex.net/v1/disk/public/resources/download"
+
+# files larger than this are fetched in segments over parallel connections
+SEGMENTED_THRESHOLD = 64 * 1024 * 1024
+SEGMENT_SIZE = 16 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+ATTEMPTS = 5
+TIMEOUT = 60
+
+_limiter_lock = threading.Lock()
+_limiter = None
+
+
+class DownloadError(Exception):
+    pass
+
+
+class LinkResolutionError(DownloadError):
+    pass
+
+
+def download_public(public_url, local_path, expected_md5, config):
+    """
+    Download the file by public link into `local_path` and verify its hash.
+
+    :raises LinkResolutionError: if the public link can not be resolved into the direct link
+    :raises DownloadError: if the file could not be downloaded or it has another hash
+    """
+    settings = config.get('downloads') or {}
+    proxies = {"http": config['proxy'], "https": config['proxy']} if config.get('proxy') else None
+    part_path = f"{local_path}.part"
+
+    # the hash is calculated while downloading, the downloaded file is not read once again
+    href, size = _resolve(public_url, proxies)
+    if size and size > SEGMENTED_THRESHOLD:
+        md5 = _download_segmented(href, part_path, size, settings.get('connections_per_file', 4), proxies, config)
+    else:
+        md5 = _download_stream(href, part_path, proxies, config)
+
+    if md5 != expected_md5:
+        os.remove(part_path)
+        raise DownloadError(f"Downloaded file {local_path} has md5 {md5}, expected {expected_md5}")
+    os.replace(part_path, local_path)
+    return md5
+
+
+def _resolve(public_url, proxies):
+    """Resolve public link into the direct link to the file and the size of the file if it is known"""
+    try:
+        response = requests.get(PUBLIC_DOWNLOAD_API, params={"public_key": public_url}, proxies=proxies, timeout=TIMEOUT)
+        response.raise_for_status()
+        href = response.json()["href"]
+        head = requests.head(href, allow_redirects=True, proxies=proxies, timeout=TIMEOUT)
+        head.raise_for_status()
+    except (requests.RequestException, KeyError, ValueError) as e:
+        raise LinkResolutionError(f"Could not resolve public link {public_url}: {e}") from e
+
+    size = int(head.headers.get("Content-Length") or 0)
+    ranges = head.headers.get("Accept-Ranges") == "bytes"
+    # the direct link is signed and redirects, further requests go straight to the final location
+    return head.url, size if ranges else None
+
+
+def _download_stream(href, part_path, proxies, config):
+    """Download the file into `part_path`, continuing the existing part, and return its MD5 hash"""
+    from utils import _HashingWriter
+
+    hash_md5 = hashlib.md5()
+    hashed = 0
+    for attempt in range(1, ATTEMPTS + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with _connection(config), requests.get(href, headers=headers, stream=True, proxies=proxies, timeout=TIMEOUT) as response:
+                if response.status_code == 416:
+                    # the part file is already complete
+                    return _hash_part(part_path, hash_md5, hashed, offset).hexdigest()
+                response.raise_for_status()
+                if response.status_code == 206:
+                    # only the part left by the previous run is read, the rest is hashed while written
+                    _hash_part(part_path, hash_md5, hashed, offset)
+                    mode = "ab"
+                else:
+                    # server ignored the range, the file is downloaded from the beginning
+                    hash_md5 = hashlib.md5()
+                    mode = "wb"
+                with open(part_path, mode) as f:
+                    writer = _HashingWriter(f, hash_md5)
+                    try:
+                        for chunk in response.iter_content(BUFFER_SIZE):
+                            writer.write(chunk)
+                    finally:
+                        hashed = f.tell()
+            return hash_md5.hexdigest()
+        except requests.RequestException as e:
+            print(f"[yellow]Download of {os.path.basename(part_path)} interrupted, attempt {attempt}/{ATTEMPTS}: {e}[/yellow]")
+            time.sleep(min(2 ** attempt, 30))
+    raise DownloadError(f"Could not download {os.path.basename(part_path)} in {ATTEMPTS} attempts")
+
+
+def _download_segmented(href, part_path, size, connections, proxies, config):
+    state_path = f"{part_path}.segments"
+    done = set()
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        if state["size"] == size:
+            done = set(state["done"])
+    if not done:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+
+    state_lock = threading.Lock()
+
+    def _mark_done(start):
+        with state_lock:
+            done.add(start)
+            with open(f"{state_path}.tmp", "w") as f:
+                json.dump({"size": size, "done": sorted(done)}, f)
+            os.replace(f"{state_path}.tmp", state_path)
+
+    # MD5 can not be combined from the hashes of segments, so every segment is hashed in the order
+    # of the file as soon as it and all segments before it are written, while the rest are still
+    # downloaded, its pages are still in the page cache then
+    hash_md5 = hashlib.md5()
+    segments = [(start, min(start + SEGMENT_SIZE, size) - 1) for start in range(0, size, SEGMENT_SIZE)]
+    fd = os.open(part_path, os.O_RDWR)
+    try:
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="segment") as executor:
+            futures = {start: executor.submit(_download_segment, href, fd, start, end, proxies, config) for start, end in segments if start not in done}
+            for start, end in segments:
+                if start in futures:
+                    futures[start].result()
+                    _mark_done(start)
+                _hash_part(fd, hash_md5, start, end + 1)
+    finally:
+        os.close(fd)
+    os.remove(state_path)
+    return hash_md5.hexdigest()
+
+
+def _hash_part(path_or_fd, hash_md5, start, end):
+    """Update the hash with the bytes of the file from `start` to `end`, exclusive"""
+    fd = os.open(path_or_fd, os.O_RDONLY) if isinstance(path_or_fd, str) else path_or_fd
+    try:
+        while start < end:
+            data = os.pread(fd, min(BUFFER_SIZE, end - start), start)
+            if not data:
+                break
+            hash_md5.update(data)
+            start += len(data)
+    finally:
+        if fd is not path_or_fd:
+            os.close(fd)
+    return hash_md5
+
+
+def _download_segment(href, fd, start, end, proxies, config):
+    offset = start
+    for attempt in range(1, ATTEMPTS + 1):
+        try:
+            headers = {"Range": f"bytes={offset}-{end}"}
+            with _connection(config), requests.get(href, headers=headers, stream=True, proxies=proxies, timeout=TIMEOUT) as response:
+                if response.status_code != 206:
+                    raise DownloadError(f"Server does not support ranges, status {response.status_code}")
+                for chunk in response.iter_content(BUFFER_SIZE):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+            if offset > end:
+                return
+        except requests.RequestException as e:
+            print(f"[yellow]Segment {start}-{end} interrupted at {offset}, attempt {attempt}/{ATTEMPTS}: {e}[/yellow]")
+            time.sleep(min(2 ** attempt, 30))
+    raise DownloadError(f"Could not download segment {start}-{end} in {ATTEMPTS} attempts")
+
+
+def _connection(config):
+    """Semaphore limiting the count of simultaneous connections of the process"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = threading.BoundedSemaphore((config.get('downloads') or {}).get('max_connections', 8))
+        return _limiter
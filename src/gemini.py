@@ -3,6 +3,7 @@ from google.genai import types
 import subprocess
 import os
 from utils import workdir
+from spans import span
 import time
 
     
@@ -35,7 +36,8 @@ def create_client(api_key):
 def gemini_api(prompt, model, client, files = {}, temperature=0.1, schema=None, timeout_sec=60*10):
     uploaded_files = []
     for path, mime_type in files.items():
-        _f = upload_and_wait(client, path, mime_type)
+        with span("gemini.upload"):
+            _f = upload_and_wait(client, path, mime_type)
         uploaded_files.append(_f)
     prompt.extend(uploaded_files)
     resp_stream = client.models.generate_content_stream(
@@ -0,0 +1,91 @@
+"""
+Bounding Box Geometry Module
+
+Vectorized helpers for comparing sets of bounding boxes produced by different layout models
+(Gemini figure boxes, YOLO DocLayNet detections, Surya layouts). All boxes are expected in
+`[x0, y0, x1, y1]` format in the same coordinate space.
+
+Functions:
+    pairwise_iou(boxes_a, boxes_b): IoU matrix of shape (len(a), len(b))
+    centroids(boxes): Centroids of the boxes, shape (n, 2)
+    pairwise_centroid_distance(boxes_a, boxes_b): Euclidean distance matrix between centroids
+    match_boxes(boxes_a, boxes_b, ...): Optimal one-to-one assignment of boxes by IoU and centroid distance
+"""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# cost assigned to pairs that must never be matched, it is far above any valid cost
+_FORBIDDEN_COST = 1e6
+
+
+def _as_boxes(boxes):
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def pairwise_iou(boxes_a, boxes_b):
+    a = _as_boxes(boxes_a)
+    b = _as_boxes(boxes_b)
+
+    xa = np.maximum(a[:, None, 0], b[None, :, 0])
+    ya = np.maximum(a[:, None, 1], b[None, :, 1])
+    xb = np.minimum(a[:, None, 2], b[None, :, 2])
+    yb = np.minimum(a[:, None, 3], b[None, :, 3])
+
+    inter_area = np.clip(xb - xa, 0, None) * np.clip(yb - ya, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union_area = area_a[:, None] + area_b[None, :] - inter_area
+
+    iou = np.zeros_like(inter_area)
+    np.divide(inter_area, union_area, out=iou, where=union_area > 0)
+    return iou
+
+
+def centroids(boxes):
+    b = _as_boxes(boxes)
+    return np.stack(((b[:, 0] + b[:, 2]) / 2, (b[:, 1] + b[:, 3]) / 2), axis=1)
+
+
+def pairwise_centroid_distance(boxes_a, boxes_b):
+    ca = centroids(boxes_a)
+    cb = centroids(boxes_b)
+    return np.hypot(ca[:, None, 0] - cb[None, :, 0], ca[:, None, 1] - cb[None, :, 1])
+
+
+def match_boxes(boxes_a, boxes_b, centroid_distance_threshold, iou_threshold=0.5):
+    """
+    Find the optimal one-to-one matching between two sets of boxes.
+
+    A pair is a candidate if its IoU is above `iou_threshold`, or, failing that, if the distance
+    between the centroids is below `centroid_distance_threshold`. IoU candidates always take
+    precedence over distance candidates. Among the candidates the assignment maximizing the
+    number of matches and then their quality is chosen by the Hungarian algorithm.
+
+    :return: list of tuples `(idx_a, idx_b, method, score)` where method is either 'iou' or
+             'centroid distance' and score is the IoU or the distance respectively
+    """
+    a = _as_boxes(boxes_a)
+    b = _as_boxes(boxes_b)
+    if not len(a) or not len(b):
+        return []
+
+    iou = pairwise_iou(a, b)
+    dist = pairwise_centroid_distance(a, b)
+    by_iou = iou > iou_threshold
+    by_dist = ~by_iou & (dist < centroid_distance_threshold)
+
+    # IoU matches cost in [0, 1), distance matches cost in [1, 2), so any IoU match is preferred
+    cost = np.full(iou.shape, _FORBIDDEN_COST)
+    cost[by_iou] = 1 - iou[by_iou]
+    if centroid_distance_threshold > 0:
+        cost[by_dist] = 1 + dist[by_dist] / centroid_distance_threshold
+
+    rows, cols = linear_sum_assignment(cost)
+    matches = []
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        if by_iou[i, j]:
+            matches.append((i, j, 'iou', float(iou[i, j])))
+        elif by_dist[i, j]:
+            matches.append((i, j, 'centroid distance', float(dist[i, j])))
+    return matches
@@ -0,0 +1,346 @@
+"""
+Jobs Module
+
+Durable state of the pipelines in the database, shared by all processes and hosts working with
+it. Every document a pipeline has to process is a row of the `job` table. A worker claims a
+batch of jobs by taking a lease on them: the jobs are `running` and owned by the worker until
+the lease expires. A heartbeat thread renews the leases of the jobs held by the process, so a
+job of a crashed process is claimed again by another one once its lease expires, and a job is
+never processed by two live workers at once.
+
+Failed attempts are retried with a delay until `max_attempts`, then the job is `failed`, like
+documents which could not be processed at all. `repairable` jobs wait for a manual repair. Both
+are retried only when requested explicitly, see `JobQueue.enqueue(..., reset=True)`. Pipelines
+which select their documents in batches without claiming them, like the metadata extraction,
+only record the failed jobs and skip them with `JobQueue.without`.
+
+Gemini API keys which have exhausted their daily quota are stored in the database as well, by
+the hash of the key and the quota period.
+
+Leases are compared with the clocks of the hosts, they are expected to be synchronized.
+
+Classes:
+    JobQueue: Durable queue of the jobs of a pipeline with lease-based claiming
+
+Functions:
+    exhausted_keys(keys): Keys exhausted in the current quota period
+    add_exhausted_keys(keys): Marks the keys as exhausted in the current quota period
+    quota_period(): Current period of the daily quotas of Gemini
+"""
+import hashlib
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+from rich import print
+from sqlalchemy import Select, case, exists, func, literal, null, select, update
+from sqlalchemy.orm import Session
+
+from models import Job, ExhaustedKey
+from utils import get_engine
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+REPAIRABLE = "repairable"
+
+LEASE_SECONDS = 15 * 60
+MAX_ATTEMPTS = 5
+RETRY_DELAY_SECONDS = 5 * 60
+
+# rows per insert statement
+_BATCH = 1000
+
+
+class JobQueue:
+    """
+    Durable queue of the jobs of a pipeline.
+
+    :param pipeline: name of the pipeline, e.g. 'content_tt', the pipelines of documents of different tables have different names
+    :param config: `jobs` section of the config sets `lease_seconds`, `max_attempts` and `retry_delay_seconds`
+    :param owner: name of the worker in leases, `host:pid` by default
+    """
+
+    def __init__(self, pipeline, config, owner=None):
+        settings = config.get('jobs') or {}
+        self.pipeline = pipeline
+        self.lease = timedelta(seconds=settings.get('lease_seconds', LEASE_SECONDS))
+        self.max_attempts = settings.get('max_attempts', MAX_ATTEMPTS)
+        self.retry_delay = timedelta(seconds=settings.get('retry_delay_seconds', RETRY_DELAY_SECONDS))
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._engine = get_engine()
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+
+    def enqueue(self, md5s, status=PENDING, reset=False):
+        """
+        Add jobs of the documents, existing jobs are kept as they are unless `reset` is set
+
+        :param md5s: md5s of the documents, a list or a select of one column. The select is
+            expected to give all documents which need processing, so done jobs among them are
+            pending again
+        :param status: status of the added jobs, e.g. to import the state of earlier runs
+        :param reset: jobs which are not leased right now are pending again and have no failed attempts
+        """
+        now = _now()
+        with Session(self._engine) as session:
+            if isinstance(md5s, Select):
+                source = md5s.subquery()
+                md5 = list(source.c)[0]
+                rows = select(
+                    literal(self.pipeline), md5, literal(status), literal(0), literal(now), literal(now),
+                ).where(
+                    ~exists().where((Job.pipeline == self.pipeline) & (Job.md5 == md5))
+                ).distinct()
+                session.execute(_insert(session).from_select(
+                    ["pipeline", "md5", "status", "attempts", "next_run_at", "updated_at"], rows,
+                ))
+                # the documents of done jobs need processing again, e.g. their content was removed
+                session.execute(
+                    update(Job)
+                    .where(self._own((Job.status == DONE) & Job.md5.in_(select(md5))))
+                    .values(status=PENDING, attempts=0, next_run_at=now, updated_at=now)
+                )
+            else:
+                md5s = list(md5s)
+                for idx in range(0, len(md5s), _BATCH):
+                    rows = [
+                        {"pipeline": self.pipeline, "md5": md5, "status": status, "attempts": 0, "next_run_at": now, "updated_at": now}
+                        for md5 in md5s[idx:idx + _BATCH]
+                    ]
+                    session.execute(_insert(session).values(rows).on_conflict_do_nothing())
+                    if reset:
+                        session.execute(
+                            update(Job)
+                            .where(self._own(Job.md5.in_(md5s[idx:idx + _BATCH])) & ~self._leased(now))
+                            .values(status=status, attempts=0, last_error=None, lease_owner=None, lease_expires_at=None, next_run_at=now, updated_at=now)
+                        )
+            session.commit()
+
+
+    def claim(self, limit, md5s=None):
+        """
+        Lease up to `limit` jobs which are due: pending ones and running ones whose lease has
+        expired, their attempt is counted as failed. A job whose lease expired `max_attempts`
+        times, e.g. its document crashes the worker, is failed instead. Returns md5s of the
+        claimed jobs.
+
+        :param md5s: claim only jobs of these documents
+        """
+        while True:
+            now = _now()
+            claimable = self._own(
+                ((Job.status == PENDING) & (Job.next_run_at <= now))
+                |
+                ((Job.status == RUNNING) & (Job.lease_expires_at < now))
+            )
+            if md5s is not None:
+                claimable &= Job.md5.in_(list(md5s))
+            # all expressions of the update see the values of the row before it
+            exhausted = (Job.status == RUNNING) & (Job.attempts + 1 >= self.max_attempts)
+            # other workers skip the rows locked by this one instead of waiting for them, a no-op in SQLite where writes are serialized
+            candidates = select(Job.md5).where(claimable).order_by(Job.next_run_at).limit(limit).with_for_update(skip_locked=True)
+            with Session(self._engine) as session:
+                rows = session.execute(
+                    update(Job)
+                    .where(claimable & Job.md5.in_(candidates.scalar_subquery()))
+                    .values(
+                        status=case((exhausted, FAILED), else_=RUNNING),
+                        attempts=case((Job.status == RUNNING, Job.attempts + 1), else_=Job.attempts),
+                        lease_owner=case((exhausted, null()), else_=literal(self.owner)),
+                        lease_expires_at=case((exhausted, null()), else_=literal(now + self.lease)),
+                        last_error=case((exhausted, literal("The lease of the job expired in every attempt")), else_=Job.last_error),
+                        updated_at=now,
+                    )
+                    .returning(Job.md5, Job.status)
+                ).all()
+                session.commit()
+            claimed = [md5 for md5, status in rows if status == RUNNING]
+            # failed jobs took the places of the batch, claim the next ones
+            if claimed or not rows:
+                break
+        if claimed:
+            self._start_heartbeat()
+        return claimed
+
+
+    def adopt(self, md5s):
+        """Take over the leases of the jobs, e.g. of the tasks left in the postprocessing spool by the previous run of this host"""
+        md5s = list(md5s)
+        if not md5s:
+            return
+        now = _now()
+        self._update(
+            Job.md5.in_(md5s) & (Job.status == RUNNING),
+            lease_owner=self.owner, lease_expires_at=now + self.lease, updated_at=now,
+        )
+        self._start_heartbeat()
+
+
+    def complete(self, md5):
+        self._update(Job.md5 == md5, status=DONE, lease_owner=None, lease_expires_at=None, last_error=None, updated_at=_now())
+
+
+    def release(self, md5, error=None, attempt=False):
+        """
+        Return the job to the queue. A failed attempt is retried after the delay, the job fails
+        after `max_attempts` of them. Without `attempt`, e.g. when the API key of the worker is
+        exhausted, the job is due immediately.
+        """
+        now = _now()
+        values = dict(status=PENDING, lease_owner=None, lease_expires_at=None, next_run_at=now, updated_at=now)
+        if attempt:
+            values.update(
+                status=case((Job.attempts + 1 >= self.max_attempts, FAILED), else_=PENDING),
+                attempts=Job.attempts + 1,
+                last_error=_truncate(error),
+                next_run_at=now + self.retry_delay,
+            )
+        self._update((Job.md5 == md5) & (Job.status == RUNNING), **values)
+
+
+    def fail(self, md5, error=None, repairable=False):
+        """Fail the job, it is added if the document has none, e.g. in pipelines which do not claim jobs"""
+        now = _now()
+        values = dict(
+            status=REPAIRABLE if repairable else FAILED, lease_owner=None, lease_expires_at=None,
+            last_error=_truncate(error), updated_at=now,
+        )
+        with Session(self._engine) as session:
+            session.execute(
+                _insert(session)
+                .values(pipeline=self.pipeline, md5=md5, attempts=0, next_run_at=now, **values)
+                .on_conflict_do_update(index_elements=[Job.pipeline, Job.md5], set_=values)
+            )
+            session.commit()
+
+
+    def import_file(self, file, status):
+        """Add jobs of the md5s listed line by line in the file, if it exists, jobs which exist already are kept as they are"""
+        if os.path.exists(file):
+            with open(file, "r") as f:
+                self.enqueue([line.strip() for line in f if line.strip()], status=status)
+
+
+    def without(self, md5, *statuses):
+        """
+        Predicate of documents having no job with one of the statuses, a NOT EXISTS over the
+        indexed job table instead of a list of md5s
+
+        :param md5: md5 column of the selected documents, e.g. `Document.md5`
+        """
+        return ~exists().where(self._own((Job.md5 == md5) & Job.status.in_(statuses)))
+
+
+    def md5s(self, *statuses):
+        with Session(self._engine) as session:
+            return set(session.scalars(select(Job.md5).where(self._own(Job.status.in_(statuses)))))
+
+
+    def next_due(self, md5s=None):
+        """Seconds until the earliest pending job is due, None if there are no pending jobs"""
+        predicate = self._own(Job.status == PENDING)
+        if md5s is not None:
+            predicate &= Job.md5.in_(list(md5s))
+        with Session(self._engine) as session:
+            next_run_at = session.scalar(select(func.min(Job.next_run_at)).where(predicate))
+        return max(0.0, (next_run_at - _now()).total_seconds()) if next_run_at else None
+
+
+    def close(self, keep=()):
+        """Stop renewing the leases, the jobs held by this process are returned to the queue except the ones in `keep`"""
+        self._stopped.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        now = _now()
+        self._update(
+            (Job.lease_owner == self.owner) & (Job.status == RUNNING) & Job.md5.not_in(list(keep)),
+            status=PENDING, lease_owner=None, lease_expires_at=None, next_run_at=now, updated_at=now,
+        )
+
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew_leases, name="jobs-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+
+    def _renew_leases(self):
+        while not self._stopped.wait(self.lease.total_seconds() / 3):
+            try:
+                now = _now()
+                self._update((Job.lease_owner == self.owner) & (Job.status == RUNNING), lease_expires_at=now + self.lease)
+            except Exception as e:
+                # the next beat may succeed before the leases expire
+                print(f"Could not renew leases of jobs: {e}")
+
+
+    def _update(self, predicate, **values):
+        with Session(self._engine) as session:
+            session.execute(update(Job).where(self._own(predicate)).values(**values))
+            session.commit()
+
+
+    def _own(self, predicate):
+        return (Job.pipeline == self.pipeline) & predicate
+
+
+    def _leased(self, now):
+        return (Job.status == RUNNING) & (Job.lease_expires_at >= now)
+
+
+def exhausted_keys(keys):
+    """Keys among the given ones which have exhausted their quota in the current period"""
+    by_hash = {_hash(key): key for key in keys}
+    with Session(get_engine()) as session:
+        hashes = session.scalars(select(ExhaustedKey.key_hash).where(ExhaustedKey.period == quota_period()))
+        return {by_hash[h] for h in hashes if h in by_hash}
+
+
+def add_exhausted_keys(keys):
+    rows = [{"key_hash": _hash(key), "period": quota_period(), "exhausted_at": _now()} for key in keys]
+    if not rows:
+        return
+    with Session(get_engine()) as session:
+        session.execute(_insert(session, ExhaustedKey).values(rows).on_conflict_do_nothing())
+        session.commit()
+
+
+def quota_period():
+    """Period like '20250810_1' or '20250811_0', quotas of Gemini are reset at 09:00 UTC"""
+    now = datetime.now(timezone.utc)
+
+    # If before 09:00 UTC, we are still in the *previous day's* second bucket
+    if now.hour < 9:
+        date = (now - timedelta(days=1)).strftime("%Y%m%d")
+        bucket_num = 1
+    else:
+        date = now.strftime("%Y%m%d")
+        bucket_num = 0
+
+    return f"{date}_{bucket_num}"
+
+
+def _insert(session, table=Job):
+    """Insert statement supporting `on_conflict_do_nothing` in the dialect of the database"""
+    if session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
+def _hash(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _now():
+    # naive UTC, the columns are timezone-less in both SQLite and Postgres
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _truncate(error, limit=2000):
+    return str(error)[:limit] if error is not None else None
@@ -0,0 +1,161 @@
+"""
+Logs Module
+
+Extraction workers log from many threads at once. A logging call only puts the record into a
+queue, and a single listener thread formats it, writes it to the console and appends it as a
+JSON line to the rotating log file in `Dirs.LOGS`, `{name}.jsonl` per logger name. Besides the
+message, records carry structured fields: the md5 of the document, the chunk range, the suffix
+of the API key, tokens, latency, so the logs can be filtered and aggregated with `jq`.
+
+Child processes send their records to the listener of the parent process through a
+multiprocessing queue, see `process_queue` and `setup_child_logging`.
+
+Functions:
+    get_logger(name, **fields): Logger adding the fields to every record
+    process_queue(): Queue for records of child processes, created on the first call
+    setup_child_logging(queue): Sends records of the child process to the parent process
+"""
+import atexit
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from rich import print
+from rich.errors import MarkupError
+from rich.text import Text
+
+from dirs import Dirs
+from utils import get_in_workdir
+
+ROOT = "monocorpus"
+MAX_BYTES = 50 * 1024 * 1024
+BACKUP_COUNT = 5
+
+_lock = threading.Lock()
+_handlers = None
+_process_queue = None
+
+
+class _Adapter(logging.LoggerAdapter):
+    """Merges the fields of the logger with the fields passed to the call, e.g. `logger.info(msg, fields={...})`"""
+
+    def process(self, msg, kwargs):
+        fields = kwargs.pop("fields", None)
+        kwargs["extra"] = {"fields": {**self.extra, **fields} if fields else self.extra}
+        return msg, kwargs
+
+
+def get_logger(name, **fields):
+    _setup()
+    return _Adapter(logging.getLogger(f"{ROOT}.{name}"), fields)
+
+
+def process_queue():
+    """Queue for records of child processes, pass it to `setup_child_logging` in the child process"""
+    global _process_queue
+    _setup()
+    with _lock:
+        if _process_queue is None:
+            _process_queue = multiprocessing.get_context("spawn").Queue()
+            listener = QueueListener(_process_queue, *_handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+        return _process_queue
+
+
+def setup_child_logging(queue):
+    """Send records of this process to the listener of the parent process"""
+    global _handlers
+    with _lock:
+        logger = _root_logger()
+        logger.handlers = [QueueHandler(queue)]
+        # the handlers live in the parent process
+        _handlers = []
+
+
+def _setup():
+    global _handlers
+    with _lock:
+        if _handlers is not None:
+            return
+        console = _ConsoleHandler()
+        # debug records, e.g. timings of spans, are written only into the files
+        console.setLevel(logging.INFO)
+        _handlers = [console, _JsonFilesHandler()]
+        records = queue.SimpleQueue()
+        _root_logger().handlers = [QueueHandler(records)]
+        listener = QueueListener(records, *_handlers, respect_handler_level=True)
+        listener.start()
+        # the listener flushes the queued records on exit
+        atexit.register(listener.stop)
+
+
+def _root_logger():
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    return logger
+
+
+def _plain(message):
+    try:
+        return Text.from_markup(message).plain
+    except MarkupError:
+        return message
+
+
+def _source(record):
+    # records of child processes are logged from their main threads
+    return record.threadName if record.processName == "MainProcess" else f"{record.processName}({record.process})"
+
+
+class _ConsoleHandler(logging.Handler):
+
+    def emit(self, record):
+        try:
+            fields = getattr(record, "fields", {})
+            key = f" {fields['key']}" if "key" in fields else ""
+            print(f"{_source(record)} {time.strftime('%d-%m-%y %H:%M:%S', time.localtime(record.created))}{key}: {record.getMessage()}")
+        except Exception:
+            self.handleError(record)
+
+
+class _JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name.removeprefix(f"{ROOT}."),
+            "source": _source(record),
+            "message": _plain(record.getMessage()),
+            **getattr(record, "fields", {}),
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _JsonFilesHandler(logging.Handler):
+    """Writes records of every logger name into its own rotating file"""
+
+    def __init__(self):
+        super().__init__()
+        self.formatter = _JsonFormatter()
+        self.files = {}
+
+    def emit(self, record):
+        name = record.name.removeprefix(f"{ROOT}.").split(".")[0]
+        if not (handler := self.files.get(name)):
+            path = get_in_workdir(Dirs.LOGS, file=f"{name}.jsonl")
+            handler = RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT, encoding="utf-8")
+            handler.setFormatter(self.formatter)
+            self.files[name] = handler
+        handler.handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        super().close()
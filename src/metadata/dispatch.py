@@ -10,14 +10,15 @@ Key Features:
 - Handling of both PDF and text-based documents
 - Automatic retries on API rate limits
 - Skip list management for problematic documents
-- State persistence for failed extractions
+- Failed extractions recorded as failed jobs of the `metadata` pipeline in the database
 """
 
 
 from sqlalchemy import select
 from rich import print
 from s3 import upload_file, create_session
-from utils import read_config, get_in_workdir, download_file_locally, load_expired_keys, dump_expired_keys, get_session
+from utils import read_config, get_in_workdir, download_file_locally, get_session
+from jobs import JobQueue, exhausted_keys, add_exhausted_keys, FAILED
 from dirs import Dirs
 from gemini import create_client
 import zipfile
@@ -28,7 +29,11 @@ from google.genai.errors import ClientError
 from queue import Queue, Empty
 import threading
 from .text_extractor import FromTextMetadataExtractor
-from .pdf_slice_extractor import FromPdfSliceMetadataExtractor
+from .pdf_slice_extractor import FromPdfSliceMetadataExtractor, prepare_slice
+from prefetch import Prefetcher
+from cache import pinned, trim_to_budget
+from logs import get_logger
+from metrics import DOCUMENTS, ERRORS, GEMINI_LATENCY, serve as serve_metrics, watch_queue, error_class
 import os
 from utils import encrypt
 from yadisk_client import YaDisk
@@ -64,22 +69,29 @@ def _process_by_predicate(lang_tag, docs_batch_size=5000, keys_batch_size=1):
         keys_batch_size: Number of API keys to use in parallel
     """
     config = read_config()
+    serve_metrics(config)
     exceeded_keys_lock = threading.Lock()
-    exceeded_keys_set = load_expired_keys()
+    exceeded_keys_set = exhausted_keys(config["gemini_api_keys"])
     entity_cls = Document if lang_tag == 'tt' else DocumentCrh
+    jobs = JobQueue("metadata", config)
+    # failures recorded in a file by the runs before the jobs table
+    jobs.import_file("unprocessables/unprocessables_meta.txt", FAILED)
     
     while True:
         tasks_queue = None
         threads = None
-        dump_expired_keys(exceeded_keys_set)
+        prefetcher = None
+        # share the keys exhausted by this process, learn the ones exhausted by others
+        add_exhausted_keys(exceeded_keys_set)
+        exceeded_keys_set |= exhausted_keys(config["gemini_api_keys"])
         gc.collect()
+        trim_to_budget(config)
         try: 
-            unprocessles = _load_unprocessables()
             predicate = (
                 entity_cls.meta.is_(None) & (
                     entity_cls.content_url.is_not(None) | (entity_cls.mime_type == 'application/pdf')
                 )
-                & entity_cls.md5.not_in(unprocessles)
+                & jobs.without(entity_cls.md5, FAILED)
                 # & ~entity_cls.ya_path.startswith('/НейроТатарлар/other_turkic_langs/Крымскотатарский/Пресса/Янъы Дюнья')
                 # & ~entity_cls.ya_path.startswith('/НейроТатарлар/other_turkic_langs/Крымскотатарский/Книги/Kitaphanesi/Qadınlıq Sotsializm Yolunda')
             )
@@ -100,6 +112,7 @@ def _process_by_predicate(lang_tag, docs_batch_size=5000, keys_batch_size=1):
             tasks_queue = Queue(maxsize=len(docs))
             for doc in docs:
                 tasks_queue.put(doc)
+            watch_queue("metadata_tasks", tasks_queue.qsize)
                 
             if tasks_queue.empty():
                 print("No documents for processing...")
@@ -107,9 +120,16 @@ def _process_by_predicate(lang_tag, docs_batch_size=5000, keys_batch_size=1):
                             
             threads = []
             with YaDisk(config['yandex']['disk']['oauth_token'], proxy=config['proxy']) as ya_client:
+                # pdf documents are downloaded and sliced while the workers are busy with the current ones
+                prefetcher = Prefetcher(
+                    tasks_queue,
+                    lambda doc: _fetch_pdf(ya_client, doc, config),
+                    depth=(config.get('downloads') or {}).get('prefetch', 2),
+                    accept=_needs_pdf,
+                )
                 for num in range(min(len(keys_slice), len(docs))):
                     key = keys_slice[num]
-                    t = threading.Thread(target=MetadataExtractionWorker(key, tasks_queue, config, ya_client, exceeded_keys_lock, exceeded_keys_set, lang_tag))
+                    t = threading.Thread(target=MetadataExtractionWorker(key, tasks_queue, config, ya_client, exceeded_keys_lock, exceeded_keys_set, lang_tag, prefetcher, jobs))
                     t.start()
                     threads.append(t)
                     time.sleep(5)  # slight delay to avoid overwhelming the API with requests
@@ -117,10 +137,13 @@ def _process_by_predicate(lang_tag, docs_batch_size=5000, keys_batch_size=1):
             # Shutdown workers gracefully
             for t in threads:
                 t.join()
+            prefetcher.close()
         except KeyboardInterrupt:
             print("Interrupted, shutting down workers...")
             if tasks_queue:
                 tasks_queue.queue.clear()  # Clear the queue to stop workers
+            if prefetcher:
+                prefetcher.close()
             if threads:
                 for t in threads:
                     t.join(timeout=120)
@@ -129,7 +152,7 @@ def _process_by_predicate(lang_tag, docs_batch_size=5000, keys_batch_size=1):
             print(f"Error during processing: {e}")
             continue
         finally:
-            dump_expired_keys(exceeded_keys_set)
+            add_exhausted_keys(exceeded_keys_set)
 
         
         
@@ -142,9 +165,10 @@ class MetadataExtractionWorker:
         api_key: Gemini API key
         docs_queue: Queue of documents to process
         results_queue: Queue for processing results
+        jobs: Jobs of the metadata pipeline, failed documents are skipped by the next batches
     """
     
-    def __init__(self, gemini_api_key, tasks_queue, config, ya_client, exceeded_keys_lock, exceeded_keys_set, lang_tag):
+    def __init__(self, gemini_api_key, tasks_queue, config, ya_client, exceeded_keys_lock, exceeded_keys_set, lang_tag, prefetcher, jobs):
         self.key = gemini_api_key
         self.tasks_queue = tasks_queue
         self.config = config
@@ -152,6 +176,9 @@ class MetadataExtractionWorker:
         self.exceeded_keys_lock = exceeded_keys_lock
         self.exceeded_keys_set = exceeded_keys_set
         self.lang_tag=lang_tag
+        self.prefetcher = prefetcher
+        self.jobs = jobs
+        self.logger = get_logger("meta_extraction", key=gemini_api_key[-7:])
         
         
     def __call__(self):
@@ -162,22 +189,25 @@ class MetadataExtractionWorker:
             try:
                 local_doc_path = None
                 doc = self.tasks_queue.get(block=False)
-                self.log(f"Extracting metadata from document {doc.md5}({doc.ya_public_url})")
+                self.log(f"Extracting metadata from document {doc.md5}({doc.ya_public_url})", md5=doc.md5)
                 
                 if doc.content_url:
                     prev_req_time = self._sleep_if_needed(prev_req_time)
-                    metadata = FromTextMetadataExtractor(doc, self.config, gemini_client, model=model, lang_tag=self.lang_tag).extract()
+                    metadata = self._extract(FromTextMetadataExtractor(doc, self.config, gemini_client, model=model, lang_tag=self.lang_tag))
                 elif doc.mime_type == 'application/pdf':
-                    local_doc_path = local_doc_path = download_file_locally(self.ya_client, doc, self.config)
-                    prev_req_time = self._sleep_if_needed(prev_req_time)
-                    metadata = FromPdfSliceMetadataExtractor(doc, self.config, gemini_client, model, local_doc_path, lang_tag=self.lang_tag).extract()
+                    with pinned(doc.md5):
+                        # usually the document is already downloaded and sliced by the prefetcher
+                        local_doc_path, prepared_slice = self.prefetcher.take(doc)
+                        prev_req_time = self._sleep_if_needed(prev_req_time)
+                        metadata = self._extract(FromPdfSliceMetadataExtractor(doc, self.config, gemini_client, model, local_doc_path, lang_tag=self.lang_tag, prepared_slice=prepared_slice))
                 else:
                     self.log(f"Document {doc.md5} has no content_url or is not a PDF, skipping...")
                     continue
                 
                 if not metadata:
                     self.log(f"No metadata was extracted from document {doc.md5}({doc.ya_public_url})")
-                    self._dump_unprocessables(doc.md5)
+                    DOCUMENTS.labels("metadata", "empty").inc()
+                    self.jobs.fail(doc.md5, "No metadata was extracted")
                     continue
                 # write metadata to zip
                 local_meta_path = get_in_workdir(Dirs.METADATA, file=f"{doc.md5}.zip")
@@ -189,14 +219,16 @@ class MetadataExtractionWorker:
                 self._upload_artifacts_to_s3(doc, local_meta_path, local_doc_path)
                 with get_session() as session:
                     self._update_document(doc.md5, metadata, session, meta_json)
-                self.log(f"Metadata extracted and uploaded for document {doc.md5}({doc.ya_public_url})")
+                DOCUMENTS.labels("metadata", "extracted").inc()
+                self.log(f"Metadata extracted and uploaded for document {doc.md5}({doc.ya_public_url})", md5=doc.md5)
                 self.log(f"Metadata: {meta_json}")
             except Empty:
                 self.log("No tasks for processing, shutting down thread...")
                 return
             except ClientError as e:
+                ERRORS.labels("metadata", error_class(e)).inc()
                 print(f"ClientError during metadata extraction for doc '{doc.md5}({doc.ya_path})' with key '{self.key}': {e}")
-                self._dump_unprocessables(doc.md5)
+                self.jobs.fail(doc.md5, repr(e))
                 if e.code == 429:
                     self.log(f"Key {self.key} exhausted {e}, shutting down thread...") 
                     self.tasks_queue.put(doc)
@@ -206,11 +238,20 @@ class MetadataExtractionWorker:
                 continue
             except Exception as e:
                 import traceback
-                self.log(f"Could not extract metadata from doc {doc.md5}: {e} \n{traceback.format_exc()}")
-                self._dump_unprocessables(doc.md5)
+                ERRORS.labels("metadata", error_class(e)).inc()
+                self.log(f"Could not extract metadata from doc {doc.md5}: {e} \n{traceback.format_exc()}", md5=doc.md5)
+                self.jobs.fail(doc.md5, repr(e))
                 continue
             
 
+    def _extract(self, extractor):
+        started = time.monotonic()
+        try:
+            return extractor.extract()
+        finally:
+            GEMINI_LATENCY.labels("metadata").observe(time.monotonic() - started)
+
+
     def _sleep_if_needed(self, prev_req_time):
         if prev_req_time:
             elapsed = datetime.datetime.now() - prev_req_time
@@ -285,41 +326,15 @@ class MetadataExtractionWorker:
         session.commit()
 
 
-    def log(self, message):
-        message = f"{threading.current_thread().name} {time.strftime('%d-%m-%y %H:%M:%S')} {self.key[-7:]}: {message}"
-        log_file = get_in_workdir(Dirs.LOGS, file=f"meta_extraction_{self.key}.log")
-        with open(log_file, "a") as log:
-            log.write(f"{message}\n")
-        print(message)
-    
-    
-    def _dump_unprocessables(self, md5, lock="unprocessables/unprocessables_meta.lock", file="unprocessables/unprocessables_meta.txt"):
-        """
-        Check lock file exists, if lock file is not exists, read the unprocessables file into set, add the given md5, and write it back.
-        If lock file exists, sleep and retry until lock file is gone.
-        """
-        while os.path.exists(lock):
-            time.sleep(1)
-        try:
-            with open(lock, "w") as _:
-                unprocessables = set([md5])
-                if os.path.exists(file):
-                    with open(file, "r") as f:
-                        for line in f:
-                            unprocessables.add(line.strip())
-                with open(file, "w") as f:
-                    for item in sorted(unprocessables):
-                        f.write(f"{item}\n")
-                    f.flush()
-        finally:
-            if os.path.exists(lock):
-                os.remove(lock)
-        
-        
-def _load_unprocessables(file="unprocessables/unprocessables_meta.txt"):
-    unprocessables = set()
-    if os.path.exists(file):
-        with open(file, "r") as f:
-            for line in f:
-                unprocessables.add(line.strip())
-    return unprocessables
\ No newline at end of file
+    def log(self, message, **fields):
+        self.logger.info(message, fields=fields)
+
+
+def _needs_pdf(doc):
+    return not doc.content_url and doc.mime_type == 'application/pdf'
+
+
+def _fetch_pdf(ya_client, doc, config):
+    with pinned(doc.md5):
+        local_doc_path = download_file_locally(ya_client, doc, config)
+        return local_doc_path, prepare_slice(doc.md5, local_doc_path, n=5)
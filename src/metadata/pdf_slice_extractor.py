@@ -11,19 +11,19 @@ import json
 class FromPdfSliceMetadataExtractor:
     
     
-    def __init__(self, doc, config, gemini_client, model, local_doc_path, lang_tag): 
+    def __init__(self, doc, config, gemini_client, model, local_doc_path, lang_tag, prepared_slice=None): 
         self.doc = doc
         self.config = config
         self.gemini_client = gemini_client
         self.model = model
         self.local_doc_path = local_doc_path
         self.lang_tag = lang_tag
+        self.prepared_slice = prepared_slice
         
         
     def extract(self):
-        # create a slice of first n and last n pages
-        slice_file_path = get_in_workdir(Dirs.DOC_SLICES, self.doc.md5, file=f"slice-for-meta")
-        slice_page_count, original_doc_page_count = self._prepare_slices(slice_file_path, n=5)
+        # create a slice of first n and last n pages, unless the prefetcher has already done it
+        slice_file_path, slice_page_count, original_doc_page_count = self.prepared_slice or prepare_slice(self.doc.md5, self.local_doc_path, n=5)
         self.doc.page_count = original_doc_page_count
         
         # prepare prompt
@@ -51,28 +51,6 @@ class FromPdfSliceMetadataExtractor:
                     print(f"Failed to delete file {file.name}: {e}")
 
         
-    def _prepare_slices(self, dest_path, n):
-        """
-        Prepare aux PDF doc with slices of pages of the original document for metadata extraction.
-        :param pdf_doc: The PDF document to slice.
-        :param n: Number of pages to include from the start.
-        :return: The number of pages in the new document and the original document.
-        """
-        def __ranges(_i):
-            for _, _b in groupby(enumerate(_i), lambda pair: pair[1] - pair[0]):
-                _b = list(_b)
-                yield _b[0][1], _b[-1][1]
-        
-        
-        with pymupdf.open(self.local_doc_path) as pdf_doc, pymupdf.open() as doc_slice:
-            pages = list(range(0, pdf_doc.page_count))
-            pages = set(pages[:n] + pages[-n:])
-            for start, end in list(__ranges(pages)):
-                doc_slice.insert_pdf(pdf_doc, from_page=start, to_page=end)
-            doc_slice.save(dest_path)
-            return doc_slice.page_count, pdf_doc.page_count
-        
-        
     def _prepare_prompt(self, slice_page_count):
         prompt = DEFINE_META_PROMPT_PDF_HEADER.format(n=int(slice_page_count / 2),)
         prompt = [{'text': prompt}]
@@ -87,4 +65,26 @@ class FromPdfSliceMetadataExtractor:
             })
         prompt.append({"text": "Now, extract metadata from the following document"})
         return prompt
-    
\ No newline at end of file
+
+
+def prepare_slice(md5, local_doc_path, n):
+    """
+    Prepare aux PDF doc with slices of pages of the original document for metadata extraction.
+    :param md5: md5 of the original document.
+    :param local_doc_path: Path to the original document.
+    :param n: Number of pages to include from the start and from the end.
+    :return: The path to the new document, the number of pages in it and in the original document.
+    """
+    def __ranges(_i):
+        for _, _b in groupby(enumerate(_i), lambda pair: pair[1] - pair[0]):
+            _b = list(_b)
+            yield _b[0][1], _b[-1][1]
+
+    dest_path = get_in_workdir(Dirs.DOC_SLICES, md5, file=f"slice-for-meta")
+    with pymupdf.open(local_doc_path) as pdf_doc, pymupdf.open() as doc_slice:
+        pages = list(range(0, pdf_doc.page_count))
+        pages = set(pages[:n] + pages[-n:])
+        for start, end in list(__ranges(pages)):
+            doc_slice.insert_pdf(pdf_doc, from_page=start, to_page=end)
+        doc_slice.save(dest_path)
+        return dest_path, doc_slice.page_count, pdf_doc.page_count
@@ -0,0 +1,113 @@
+"""
+Metrics Module
+
+Counters and histograms of the extraction and metadata workers in the Prometheus format:
+processed chunks and documents, tokens per key, latency of Gemini requests and uploads, errors
+by class, depths of the queues. Throughput is derived by Prometheus, e.g. chunks per minute per
+key is `rate(monocorpus_chunks_total[1m]) * 60`.
+
+Metrics are collected in the multiprocess mode of `prometheus_client`, so the postprocessing
+worker processes are accounted as well: every process writes its values into the directory of
+the root process in `Dirs.METRICS`, and they are summed up on scraping. The metrics are served
+on `http://localhost:{metrics.port}/metrics` when the port is set in the config.
+
+Functions:
+    serve(config): Starts the HTTP endpoint, if `metrics.port` is set
+    watch_queue(name, size): Reports the size of the queue as `monocorpus_queue_depth`
+    error_class(e): Label of the error for `ERRORS`
+"""
+import os
+import shutil
+import threading
+import time
+
+from rich import print
+
+from dirs import Dirs
+from utils import get_in_workdir, pid_alive
+
+# must be set before `prometheus_client` is imported, child processes inherit it
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    _metrics_dir = get_in_workdir(Dirs.METRICS)
+    # values of finished runs are not counted, other running processes keep theirs
+    for _name in os.listdir(_metrics_dir):
+        if not pid_alive(_name):
+            shutil.rmtree(os.path.join(_metrics_dir, _name), ignore_errors=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = get_in_workdir(Dirs.METRICS, str(os.getpid()))
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server  # noqa: E402
+from prometheus_client.multiprocess import MultiProcessCollector  # noqa: E402
+
+CHUNKS = Counter("monocorpus_chunks", "Chunks of pdf documents requested from Gemini", ["key", "outcome"])
+TOKENS = Counter("monocorpus_tokens", "Tokens of Gemini requests", ["key", "direction"])
+DOCUMENTS = Counter("monocorpus_documents", "Processed documents", ["task", "outcome"])
+ERRORS = Counter("monocorpus_errors", "Failed requests by error class", ["task", "error"])
+GEMINI_LATENCY = Histogram(
+    "monocorpus_gemini_latency_seconds",
+    "Time of Gemini request including streaming of the response",
+    ["task"],
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+UPLOAD_LATENCY = Histogram(
+    "monocorpus_upload_latency_seconds",
+    "Time of upload to the object storage",
+    ["bucket"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+)
+STAGE_SECONDS = Histogram(
+    "monocorpus_stage_seconds",
+    "Time of the stages of the document processing, see `spans`",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+QUEUE_DEPTH = Gauge("monocorpus_queue_depth", "Count of items in the queue", ["queue"], multiprocess_mode="livesum")
+
+# queues are sampled instead of reporting every put and get
+SAMPLING_INTERVAL = 5
+
+_lock = threading.Lock()
+_queues = {}
+_server = None
+
+
+def serve(config):
+    global _server
+    port = (config.get('metrics') or {}).get('port')
+    if not port:
+        return
+    with _lock:
+        if _server:
+            return
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+        _server = start_http_server(port, registry=registry)
+        threading.Thread(target=_sample_queues, name="metrics", daemon=True).start()
+    print(f"Metrics are served on http://localhost:{port}/metrics")
+
+
+def watch_queue(name, size):
+    """
+    Report the size of the queue, replaces the queue watched by the same name before.
+
+    :param name: label of the queue
+    :param size: function returning the count of items in the queue
+    """
+    with _lock:
+        _queues[name] = size
+
+
+def error_class(e):
+    code = getattr(e, 'code', None)
+    return f"{type(e).__name__}:{code}" if isinstance(code, int) else type(e).__name__
+
+
+def _sample_queues():
+    while True:
+        with _lock:
+            queues = list(_queues.items())
+        for name, size in queues:
+            try:
+                QUEUE_DEPTH.labels(name).set(size())
+            except Exception:
+                pass
+        time.sleep(SAMPLING_INTERVAL)
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, Boolean, JSON
+from sqlalchemy import Column, Integer, String, Boolean, JSON, DateTime, Index
 
 Base = declarative_base()
 
@@ -34,7 +34,7 @@ class Document(Base):
     """
     __tablename__ = "document"
 
-    md5 = Column(primary_key=True, nullable=False, unique=True, index=True)
+    md5 = Column(String, primary_key=True, nullable=False, unique=True, index=True)
     mime_type = Column(String)
     ya_path = Column(String)
     ya_public_url = Column(String)
@@ -101,7 +101,7 @@ class DocumentCrh(Base):
     """
     __tablename__ = "document_crh"
 
-    md5 = Column(primary_key=True, nullable=False, unique=True, index=True)
+    md5 = Column(String, primary_key=True, nullable=False, unique=True, index=True)
     mime_type = Column(String)
     ya_path = Column(String)
     ya_public_url = Column(String)
@@ -133,4 +133,51 @@ class DocumentCrh(Base):
         )
         
     def __repr__(self):
-        return self.__str__()
\ No newline at end of file
+        return self.__str__()    
+    
+class Job(Base):
+    """
+    Represents a job of a pipeline over a document. Workers of any process or host claim jobs by
+    taking a lease on them, a job whose lease has expired is claimed again.
+
+    Attributes:
+        pipeline (str): Pipeline processing the document, e.g. 'content_tt' or 'metadata'
+        md5 (str): MD5 hash of the document.
+        status (str): One of 'pending', 'running', 'done', 'failed', 'repairable'
+        attempts (int): Count of failed attempts, including the ones of crashed workers
+        lease_owner (str): Worker holding the job, in format 'host:pid'
+        lease_expires_at (datetime): Time in UTC when the job can be claimed by another worker unless the lease is renewed
+        last_error (str): Error of the last failed attempt
+        next_run_at (datetime): Time in UTC before which the job is not claimed
+        updated_at (datetime): Time in UTC of the last change of the job
+    """
+    __tablename__ = "job"
+    __table_args__ = (
+        Index("ix_job_claim", "pipeline", "status", "next_run_at"),
+    )
+
+    pipeline = Column(String, primary_key=True, nullable=False)
+    md5 = Column(String, primary_key=True, nullable=False)
+    status = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_owner = Column(String)
+    lease_expires_at = Column(DateTime)
+    last_error = Column(String)
+    next_run_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ExhaustedKey(Base):
+    """
+    Represents a Gemini API key which has exhausted its daily quota.
+
+    Attributes:
+        key_hash (str): SHA-256 of the key, the keys themselves are not stored
+        period (str): Quota period the key is exhausted in, like '20250810_1'
+        exhausted_at (datetime): Time in UTC when the quota was exhausted
+    """
+    __tablename__ = "exhausted_key"
+
+    key_hash = Column(String, primary_key=True, nullable=False)
+    period = Column(String, primary_key=True, nullable=False)
+    exhausted_at = Column(DateTime, nullable=False)
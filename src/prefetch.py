@@ -0,0 +1,79 @@
+"""
+Prefetch Module
+
+Workers take documents from the tasks queue and, before the first request to Gemini, download
+the document and prepare it: count its pages and cut the slices sent to the model. For large
+books it takes minutes, and the API key of the worker is idle all that time.
+
+The prefetcher looks at the head of the tasks queue and downloads the next documents there in
+background threads, while the workers are busy with the current ones. When a worker takes a
+document, it gets the local, verified file and everything prepared for it. A document which was
+not prefetched, e.g. returned to the queue for a retry, is fetched by the worker itself.
+
+Classes:
+    Prefetcher: Fetches the documents at the head of the tasks queue in advance
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Fetches the documents at the head of the tasks queue in advance.
+
+    :param tasks_queue: the queue the workers take documents from
+    :param fetch: function downloading and preparing the document, its result is returned by `take`
+    :param depth: how many documents are fetched ahead of the workers
+    :param accept: predicate of documents which need fetching, all documents by default
+    """
+
+    def __init__(self, tasks_queue, fetch, depth, accept=None):
+        self.tasks_queue = tasks_queue
+        self.fetch = fetch
+        self.depth = depth
+        self.accept = accept or (lambda doc: True)
+        self._lock = threading.Lock()
+        # fetched or being fetched documents not taken by workers yet, by md5
+        self._futures = {}
+        # documents handed out to workers, they are not fetched ahead again when returned to the queue
+        self._taken = set()
+        self._executor = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch") if depth > 0 else None
+        self._schedule()
+
+    def take(self, doc):
+        """Result of `fetch` for the document, waits for the prefetch if it is in progress"""
+        with self._lock:
+            future = self._futures.pop(doc.md5, None)
+            self._taken.add(doc.md5)
+        # the worker took the document, so one more document can be fetched ahead
+        self._schedule()
+        if future is None or future.cancelled():
+            return self.fetch(doc)
+        return future.result()
+
+    def close(self):
+        """Stop fetching, the documents which are not started yet are not fetched"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _schedule(self):
+        if not self._executor:
+            return
+        # peeking the queue under its own lock, the documents stay in the queue for the workers
+        with self.tasks_queue.mutex, self._lock:
+            for doc in self.tasks_queue.queue:
+                if len(self._futures) >= self.depth:
+                    break
+                if doc.md5 in self._futures or doc.md5 in self._taken or not self.accept(doc):
+                    continue
+                try:
+                    self._futures[doc.md5] = self._executor.submit(self.fetch, doc)
+                except RuntimeError:
+                    # the prefetcher is closed
+                    return
@@ -6,7 +6,9 @@ from rich import print
 CONFIG_FILE = "config.yaml"
 
 
-def create_session(config=read_config()):
+def create_session(config=None):
+    # config is read on call, not on import of the module
+    config = config or read_config()
     aws_access_key_id, aws_secret_access_key = map(config['yandex']['cloud'].get, ['aws_access_key_id', 'aws_secret_access_key'])
     return Session().client(
         service_name='s3',
@@ -17,13 +19,16 @@ def create_session(config=read_config()):
     
 
 def upload_file(path, bucket, key, session, skip_if_exists=False):
+    from metrics import UPLOAD_LATENCY
+
     if not (skip_if_exists and session.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1).get("Contents", [])):
         print(f"Uploading doc '{key}'")
-        session.upload_file(
-            path,
-            bucket,
-            key
-        )    
+        with UPLOAD_LATENCY.labels(bucket).time():
+            session.upload_file(
+                path,
+                bucket,
+                key
+            )    
     else: print(f"Doc '{key}' already exists")
     return f"{session._endpoint.host}/{bucket}/{key}"
 
@@ -0,0 +1,94 @@
+"""
+Spans Module
+
+Timing of the stages of the document processing. A span is a context manager around a stage:
+its duration is observed by the `monocorpus_stage_seconds` histogram and written into the
+`spans.jsonl` structured log together with the fields of the span (md5, chunk range) and the
+name of the enclosing span, so the time of a document can be broken down stage by stage.
+
+A whole document can also be run under a profiler, if `profiling.enabled` is set in the config,
+e.g. by the `--profile` option of the `extract` command. A report per md5 and step is saved in
+`Dirs.PROFILES`: the `.prof` stats and the `.txt` summary for cProfile, the `.html` report for
+pyinstrument.
+
+Functions:
+    span(stage, **fields): Times the stage
+    profiled(md5, step, config): Profiles the step of the document processing, if enabled
+"""
+import contextvars
+import cProfile
+import io
+import pstats
+import time
+from contextlib import contextmanager
+
+from rich import print
+
+from dirs import Dirs
+from logs import get_logger
+from metrics import STAGE_SECONDS
+from utils import get_in_workdir
+
+_current = contextvars.ContextVar("span", default=None)
+_logger = get_logger("spans")
+
+
+@contextmanager
+def span(stage, **fields):
+    """
+    Time the stage, spans can be nested.
+
+    :param stage: name of the stage, dotted names group stages, e.g. `gemini.generate`
+    :param fields: fields written into the log along with the duration
+    """
+    parent = _current.get()
+    token = _current.set(stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _current.reset(token)
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        _logger.debug(f"{stage} took {elapsed:.3f}s", fields={"span": stage, "parent": parent, "seconds": round(elapsed, 4), **fields})
+
+
+@contextmanager
+def profiled(md5, step, config):
+    """Run the step of the document processing under the profiler set by `profiling.profiler`, if profiling is enabled"""
+    settings = config.get('profiling') or {}
+    if not settings.get('enabled'):
+        yield
+        return
+
+    profiler = settings.get('profiler', 'cprofile')
+    report = get_in_workdir(Dirs.PROFILES, file=f"{md5}-{step}")
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+
+        p = Profiler()
+        p.start()
+        try:
+            yield
+        finally:
+            p.stop()
+            p.write_html(f"{report}.html")
+    else:
+        p = cProfile.Profile()
+        try:
+            p.enable()
+        except ValueError as e:
+            # only one profiler may be active at a time in the process
+            print(f"[yellow]Document {md5} is not profiled: {e}[/yellow]")
+            yield
+            return
+        try:
+            yield
+        finally:
+            p.disable()
+            p.dump_stats(f"{report}.prof")
+            summary = io.StringIO()
+            pstats.Stats(p, stream=summary).sort_stats("cumulative").print_stats(50)
+            with open(f"{report}.txt", "w") as f:
+                f.write(summary.getvalue())
+    print(f"Profile of {md5} {step} is saved to {report}")
@@ -7,14 +7,15 @@ import hashlib
 from models import Document
 from sqlalchemy import select
 from collections import deque
+from functools import lru_cache
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import base64
-from datetime import datetime, timezone, timedelta
 import json
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import requests
 import zipfile
+from downloads import download_public, DownloadError, LinkResolutionError
 
 prefix = "enc:"
 
@@ -54,26 +55,114 @@ def calculate_md5(file_path: str):
     :param file_path: path to the file
     :return: MD5 hash of the file
     """
-    hash_md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(2048), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        # reads the file with large buffers, releasing GIL while hashing
+        return hashlib.file_digest(f, "md5").hexdigest()
+
+
+def cached_md5(file_path: str):
+    """
+    Returns MD5 hash of the file, calculating it only if the file changed since the last call.
+    The hash is cached in `Dirs.MD5_CACHE` together with the size and the modification time of the file
+
+    :param file_path: path to the file
+    :return: MD5 hash of the file
+    """
+    stat = os.stat(file_path)
+    cache_file = _md5_cache_file(file_path)
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+        if cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["md5"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    md5 = calculate_md5(file_path)
+    _store_md5(file_path, md5)
+    return md5
+
+
+def _store_md5(file_path, md5):
+    stat = os.stat(file_path)
+    cache_file = _md5_cache_file(file_path)
+    with open(f"{cache_file}.part", "w") as f:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "md5": md5}, f)
+    os.replace(f"{cache_file}.part", cache_file)
+
+
+def _md5_cache_file(file_path):
+    # files of different directories may have the same name
+    key = hashlib.md5(os.path.abspath(file_path).encode("utf-8")).hexdigest()
+    return get_in_workdir(Dirs.MD5_CACHE, file=f"{os.path.basename(file_path)}.{key[:8]}.json")
+
+
+class _HashingWriter:
+    """File wrapper calculating MD5 hash of everything written through it"""
+
+    def __init__(self, file, hash_md5=None):
+        self.file = file
+        # the hash of the part of the file written before, if it is continued
+        self.hash_md5 = hashlib.md5() if hash_md5 is None else hash_md5
+
+    def write(self, data):
+        self.hash_md5.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
 
 
 def get_in_workdir(*dir_names: Union[str, Dirs], file: str = None, prefix: str = workdir):
-    dir_names = [i.value if isinstance(i, Dirs) else i for i in dir_names]
-    script_parent_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
-    path = [script_parent_dir, '..', os.path.expanduser(prefix), *dir_names]
-    path = os.path.normpath(os.path.join(*path))
-    os.makedirs(path, exist_ok=True)
+    """
+    Path to the directory in the work directory, or to the file in it. The directory is created
+    if it does not exist. Only the fixed directories, such as the `Dirs` ones, are remembered and
+    make no syscalls on further calls. Directories of documents inside them, e.g. `DOC_SLICES/<md5>`,
+    are created on every call, since any process trimming the cache may have removed them.
+    """
+    key = (prefix, *[i.value if isinstance(i, Dirs) else i for i in dir_names[:1]])
+    path = _workdirs.get(key)
+    if path is None:
+        path = os.path.normpath(os.path.join(_script_parent_dir(), '..', os.path.expanduser(prefix), *key[1:]))
+        os.makedirs(path, exist_ok=True)
+        _workdirs[key] = path
+    if len(dir_names) > 1:
+        path = os.path.join(path, *[i.value if isinstance(i, Dirs) else i for i in dir_names[1:]])
+        os.makedirs(path, exist_ok=True)
     if file:
         return os.path.join(path, file)
     else:
         return path
 
 
-def obtain_documents(cli_params, ya_client, entity_cls, predicate=None, limit=None, offset=None, session=get_session()):
+def forget_workdirs():
+    """Forget the directories remembered by `get_in_workdir`, must be called after removing any of them"""
+    _workdirs.clear()
+
+
+_workdirs = {}
+
+
+def pid_alive(pid):
+    """Whether the process with the pid, given as a number or a string, is running"""
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+@lru_cache(maxsize=None)
+def _script_parent_dir():
+    return os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+def obtain_documents(cli_params, ya_client, entity_cls, predicate=None, limit=None, offset=None, session=None):
+    # the session is opened on call, not on import of the module
+    session = session or get_session()
     def _yield_by_md5(_md5, _predicate):
         print(f"Looking for document by md5 '{_md5}'")
         if _predicate is None:
@@ -131,10 +220,23 @@ def download_file_locally(ya_client, doc, config):
         # or use a default extension if mime type is unknown
         ext = _extension_by_mime_type(doc.mime_type)
     local_path=get_in_workdir(Dirs.ENTRY_POINT, file=f"{doc.md5}{ext}")
-    if not (os.path.exists(local_path) and calculate_md5(local_path) == doc.md5):
+    if not (os.path.exists(local_path) and cached_md5(local_path) == doc.md5):
         url = decrypt(doc.ya_public_url, config) if doc.sharing_restricted else doc.ya_public_url
-        with open(local_path, "wb") as f:
-            ya_client.download_public(url, f)
+        try:
+            md5 = download_public(url, local_path, doc.md5, config)
+        except LinkResolutionError as e:
+            print(f"Falling back to the download by the Yandex.Disk client: {e}")
+            # the hash is calculated while downloading, the file is not read once again
+            part_path = f"{local_path}.part"
+            with open(part_path, "wb") as f:
+                writer = _HashingWriter(f)
+                ya_client.download_public(url, writer)
+            md5 = writer.hash_md5.hexdigest()
+            if md5 != doc.md5:
+                os.remove(part_path)
+                raise DownloadError(f"Downloaded file {local_path} has md5 {md5}, expected {doc.md5}")
+            os.replace(part_path, local_path)
+        _store_md5(local_path, md5)
     return local_path
 
 
@@ -197,36 +299,6 @@ def decrypt(ciphertext, config):
     return aesgcm.decrypt(nonce, ct, None).decode()
 
 
-def load_expired_keys(dir = 'expired_keys'):
-    os.makedirs(dir, exist_ok=True)
-    ekf = os.path.join(dir, f"expired_keys_{_get_bucket_id()}.json")
-    if os.path.exists(ekf):
-        with open(ekf, "r") as f:
-            return set(json.load(f))
-    else: return set()
-    
-
-def dump_expired_keys(keys, dir = 'expired_keys'):
-    os.makedirs(dir, exist_ok=True)
-    ekf = os.path.join(dir, f"expired_keys_{_get_bucket_id()}.json")
-    with open(ekf, "w") as f:
-        json.dump(list(keys), f, ensure_ascii=False, indent=4)
-        
-
-def _get_bucket_id():
-    """Return bucket like '20250810_1' or '20250811_0' based on 09:00 UTC cutoff."""
-    now = datetime.now(timezone.utc)
-
-    # If before 09:00 UTC, we are still in the *previous day's* second bucket
-    if now.hour < 9:
-        date = (now - timedelta(days=1)).strftime("%Y%m%d")
-        bucket_num = 1
-    else:
-        date = now.strftime("%Y%m%d")
-        bucket_num = 0
-
-    return f"{date}_{bucket_num}"
-
 import requests
 import zipfile
 
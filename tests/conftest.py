@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of the application are imported from `src` the same way `src/main.py` does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,41 @@
+import pytest
+
+from content.continuity_checker import continue_smoothly
+
+# chunk boundaries glued by the spaCy sentencizer
+BOUNDARIES = [
+    ("Казан бала?", "Укучы халык", "\n\nУкучы халык"),
+    ("Казан бала!", "Укучы халык", "\n\nУкучы халык"),
+    ("Ул әйтте: «Кайт!»", "Без киттек.", " Без киттек."),
+    ("Ничек?!", "Белмим.", " Белмим."),
+    ("Шулай итеп...", "аннары без", " аннары без"),
+    ("Шулай итеп…", "Аннары без", " Аннары без"),
+    ("Бу 5 млн.", "сум тора.", " сум тора."),
+    ("Безнең эрага кадәр 300 ел, б.э.к.", "Ул чорда", " Ул чорда"),
+    ("китаплар, дәфтәрләр һ.б.", "әйберләр", " әйберләр"),
+    ("Тукай 1886 елда туган.", "1913 елда вафат.", " 1913 елда вафат."),
+    ("язучы-", "лар белән", "лар белән"),
+    ("ул китап", "укыды.", " укыды."),
+    ("Сүз", "# Бүлек 2", "\n\n# Бүлек 2"),
+    ("Кем ул (укучы?)", "Белмим", " Белмим"),
+    ("Ә син?", "— Мин дә.", "\n\n— Мин дә."),
+    ("Бу т.б.", "Сүзләр", "\n\nСүзләр"),
+]
+
+
+@pytest.mark.parametrize("tail, head, expected", BOUNDARIES)
+def test_rules_glue_as_spacy(tail, head, expected):
+    assert continue_smoothly(tail, head, segmenter="rules") == expected
+
+
+def test_rules_agree_with_spacy():
+    pytest.importorskip("spacy")
+    from bench.sentence_boundary import synthetic_boundaries
+
+    boundaries = synthetic_boundaries(2000) + [(tail, head) for tail, head, _ in BOUNDARIES]
+    disagreements = [
+        (tail, head)
+        for tail, head in boundaries
+        if continue_smoothly(tail, head, segmenter="rules") != continue_smoothly(tail, head, segmenter="spacy")
+    ]
+    assert not disagreements
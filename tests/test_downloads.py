@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import downloads
+import utils
+from dirs import Dirs
+
+DATA = bytes(range(256)) * 4096 + b"tail"
+MD5 = hashlib.md5(DATA).hexdigest()
+HREF = "https://downloader.disk.yandex.ru/file"
+
+
+class _Response:
+    def __init__(self, status_code, body=b"", headers=None, url=HREF, fail_after=None, delay=0):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.url = url
+        self.fail_after = fail_after
+        self.delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"status {self.status_code}")
+
+    def json(self):
+        return {"href": HREF}
+
+    def iter_content(self, size):
+        time.sleep(self.delay)
+        for sent in range(0, len(self.body), 1000):
+            if self.fail_after is not None and sent >= self.fail_after:
+                raise requests.ConnectionError("connection reset")
+            yield self.body[sent:sent + 1000]
+
+
+class _Server:
+    """Direct link of a Yandex.Disk file supporting Range requests"""
+
+    def __init__(self, data=DATA, ranges=True):
+        self.data = data
+        self.ranges = ranges
+        self.requested = []
+        # responses of the requested ranges interrupted after this count of bytes, once each
+        self.interrupt = {}
+        # seconds the responses of the ranges starting at the offset wait before the first byte
+        self.delays = {}
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        if url == downloads.PUBLIC_DOWNLOAD_API:
+            return _Response(200)
+        header = (headers or {}).get("Range")
+        self.requested.append(header)
+        if not header or not self.ranges:
+            return _Response(200, self.data)
+        start, end = re.fullmatch(r"bytes=(\d+)-(\d*)", header).groups()
+        start, end = int(start), int(end) if end else len(self.data) - 1
+        if start >= len(self.data):
+            return _Response(416)
+        return _Response(206, self.data[start:end + 1], fail_after=self.interrupt.pop(start, None), delay=self.delays.get(start, 0))
+
+    def head(self, url, **kwargs):
+        headers = {"Content-Length": str(len(self.data))}
+        if self.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        return _Response(200, headers=headers)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = _Server()
+    monkeypatch.setattr(downloads.requests, "get", server.get)
+    monkeypatch.setattr(downloads.requests, "head", server.head)
+    monkeypatch.setattr(downloads.time, "sleep", lambda seconds: None)
+    monkeypatch.setattr(downloads, "_limiter", threading.BoundedSemaphore(8))
+    return server
+
+
+@pytest.fixture
+def segmented(monkeypatch):
+    monkeypatch.setattr(downloads, "SEGMENTED_THRESHOLD", 64 * 1024)
+    monkeypatch.setattr(downloads, "SEGMENT_SIZE", 100 * 1024)
+
+
+def test_existing_part_is_continued_by_range_request(server, tmp_path):
+    local_path = tmp_path / "doc.pdf"
+    (tmp_path / "doc.pdf.part").write_bytes(DATA[:12345])
+
+    assert downloads.download_public("public", str(local_path), MD5, {}) == MD5
+    assert server.requested == ["bytes=12345-"]
+    assert local_path.read_bytes() == DATA
+    assert not (tmp_path / "doc.pdf.part").exists()
+
+
+def test_interrupted_stream_is_continued_and_hashed(server, tmp_path):
+    local_path = tmp_path / "doc.pdf"
+    (tmp_path / "doc.pdf.part").write_bytes(DATA[:1000])
+    server.interrupt[1000] = 5000
+
+    assert downloads.download_public("public", str(local_path), MD5, {}) == MD5
+    assert server.requested == ["bytes=1000-", "bytes=6000-"]
+    assert local_path.read_bytes() == DATA
+
+
+def test_complete_part_is_not_downloaded_again(server, tmp_path):
+    local_path = tmp_path / "doc.pdf"
+    (tmp_path / "doc.pdf.part").write_bytes(DATA)
+
+    assert downloads.download_public("public", str(local_path), MD5, {}) == MD5
+    assert local_path.read_bytes() == DATA
+
+
+def test_part_is_downloaded_again_if_range_is_ignored(server, tmp_path):
+    server.ranges = False
+    local_path = tmp_path / "doc.pdf"
+    (tmp_path / "doc.pdf.part").write_bytes(b"garbage")
+
+    assert downloads.download_public("public", str(local_path), MD5, {}) == MD5
+    assert local_path.read_bytes() == DATA
+
+
+def test_segments_completed_out_of_order_are_hashed_in_order(server, segmented, tmp_path):
+    local_path = tmp_path / "doc.pdf"
+    # the first segment is the last to complete
+    server.delays[0] = 0.2
+    server.interrupt[200 * 1024] = 5000
+
+    assert downloads.download_public("public", str(local_path), MD5, {"downloads": {"connections_per_file": 4}}) == MD5
+    assert local_path.read_bytes() == DATA
+    assert not (tmp_path / "doc.pdf.part.segments").exists()
+
+
+def test_completed_segments_are_not_downloaded_again(server, segmented, tmp_path):
+    local_path = tmp_path / "doc.pdf"
+    part = bytearray(len(DATA))
+    part[100 * 1024:200 * 1024] = DATA[100 * 1024:200 * 1024]
+    (tmp_path / "doc.pdf.part").write_bytes(bytes(part))
+    (tmp_path / "doc.pdf.part.segments").write_text(json.dumps({"size": len(DATA), "done": [100 * 1024]}))
+
+    assert downloads.download_public("public", str(local_path), MD5, {}) == MD5
+    assert f"bytes={100 * 1024}-{200 * 1024 - 1}" not in server.requested
+    assert local_path.read_bytes() == DATA
+
+
+def test_file_with_another_hash_is_removed(server, tmp_path):
+    local_path = tmp_path / "doc.pdf"
+    # the part left by the previous run is corrupted
+    (tmp_path / "doc.pdf.part").write_bytes(b"\0" * 1000)
+
+    with pytest.raises(downloads.DownloadError, match=MD5):
+        downloads.download_public("public", str(local_path), MD5, {})
+    assert not local_path.exists()
+    assert not (tmp_path / "doc.pdf.part").exists()
+
+
+def test_fallback_download_with_another_hash_is_removed(monkeypatch, tmp_path):
+    def _unresolvable(*args):
+        raise downloads.LinkResolutionError("no href")
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(utils, "download_public", _unresolvable)
+    utils.forget_workdirs()
+    ya_client = SimpleNamespace(download_public=lambda url, f: f.write(DATA[:-1]))
+    doc = SimpleNamespace(md5=MD5, ya_path="/doc.pdf", mime_type="application/pdf", sharing_restricted=False, ya_public_url="public")
+    try:
+        with pytest.raises(downloads.DownloadError, match=MD5):
+            utils.download_file_locally(ya_client, doc, {})
+        entry_point = utils.get_in_workdir(Dirs.ENTRY_POINT)
+        assert os.listdir(entry_point) == []
+
+        ya_client.download_public = lambda url, f: f.write(DATA)
+        local_path = utils.download_file_locally(ya_client, doc, {})
+        assert os.listdir(entry_point) == [f"{MD5}.pdf"]
+        with open(local_path, "rb") as f:
+            assert f.read() == DATA
+    finally:
+        utils.forget_workdirs()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from geometry import match_boxes, pairwise_centroid_distance, pairwise_iou
+
+
+def _greedy(boxes_a, boxes_b, centroid_distance_threshold, iou_threshold=0.5):
+    """The matching replaced by `match_boxes`: the best remaining candidate is picked first"""
+    iou = pairwise_iou(boxes_a, boxes_b)
+    dist = pairwise_centroid_distance(boxes_a, boxes_b)
+    candidates = []
+    for i in range(len(iou)):
+        for j in range(len(iou[i])):
+            if iou[i, j] > iou_threshold:
+                candidates.append((-iou[i, j], i, j))
+            elif dist[i, j] < centroid_distance_threshold:
+                candidates.append((dist[i, j], i, j))
+    matched_a, matched_b, matches = set(), set(), []
+    for _, i, j in sorted(candidates):
+        if i not in matched_a and j not in matched_b:
+            matches.append((i, j))
+            matched_a.add(i)
+            matched_b.add(j)
+    return matches
+
+
+def _pairs(matches):
+    return sorted((i, j) for i, j, _, _ in matches)
+
+
+def test_assignment_matches_more_boxes_than_greedy():
+    # `a[0]` overlaps both boxes of `b`, `a[1]` overlaps only `b[0]`, which is the best match of `a[0]`
+    a = [[0, 0, 10, 9.5], [0, 1, 10, 10]]
+    b = [[0, 0, 10, 10], [0, -3, 10, 7]]
+    iou = pairwise_iou(a, b)
+    assert iou[0, 0] > iou[1, 0] > iou[0, 1] > 0.5 > iou[1, 1]
+
+    assert _greedy(a, b, centroid_distance_threshold=0) == [(0, 0)]
+    matches = match_boxes(a, b, centroid_distance_threshold=0)
+    assert _pairs(matches) == [(0, 1), (1, 0)]
+    assert [method for _, _, method, _ in matches] == ['iou', 'iou']
+
+
+def test_iou_candidate_takes_precedence_over_closer_centroid():
+    a = [[0, 0, 10, 10]]
+    # `b[0]` overlaps `a[0]`, the centroid of `b[1]` is closer but it is too small to overlap enough
+    b = [[0, 0, 10, 14], [4.5, 4.5, 5.5, 5.5]]
+    assert pairwise_centroid_distance(a, b)[0, 1] < pairwise_centroid_distance(a, b)[0, 0]
+
+    matches = match_boxes(a, b, centroid_distance_threshold=50)
+    assert len(matches) == 1
+    i, j, method, score = matches[0]
+    assert (i, j, method) == (0, 0, 'iou')
+    assert score == pytest.approx(100 / 140)
+
+
+def test_centroid_distance_candidate_is_matched_without_overlap():
+    matches = match_boxes([[0, 0, 10, 10]], [[20, 0, 30, 10]], centroid_distance_threshold=25)
+    assert matches == [(0, 0, 'centroid distance', 20.0)]
+    assert match_boxes([[0, 0, 10, 10]], [[20, 0, 30, 10]], centroid_distance_threshold=15) == []
+
+
+@pytest.mark.parametrize("a, b", [([], []), ([[0, 0, 10, 10]], []), ([], [[0, 0, 10, 10]])])
+def test_empty_inputs(a, b):
+    assert match_boxes(a, b, centroid_distance_threshold=100) == []
+    assert pairwise_iou(a, b).shape == (len(a), len(b))
+
+
+def test_zero_area_boxes_have_no_iou():
+    point = [5, 5, 5, 5]
+    iou = pairwise_iou([point, [0, 0, 0, 10]], [point, [0, 0, 10, 10]])
+    assert not np.isnan(iou).any()
+    assert (iou == 0).all()
+
+    # they may still be matched by the distance of their centroids
+    assert match_boxes([point], [point], centroid_distance_threshold=1) == [(0, 0, 'centroid distance', 0.0)]
+    assert match_boxes([point], [point], centroid_distance_threshold=0) == []
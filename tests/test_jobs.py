@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import Session
+
+import jobs
+from models import Base, Job
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'jobs.db'}")
+    Base.metadata.create_all(engine, tables=[Job.__table__])
+    monkeypatch.setattr(jobs, "get_engine", lambda: engine)
+    return engine
+
+
+def _expire_leases(engine):
+    with Session(engine) as session:
+        session.execute(update(Job).where(Job.status == jobs.RUNNING).values(lease_expires_at=jobs._now() - timedelta(seconds=1)))
+        session.commit()
+
+
+def _job(engine, md5):
+    with Session(engine) as session:
+        return session.scalars(select(Job).where(Job.md5 == md5)).one()
+
+
+def test_expired_leases_fail_the_job_after_max_attempts(engine):
+    queue = jobs.JobQueue("content_tt", {"jobs": {"max_attempts": 2}})
+    queue.enqueue(["a"])
+    try:
+        assert queue.claim(10) == ["a"]
+        _expire_leases(engine)
+        assert queue.claim(10) == ["a"]
+        assert _job(engine, "a").attempts == 1
+        _expire_leases(engine)
+        assert queue.claim(10) == []
+
+        job = _job(engine, "a")
+        assert (job.status, job.attempts, job.lease_owner) == (jobs.FAILED, 2, None)
+        _expire_leases(engine)
+        assert queue.claim(10) == []
+    finally:
+        queue.close()
+
+
+def test_failed_jobs_do_not_take_the_places_of_pending_ones(engine):
+    queue = jobs.JobQueue("content_tt", {"jobs": {"max_attempts": 1}})
+    queue.enqueue(["a"])
+    try:
+        assert queue.claim(1) == ["a"]
+        queue.enqueue(["b"])
+        _expire_leases(engine)
+        assert queue.claim(1) == ["b"]
+        assert _job(engine, "a").status == jobs.FAILED
+    finally:
+        queue.close()
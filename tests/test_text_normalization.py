@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from bench.text_normalization import RULE_SETS
+
+CASES = [
+    "![](a)-",
+    "![](a)- x",
+    "![](a)\n\n- x",
+    "![](a)\n![](b)\n- x",
+    "![](a)![](b)-",
+    "![x](a)- x",
+    "xml version='1.0' encoding='utf-8'?- x",
+    "xml version='1.0' encoding='utf-8'?\n![](a)\n- x",
+    "xml version='1.0' encoding='utf-8'?![](a)![](b)- x",
+    "x\n- y\n-z",
+    '<img src="m.png">- x',
+    "-\n-",
+]
+FRAGMENTS = [
+    "-", "- ", "-\n", "\n", "\n\n", " ", "x", "![](a)", "![x](b)", "xml version='1.0' encoding='utf-8'?",
+    '<img src="m.png">', "dN=`<a>`{=html}1`</a>`{=html}", "—",
+]
+
+
+@pytest.mark.parametrize("rule_set", RULE_SETS)
+@pytest.mark.parametrize("text", CASES)
+def test_fused_rules_give_the_same_result_as_sequential_ones(rule_set, text):
+    sequential, fused = RULE_SETS[rule_set]
+    assert fused(text) == sequential(text)
+
+
+@pytest.mark.parametrize("rule_set", RULE_SETS)
+def test_fused_rules_on_random_fragments(rule_set):
+    sequential, fused = RULE_SETS[rule_set]
+    rnd = random.Random(1552)
+    for _ in range(5000):
+        text = "".join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(1, 8)))
+        assert fused(text) == sequential(text), text
@@ -0,0 +1,43 @@
+import os
+import shutil
+
+import pytest
+
+import utils
+from content import pdf_extractor
+from dirs import Dirs
+
+MD5 = "0" * 32
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # the work directory is in the home directory
+    monkeypatch.setenv("HOME", str(tmp_path))
+    utils.forget_workdirs()
+    yield tmp_path
+    utils.forget_workdirs()
+
+
+def test_directory_of_document_is_created_again_after_eviction():
+    path = utils.get_in_workdir(Dirs.DOC_SLICES, MD5)
+    assert os.path.isdir(path)
+    # evicted by another process, the memoized paths of this one are not forgotten
+    shutil.rmtree(path)
+
+    assert utils.get_in_workdir(Dirs.DOC_SLICES, MD5, file="slice-0-1.pdf") == os.path.join(path, "slice-0-1.pdf")
+    assert os.path.isdir(path)
+
+
+def test_slice_is_created_after_eviction():
+    pymupdf = pytest.importorskip("pymupdf")
+    source = utils.get_in_workdir(Dirs.ENTRY_POINT, file=f"{MD5}.pdf")
+    with pymupdf.open() as doc:
+        doc.new_page()
+        doc.new_page()
+        doc.save(source)
+    shutil.rmtree(utils.get_in_workdir(Dirs.DOC_SLICES, MD5))
+
+    with pymupdf.open(source) as doc:
+        slice_path = pdf_extractor._create_doc_slice(0, 1, doc, MD5)
+    assert os.path.exists(slice_path)